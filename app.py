@@ -4,7 +4,15 @@ Main application with command-line interface
 """
 import os
 import argparse
-from rag import RAGSystem
+from concurrent.futures import Future, ThreadPoolExecutor
+from rag import RAGSystem, SEARCH_MODES
+from vectorstore_utils import FUSION_METHODS
+from reranker import DEFAULT_RERANK_MODEL
+from llm_integration import OllamaLLM, DEFAULT_OLLAMA_URL
+from context_builder import DEFAULT_CONTEXT_TOKENS
+from embedding_utils import (warmup_embedding_model, set_embedding_backend,
+                             EMBEDDING_BACKENDS, DEFAULT_BACKEND)
+from metrics import enable_metrics, write_prometheus
 
 def print_header():
     """Print application header"""
@@ -22,19 +30,30 @@ def print_help():
     print("  - Type 'exit' or 'quit' to end the session")
     print("  - Type 'help' to see this message")
     print("  - Type 'source' to change the index source")
+    print("  - Type 'stats' to see the query cache hit rate")
     print("\nExamples:")
     print("  > What topics are covered in the documentation?")
     print("  > How do I implement feature X?")
     print("  > Find information about error handling")
     print()
 
-def interactive_mode(rag_system, show_docs=True):
+def ready(rag_system):
+    """The RAG system, waiting for it if it is still warming up"""
+    if isinstance(rag_system, Future):
+        if not rag_system.done():
+            print("\nStill loading the model and index...")
+        rag_system = rag_system.result()
+    return rag_system
+
+def interactive_mode(rag_system, show_docs=True, metrics_file=None):
     """
     Run interactive query mode
     
     Args:
-        rag_system: Initialized RAG system
+        rag_system: Initialized RAG system, or a Future of one that is still
+            warming up; the first command that needs it waits for it
         show_docs: Whether to show retrieved documents
+        metrics_file: File rewritten with Prometheus metrics after each query
     """
     print_header()
     
@@ -51,10 +70,20 @@ def interactive_mode(rag_system, show_docs=True):
             elif query.lower() == 'help':
                 print_help()
                 continue
+            elif query.lower() == 'stats':
+                rag_system = ready(rag_system)
+                stats = rag_system.cache_stats()
+                if stats:
+                    print(f"\nQuery cache: {stats['hit_rate']:.0%} hit rate "
+                          f"({stats['exact_hits']} exact, {stats['semantic_hits']} semantic, "
+                          f"{stats['misses']} misses, {stats['entries']} entries)")
+                else:
+                    print("\nQuery cache is disabled")
+                continue
             elif query.lower() == 'source':
                 new_index = input("Enter path to index folder: ")
                 if os.path.exists(new_index):
-                    rag_system = RAGSystem(new_index)
+                    rag_system = ready(rag_system).with_index(new_index)
                     print(f"Now using index from: {new_index}")
                 else:
                     print(f"Error: Index not found at {new_index}")
@@ -63,24 +92,69 @@ def interactive_mode(rag_system, show_docs=True):
                 continue
                 
             # Process query
+            rag_system = ready(rag_system)
             print("\nSearching for relevant information...")
-            result = rag_system.query(query)
+            result = rag_system.stream_query(query)
             
             # Display results
             if show_docs:
                 print("\n📄 RETRIEVED DOCUMENTS:")
                 print(result["formatted_docs"])
                 
-            # If we had an LLM integration, we would show the generated answer here
-            if result["answer"]:
+            # Print the answer as it is generated; Ctrl+C stops only the answer
+            if rag_system.llm and result["retrieved_docs"]:
                 print("\n🤖 ANSWER:")
-                print(result["answer"])
+                tokens = result["answer_stream"]
+                try:
+                    for token in tokens:
+                        print(token, end="", flush=True)
+                    print()
+                    packing = result.get("context_stats")
+                    if packing:
+                        print(f"\n[Context: {packing['tokens']} tokens from {packing['chunks']} "
+                              f"chunks, {packing['tokens_saved']} saved, "
+                              f"{packing['duplicates']} duplicates dropped]")
+                except KeyboardInterrupt:
+                    tokens.close()
+                    print("\n[Answer cancelled]")
+            if metrics_file:
+                write_prometheus(metrics_file)
             
     except KeyboardInterrupt:
         print("\n\nExiting. Thank you for using Document Q&A Bot!")
     except Exception as e:
         print(f"\nAn error occurred: {e}")
 
+def load_rag_system(args: argparse.Namespace) -> RAGSystem:
+    """
+    Load the embedding model, the LLM client and the index
+    
+    Runs on a background thread while the prompt is already shown, so the
+    first query only pays the forward pass.
+    """
+    warmup_embedding_model(args.model)
+    
+    llm = None
+    if args.llm_model:
+        llm = OllamaLLM(args.llm_model, args.llm_url, timeout=args.llm_timeout,
+                        tokenizer=args.llm_tokenizer)
+        if not llm.load():
+            print("Continuing without answer generation")
+            llm = None
+    
+    rag_system = RAGSystem(args.index, llm=llm, model_name=args.model,
+                           nprobe=args.nprobe, ef_search=args.ef_search,
+                           shard_processes=args.shard_processes,
+                           search_mode=args.search_mode, fusion=args.fusion,
+                           vector_weight=args.vector_weight,
+                           rerank_model=args.rerank_model,
+                           rerank_candidates=args.rerank_candidates,
+                           rerank_budget_ms=args.rerank_budget_ms,
+                           use_cache=not args.no_cache,
+                           context_tokens=args.context_tokens or None)
+    rag_system.reload()
+    return rag_system
+
 def main():
     """Main entry point"""
     parser = argparse.ArgumentParser(description="Document Q&A Bot")
@@ -89,13 +163,63 @@ def main():
     parser.add_argument("--hide-docs", action="store_true",
                       help="Hide retrieved documents and show only answers")
     
+    parser.add_argument("--model", "-m", default="all-MiniLM-L6-v2",
+                      help="SentenceTransformer model used for query embeddings")
+    parser.add_argument("--backend", choices=EMBEDDING_BACKENDS, default=DEFAULT_BACKEND,
+                      help="Run the embedding model on PyTorch, or exported to ONNX "
+                           "(onnx-int8 also quantizes its weights)")
+    parser.add_argument("--nprobe", type=int,
+                      help="IVF lists visited per query (defaults to the index setting)")
+    parser.add_argument("--shard-processes", type=int, default=0,
+                      help="Worker processes searching the shards of a sharded index "
+                           "(0 searches them on threads)")
+    parser.add_argument("--ef-search", type=int,
+                      help="HNSW search depth per query (defaults to the index setting)")
+    parser.add_argument("--search-mode", choices=SEARCH_MODES, default="vector",
+                      help="vector (embeddings), keyword (BM25) or hybrid (both, fused)")
+    parser.add_argument("--fusion", choices=FUSION_METHODS, default="rrf",
+                      help="How hybrid search merges rankings: reciprocal rank or weighted scores")
+    parser.add_argument("--vector-weight", type=float, default=0.5,
+                      help="Share of the vector score in weighted fusion")
+    parser.add_argument("--rerank-model",
+                      help="Cross-encoder used to rerank candidates "
+                           f"(e.g. {DEFAULT_RERANK_MODEL}); reranking is off when omitted")
+    parser.add_argument("--rerank-candidates", type=int, default=50,
+                      help="Candidates fetched per query for reranking")
+    parser.add_argument("--rerank-budget-ms", type=float,
+                      help="Stop reranking new batches after this many milliseconds")
+    parser.add_argument("--llm-model",
+                      help="Ollama model used to generate answers (e.g. llama3); "
+                           "retrieval only when omitted")
+    parser.add_argument("--llm-url", default=DEFAULT_OLLAMA_URL,
+                      help="URL of the Ollama-compatible server")
+    parser.add_argument("--llm-timeout", type=float, default=120.0,
+                      help="Maximum seconds for one answer")
+    parser.add_argument("--llm-tokenizer",
+                      help="Hugging Face tokenizer matching the LLM, used to count "
+                           "context tokens (approximated when omitted)")
+    parser.add_argument("--context-tokens", type=int, default=DEFAULT_CONTEXT_TOKENS,
+                      help="Token budget of the context sent to the LLM (0 for no limit)")
+    parser.add_argument("--no-cache", action="store_true",
+                      help="Do not reuse results of identical or similar earlier queries")
+    parser.add_argument("--metrics-file",
+                      help="Keep stage latencies, batch sizes, cache hit counts and index "
+                           "size in this file, in the Prometheus text format")
+    parser.add_argument("--log-json",
+                      help="Append one JSON line per pipeline stage to this file (- for stderr)")
+    
     args = parser.parse_args()
+    if args.metrics_file or args.log_json:
+        enable_metrics(args.log_json)
     
-    # Initialize RAG system
-    rag_system = RAGSystem(args.index)
+    # Warm up in the background while the user types the first question
+    set_embedding_backend(args.backend)
+    warmup = ThreadPoolExecutor(max_workers=1, thread_name_prefix="warmup")
+    rag_system = warmup.submit(load_rag_system, args)
+    warmup.shutdown(wait=False)
     
     # Start interactive mode
-    interactive_mode(rag_system, not args.hide_docs)
+    interactive_mode(rag_system, not args.hide_docs, args.metrics_file)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
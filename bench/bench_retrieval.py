@@ -0,0 +1,308 @@
+# bench/bench_retrieval.py
+"""
+Recall/latency benchmark for the retrieval path
+
+Builds synthetic corpora by recombining sentences from sample_documents.json,
+indexes them with each FAISS index type and writes ingest throughput, build
+time, index size, query latency percentiles, QPS under concurrency and
+recall@k against an exact flat index to a JSON file.
+
+Example:
+    python bench/bench_retrieval.py --sizes 1000,100000 --embedder hash
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import re
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import numpy as np
+import faiss
+
+# Add the repository root to path for module imports
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.documents import Document
+from index_factory import INDEX_TYPES, build_index, resolve_index_params, training_size
+from keyword_index import KEYWORD_DIR, KeywordIndex
+from embedding_utils import encode_documents, encode_queries
+
+SAMPLE_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           "sample_documents.json")
+
+
+def load_sentences(path: str = SAMPLE_FILE) -> List[str]:
+    """Split the sample corpus into sentences used to synthesize chunks"""
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    sentences = []
+    for chunk in data:
+        sentences.extend(s.strip() for s in re.split(r"(?<=[.!?])\s+", chunk["page_content"])
+                         if s.strip())
+    return sentences
+
+
+def synthetic_corpus(size: int, sentences: List[str], seed: int = 0) -> List[Document]:
+    """Generate size chunks of 2-4 random sentences plus a unique identifier"""
+    rng = random.Random(seed)
+    docs = []
+    for i in range(size):
+        text = " ".join(rng.choice(sentences) for _ in range(rng.randint(2, 4)))
+        docs.append(Document(page_content=f"{text} Reference DOC-{i:07d}.",
+                             metadata={"source": f"synthetic_{i % 1000}.txt", "chunk": i}))
+    return docs
+
+
+def synthetic_queries(docs: List[Document], count: int, seed: int = 1) -> List[str]:
+    """Build short keyword queries from random words of random chunks"""
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(count):
+        words = rng.choice(docs).page_content.split()
+        queries.append(" ".join(rng.sample(words, min(6, len(words)))))
+    return queries
+
+
+def hash_embed(texts: List[str], dim: int = 384) -> np.ndarray:
+    """
+    Deterministic hashing-trick embeddings
+
+    Much faster than a transformer, so index behaviour can be measured at
+    millions of chunks on CPU; vectors still cluster by shared vocabulary.
+    """
+    vectors = np.zeros((len(texts), dim), dtype="float32")
+    for row, text in enumerate(texts):
+        for token in re.findall(r"\w+", text.lower()):
+            digest = hashlib.md5(token.encode("utf-8")).digest()
+            column = int.from_bytes(digest[:4], "little") % dim
+            vectors[row, column] += 1.0 if digest[4] & 1 else -1.0
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def embed(texts: List[str], args, batch_size: int = 256) -> np.ndarray:
+    if args.embedder == "hash":
+        return hash_embed(texts, args.dim)
+    return encode_documents(texts, args.model, batch_size)
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    values = np.asarray(samples) * 1000.0
+    return {f"p{p}": round(float(np.percentile(values, p)), 3) for p in (50, 95, 99)}
+
+
+def index_bytes(index: faiss.Index) -> int:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "index.faiss")
+        faiss.write_index(index, path)
+        return os.path.getsize(path)
+
+
+def measure_qps(index: faiss.Index, queries: np.ndarray, k: int, threads: int,
+                duration: float) -> float:
+    """Run single-query searches from several threads for a fixed duration"""
+    deadline = time.perf_counter() + duration
+
+    def worker(offset: int) -> int:
+        done = 0
+        while time.perf_counter() < deadline:
+            row = (offset + done) % len(queries)
+            index.search(queries[row:row + 1], k)
+            done += 1
+        return done
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        total = sum(pool.map(worker, range(threads)))
+    return total / (time.perf_counter() - start)
+
+
+def run_keyword(size: int, docs: List[Document], query_texts: List[str], k: int) -> Dict:
+    """Build the BM25 keyword index of a corpus and time keyword queries"""
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        KeywordIndex.write(tmp, np.arange(size), lambda i: docs[i].page_content)
+        build_seconds = time.perf_counter() - start
+        index_size = sum(os.path.getsize(os.path.join(tmp, KEYWORD_DIR, name))
+                         for name in os.listdir(os.path.join(tmp, KEYWORD_DIR)))
+
+        keyword_index = KeywordIndex(tmp)
+        # Touch the mapped postings once so latencies reflect a warm page cache
+        for query in query_texts:
+            keyword_index.search(query, k)
+        latencies = []
+        for query in query_texts:
+            t0 = time.perf_counter()
+            keyword_index.search(query, k)
+            latencies.append(time.perf_counter() - t0)
+        del keyword_index
+
+    result = {
+        "size": size,
+        "build_seconds": round(build_seconds, 3),
+        "index_bytes": index_size,
+        "search_latency_ms": percentiles(latencies),
+    }
+    print(json.dumps({"keyword": result}))
+    return result
+
+
+def run_size(size: int, sentences: List[str], args) -> List[Dict]:
+    """Benchmark every requested index type on one corpus size"""
+    docs = synthetic_corpus(size, sentences)
+    query_texts = synthetic_queries(docs, args.queries)
+    if args.keyword:
+        args.keyword_results.append(run_keyword(size, docs, query_texts, args.k))
+
+    start = time.perf_counter()
+    vectors = np.vstack([embed([d.page_content for d in docs[i:i + args.batch_size]], args,
+                               args.batch_size)
+                         for i in range(0, size, args.batch_size)])
+    embed_seconds = time.perf_counter() - start
+    ids = np.arange(size, dtype="int64")
+
+    start = time.perf_counter()
+    if args.embedder == "hash":
+        queries = hash_embed(query_texts, args.dim)
+    else:
+        queries = encode_queries(query_texts, args.model, args.batch_size)
+    encode_ms = (time.perf_counter() - start) * 1000.0 / len(query_texts)
+
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    _, truth = exact.search(queries, args.k)
+
+    results = []
+    for index_type in args.index_types:
+        params = resolve_index_params({"nlist": args.nlist})
+        sample_size = training_size(index_type, params)
+        train = vectors[np.random.default_rng(0).permutation(size)[:sample_size]] if sample_size else None
+
+        start = time.perf_counter()
+        index, config = build_index(index_type, vectors.shape[1], params, train)
+        index.add_with_ids(vectors, ids)
+        build_seconds = time.perf_counter() - start
+
+        latencies = []
+        for row in range(len(queries)):
+            t0 = time.perf_counter()
+            index.search(queries[row:row + 1], args.k)
+            latencies.append(time.perf_counter() - t0)
+
+        _, found = index.search(queries, args.k)
+        recall = np.mean([len(set(f) & set(t)) / args.k for f, t in zip(found, truth)])
+
+        # One OpenMP thread per search so concurrency comes from the clients
+        omp_threads = faiss.omp_get_max_threads()
+        faiss.omp_set_num_threads(1)
+        qps = {str(t): round(measure_qps(index, queries, args.k, t, args.qps_seconds), 1)
+               for t in args.threads}
+        faiss.omp_set_num_threads(omp_threads)
+
+        result = {
+            "size": size,
+            "index_type": index_type,
+            "index_config": config,
+            "ingest_docs_per_sec": round(size / (embed_seconds + build_seconds), 1),
+            "embed_seconds": round(embed_seconds, 3),
+            "build_seconds": round(build_seconds, 3),
+            "index_bytes": index_bytes(index),
+            "query_encode_ms": round(encode_ms, 3),
+            "search_latency_ms": percentiles(latencies),
+            "qps": qps,
+            f"recall_at_{args.k}": round(float(recall), 4),
+        }
+        print(json.dumps(result))
+        results.append(result)
+    return results
+
+
+def compare(current: List[Dict], baseline_path: str) -> None:
+    """Print changes in latency, QPS and recall against a previous run"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {(r["size"], r["index_type"]): r for r in json.load(f)["results"]}
+    for result in current:
+        old = baseline.get((result["size"], result["index_type"]))
+        if not old:
+            continue
+        recall_key = next(key for key in result if key.startswith("recall_at_"))
+        p95_old = old["search_latency_ms"]["p95"]
+        p95_new = result["search_latency_ms"]["p95"]
+        change = (p95_new - p95_old) / p95_old * 100 if p95_old else 0.0
+        threads = max(result["qps"], key=int)
+        print(f"{result['size']:>9} {result['index_type']:<9} "
+              f"p95 {p95_old:.3f} -> {p95_new:.3f} ms ({change:+.1f}%)  "
+              f"qps@{threads} {old['qps'].get(threads, 0):.0f} -> {result['qps'][threads]:.0f}  "
+              f"{recall_key} {old.get(recall_key, 0):.4f} -> {result[recall_key]:.4f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark FlowQuery retrieval")
+    parser.add_argument("--sizes", default="1000,100000",
+                        help="Comma-separated corpus sizes in chunks (e.g. 1000,100000,1000000)")
+    parser.add_argument("--index-types", default=",".join(INDEX_TYPES),
+                        help="Comma-separated index types to benchmark")
+    parser.add_argument("--embedder", choices=["model", "hash"], default="model",
+                        help="Embed with the SentenceTransformer model or the fast hashing trick")
+    parser.add_argument("--model", "-m", default="all-MiniLM-L6-v2",
+                        help="SentenceTransformer model for --embedder model")
+    parser.add_argument("--dim", type=int, default=384,
+                        help="Vector dimension for --embedder hash")
+    parser.add_argument("--k", type=int, default=10, help="Neighbours per query")
+    parser.add_argument("--queries", type=int, default=500, help="Number of queries")
+    parser.add_argument("--nlist", type=int, default=1024, help="IVF lists")
+    parser.add_argument("--batch-size", type=int, default=256, help="Embedding batch size")
+    parser.add_argument("--threads", default="1,4",
+                        help="Comma-separated client thread counts for the QPS test")
+    parser.add_argument("--qps-seconds", type=float, default=3.0,
+                        help="Duration of each QPS measurement")
+    parser.add_argument("--no-keyword", dest="keyword", action="store_false",
+                        help="Skip the BM25 keyword index benchmark")
+    parser.add_argument("--output", "-o", default=None,
+                        help="JSON results file (default: bench/results/<timestamp>.json)")
+    parser.add_argument("--baseline", default=None,
+                        help="Previous results file to compare against")
+    args = parser.parse_args()
+
+    args.index_types = [t for t in args.index_types.split(",") if t]
+    args.threads = [int(t) for t in args.threads.split(",") if t]
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    args.keyword_results = []
+
+    sentences = load_sentences()
+    results = []
+    for size in sizes:
+        results.extend(run_size(size, sentences, args))
+
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), "results",
+                                         time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({
+            "meta": {
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "platform": platform.platform(),
+                "python": platform.python_version(),
+                "faiss": faiss.__version__,
+                "cpu_count": os.cpu_count(),
+                "args": {key: value for key, value in vars(args).items()
+                         if key != "keyword_results"},
+            },
+            "results": results,
+            "keyword": args.keyword_results,
+        }, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
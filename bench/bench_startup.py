@@ -0,0 +1,166 @@
+# bench/bench_startup.py
+"""
+Startup-time benchmark for the command line tools
+
+Runs each measurement in a fresh interpreter and writes to a JSON file the
+wall time of `app.py --help` and `ingest.py --help`, the time to import the
+app module, the heavy packages that import pulls in, and - when an index is
+given - the time until the interactive prompt is shown and until the first
+query is answered.
+
+Example:
+    python bench/bench_startup.py --index my_index --runs 5
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Packages that should only be imported once a command actually needs them
+HEAVY_MODULES = ["torch", "sentence_transformers", "transformers", "onnxruntime",
+                 "langchain_community.vectorstores", "langchain_huggingface", "langsmith",
+                 "docx", "PyPDF2"]
+
+IMPORT_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import app
+seconds = time.perf_counter() - start
+print(json.dumps({"seconds": seconds,
+                  "loaded": [m for m in %r if m in sys.modules]}))
+"""
+
+
+def run_python(args: List[str]) -> float:
+    """Wall time in seconds of one interpreter running args from the repo root"""
+    start = time.perf_counter()
+    subprocess.run([sys.executable] + args, cwd=ROOT,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+def summary(samples: List[float]) -> Dict[str, float]:
+    return {"min": round(min(samples), 3), "median": round(statistics.median(samples), 3),
+            "max": round(max(samples), 3)}
+
+
+def measure_import(runs: int) -> Dict:
+    """Time `import app` and list the heavy modules it loads"""
+    samples, loaded = [], []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", IMPORT_PROBE % HEAVY_MODULES],
+                                cwd=ROOT, capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        samples.append(result["seconds"])
+        loaded = result["loaded"]
+    return {"seconds": summary(samples), "heavy_modules_loaded": loaded}
+
+
+def measure_interactive(args) -> Dict:
+    """
+    Time until the prompt appears and until the first query is answered
+
+    Reads app.py's output line by line; the prompt counts as shown once the
+    usage header has been printed and the query as answered once its
+    retrieved documents are.
+    """
+    prompt_samples, answer_samples = [], []
+    command = [sys.executable, "-u", "app.py", "--index", args.index, "--model", args.model,
+               "--no-cache"]
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=ROOT, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                   text=True, bufsize=1)
+        process.stdin.write(args.query + "\nexit\n")
+        process.stdin.flush()
+        prompt_seconds = answer_seconds = None
+        for line in process.stdout:
+            now = time.perf_counter() - start
+            if prompt_seconds is None and "Type 'help'" in line:
+                prompt_seconds = now
+            elif answer_seconds is None and "RETRIEVED DOCUMENTS" in line:
+                answer_seconds = now
+        process.wait()
+        if prompt_seconds is not None:
+            prompt_samples.append(prompt_seconds)
+        if answer_seconds is not None:
+            answer_samples.append(answer_seconds)
+    return {
+        "prompt_seconds": summary(prompt_samples) if prompt_samples else None,
+        "first_answer_seconds": summary(answer_samples) if answer_samples else None,
+    }
+
+
+def compare(current: Dict, baseline_path: str) -> None:
+    """Print changes in startup times against a previous run"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    for name, result in current.items():
+        old = baseline.get(name)
+        if not result or not old:
+            continue
+        for key, value in result.items():
+            if isinstance(value, dict) and isinstance(old.get(key), dict):
+                old_median, new_median = old[key]["median"], value["median"]
+                change = (new_median - old_median) / old_median * 100 if old_median else 0.0
+                print(f"{name:<12} {key:<22} {old_median:.3f} -> {new_median:.3f} s "
+                      f"({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark FlowQuery startup time")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters per measurement")
+    parser.add_argument("--index", "-i",
+                        help="Index used to time the interactive prompt and first answer "
+                             "(skipped when omitted)")
+    parser.add_argument("--model", "-m", default="all-MiniLM-L6-v2",
+                        help="Embedding model used with --index")
+    parser.add_argument("--query", default="What topics are covered in the documentation?",
+                        help="First query sent to the interactive prompt")
+    parser.add_argument("--output", "-o", default=None,
+                        help="JSON results file (default: bench/results/startup-<timestamp>.json)")
+    parser.add_argument("--baseline", default=None,
+                        help="Previous results file to compare against")
+    args = parser.parse_args()
+
+    results = {
+        "app_help": {"seconds": summary([run_python(["app.py", "--help"])
+                                         for _ in range(args.runs)])},
+        "ingest_help": {"seconds": summary([run_python(["ingest.py", "--help"])
+                                            for _ in range(args.runs)])},
+        "import_app": measure_import(args.runs),
+    }
+    if args.index:
+        results["interactive"] = measure_interactive(args)
+    print(json.dumps(results, indent=2))
+
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), "results",
+                                         "startup-" + time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({
+            "meta": {
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "platform": platform.platform(),
+                "python": platform.python_version(),
+                "cpu_count": os.cpu_count(),
+                "args": vars(args),
+            },
+            "results": results,
+        }, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
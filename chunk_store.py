@@ -0,0 +1,319 @@
+# chunk_store.py
+"""
+Memory-mapped chunk texts stored next to a FAISS index
+"""
+import json
+import os
+import struct
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Set, Tuple, Union
+import numpy as np
+from langchain_core.documents import Document
+from langchain_community.docstore.base import AddableMixin, Docstore
+
+CHUNK_DIR = "chunks"
+_INFO_FILE = "info.json"
+_IDS_FILE = "ids.npy"
+_BLOCKS_FILE = "blocks.npy"
+_TEXTS_FILE = "texts.bin"
+
+FORMAT_VERSION = 2
+
+# How chunk texts are stored: raw UTF-8, or zstd-compressed per block
+CHUNK_COMPRESSIONS = ("none", "zstd")
+
+# Texts per block; a lookup reads (and, if compressed, decompresses) one block
+BLOCK_SIZE = 64
+
+# Decompressed blocks kept per open store
+BLOCK_CACHE_SIZE = 256
+
+ZSTD_LEVEL = 3
+
+_LENGTH = struct.Struct("<I")
+
+
+def docstore_id(chunk_id: int) -> str:
+    """Docstore key of a chunk ID, as used in index_to_docstore_id"""
+    return f"{chunk_id:015x}"
+
+
+def _split_block(block: bytes) -> List[bytes]:
+    """Texts of a block of length-prefixed UTF-8 blobs"""
+    texts, position = [], 0
+    while position < len(block):
+        (length,) = _LENGTH.unpack_from(block, position)
+        position += _LENGTH.size
+        texts.append(block[position:position + length])
+        position += length
+    return texts
+
+
+class ChunkStore:
+    """
+    Chunk texts keyed by chunk ID, read through memory maps
+
+    On disk, ids.npy holds the sorted chunk IDs and texts.bin their texts in
+    ID order as length-prefixed UTF-8 blobs, grouped into blocks of
+    BLOCK_SIZE texts that are optionally zstd-compressed one by one;
+    blocks.npy holds the byte offset of each block (plus the end of the
+    last one). Opening a store maps the files without reading them, so
+    startup costs nothing, a lookup touches only the block of the text it
+    returns, and processes serving the same index share those pages
+    through the OS page cache.
+    """
+
+    def __init__(self, index_name: str):
+        """
+        Open the chunk store of an index folder (nothing is read until first use)
+
+        Args:
+            index_name: Path to the index folder
+        """
+        self.path = os.path.join(index_name, CHUNK_DIR)
+        self._read_info()
+        self._ids: Optional[np.ndarray] = None
+        self._blocks: Optional[np.ndarray] = None
+        self._texts: Optional[np.ndarray] = None
+        self._cache: "OrderedDict[int, List[bytes]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    @staticmethod
+    def exists(index_name: str) -> bool:
+        """Whether an index folder has a chunk store"""
+        return os.path.exists(os.path.join(index_name, CHUNK_DIR, _INFO_FILE))
+
+    @staticmethod
+    def write(index_name: str, ids: Sequence[int], text_of: Callable[[int], str],
+              compression: str = "none") -> None:
+        """
+        Write the texts of the given chunk IDs, replacing any existing store
+
+        Each file is written next to its predecessor and renamed over it, so
+        processes that still map the old files (including the store text_of
+        may be reading from) keep seeing the previous version.
+
+        Args:
+            index_name: Path to the index folder
+            ids: Every chunk ID of the index
+            text_of: Returns the text of a chunk ID
+            compression: One of CHUNK_COMPRESSIONS
+        """
+        if compression not in CHUNK_COMPRESSIONS:
+            raise ValueError(f"Unknown chunk compression '{compression}', "
+                             f"expected one of {CHUNK_COMPRESSIONS}")
+        compress = None
+        if compression == "zstd":
+            import zstandard
+            compress = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress
+        path = os.path.join(index_name, CHUNK_DIR)
+        os.makedirs(path, exist_ok=True)
+        ids = np.unique(np.asarray(ids, dtype="int64"))
+        blocks = np.zeros((len(ids) + BLOCK_SIZE - 1) // BLOCK_SIZE + 1, dtype="int64")
+        with open(os.path.join(path, _TEXTS_FILE + ".tmp"), "wb") as f:
+            for number, start in enumerate(range(0, len(ids), BLOCK_SIZE)):
+                parts = []
+                for chunk_id in ids[start:start + BLOCK_SIZE].tolist():
+                    data = text_of(chunk_id).encode("utf-8")
+                    parts += [_LENGTH.pack(len(data)), data]
+                block = b"".join(parts)
+                if compress is not None:
+                    block = compress(block)
+                f.write(block)
+                blocks[number + 1] = blocks[number] + len(block)
+        np.save(os.path.join(path, _IDS_FILE + ".tmp.npy"), ids)
+        np.save(os.path.join(path, _BLOCKS_FILE + ".tmp.npy"), blocks)
+        with open(os.path.join(path, _INFO_FILE + ".tmp"), "w", encoding="utf-8") as f:
+            json.dump({"format": FORMAT_VERSION, "compression": compression,
+                       "block_size": BLOCK_SIZE, "count": len(ids)}, f)
+        os.replace(os.path.join(path, _TEXTS_FILE + ".tmp"), os.path.join(path, _TEXTS_FILE))
+        os.replace(os.path.join(path, _IDS_FILE + ".tmp.npy"), os.path.join(path, _IDS_FILE))
+        os.replace(os.path.join(path, _BLOCKS_FILE + ".tmp.npy"),
+                   os.path.join(path, _BLOCKS_FILE))
+        os.replace(os.path.join(path, _INFO_FILE + ".tmp"), os.path.join(path, _INFO_FILE))
+
+    def _read_info(self) -> None:
+        with open(os.path.join(self.path, _INFO_FILE), "r", encoding="utf-8") as f:
+            info = json.load(f)
+        if info.get("format") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported chunk store format {info.get('format')} in {self.path}")
+        self.compression = info["compression"]
+        self.block_size = info["block_size"]
+
+    def _load(self) -> None:
+        if self._ids is None:
+            # Map every file at once, so a later write cannot mix two versions
+            self._read_info()
+            blocks = np.load(os.path.join(self.path, _BLOCKS_FILE), mmap_mode="r")
+            self._texts = (np.memmap(os.path.join(self.path, _TEXTS_FILE), dtype="uint8",
+                                     mode="r") if int(blocks[-1]) else np.empty(0, dtype="uint8"))
+            self._blocks = blocks
+            self._ids = np.load(os.path.join(self.path, _IDS_FILE), mmap_mode="r")
+
+    @property
+    def ids(self) -> np.ndarray:
+        """Sorted chunk IDs, one per row"""
+        self._load()
+        return self._ids
+
+    def _data(self):
+        self._load()
+        return self._blocks, self._texts
+
+    def _read_block(self, number: int) -> List[bytes]:
+        blocks, texts = self._data()
+        data = texts[blocks[number]:blocks[number + 1]].tobytes()
+        if self.compression == "zstd":
+            import zstandard
+            data = zstandard.ZstdDecompressor().decompress(data)
+        return _split_block(data)
+
+    def _block(self, number: int) -> List[bytes]:
+        """Texts of a block, through a small LRU cache when compressed"""
+        if self.compression == "none":
+            return self._read_block(number)
+        with self._cache_lock:
+            if number in self._cache:
+                self._cache.move_to_end(number)
+                return self._cache[number]
+        texts = self._read_block(number)
+        with self._cache_lock:
+            self._cache[number] = texts
+            if len(self._cache) > BLOCK_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return texts
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def row(self, chunk_id: int) -> int:
+        """Row of a chunk ID, or -1 if it is not stored"""
+        ids = self.ids
+        row = int(np.searchsorted(ids, chunk_id))
+        return row if row < len(ids) and ids[row] == chunk_id else -1
+
+    def __contains__(self, chunk_id) -> bool:
+        return isinstance(chunk_id, (int, np.integer)) and self.row(int(chunk_id)) >= 0
+
+    def text(self, chunk_id: int) -> Optional[str]:
+        """Text of a chunk ID, or None if it is not stored"""
+        row = self.row(chunk_id)
+        if row < 0:
+            return None
+        number, offset = divmod(row, self.block_size)
+        return self._block(number)[offset].decode("utf-8")
+
+    def texts(self, ids: Sequence[int]) -> List[Optional[str]]:
+        """Texts of several chunk IDs (None for IDs that are not stored)"""
+        return [self.text(int(chunk_id)) for chunk_id in ids]
+
+    def items(self) -> Iterator[Tuple[int, str]]:
+        """Every (chunk ID, text) pair in ID order"""
+        blocks, _ = self._data()
+        ids = self.ids.tolist()
+        for number in range(len(blocks) - 1):
+            start = number * self.block_size
+            for chunk_id, data in zip(ids[start:start + self.block_size],
+                                      self._read_block(number)):
+                yield chunk_id, data.decode("utf-8")
+
+
+class ChunkIdMap(MutableMapping):
+    """
+    index_to_docstore_id mapping backed by a ChunkStore
+
+    Membership tests and lookups are binary searches over the mapped ID
+    array, so no per-chunk Python objects are created when an index opens.
+    Additions and removals are kept in memory on top of the store.
+    """
+
+    def __init__(self, store: ChunkStore):
+        self.store = store
+        self._added: Dict[int, str] = {}
+        self._removed: Set[int] = set()
+
+    def _stored(self, chunk_id) -> bool:
+        return chunk_id not in self._removed and chunk_id in self.store
+
+    def __getitem__(self, chunk_id) -> str:
+        if chunk_id in self._added:
+            return self._added[chunk_id]
+        if not self._stored(chunk_id):
+            raise KeyError(chunk_id)
+        return docstore_id(int(chunk_id))
+
+    def __setitem__(self, chunk_id, value: str) -> None:
+        if self._stored(chunk_id) or chunk_id in self._added:
+            del self[chunk_id]
+        self._added[int(chunk_id)] = value
+
+    def __delitem__(self, chunk_id) -> None:
+        if chunk_id in self._added:
+            del self._added[chunk_id]
+        elif self._stored(chunk_id):
+            self._removed.add(int(chunk_id))
+        else:
+            raise KeyError(chunk_id)
+
+    def __contains__(self, chunk_id) -> bool:
+        return chunk_id in self._added or self._stored(chunk_id)
+
+    def __iter__(self) -> Iterator[int]:
+        for chunk_id in self.store.ids.tolist():
+            if chunk_id not in self._removed and chunk_id not in self._added:
+                yield chunk_id
+        yield from self._added
+
+    def __len__(self) -> int:
+        overlap = sum(1 for chunk_id in self._added
+                      if chunk_id in self.store and chunk_id not in self._removed)
+        return len(self.store) - len(self._removed) + len(self._added) - overlap
+
+
+class ChunkDocstore(Docstore, AddableMixin):
+    """
+    Langchain docstore serving texts from a ChunkStore
+
+    Documents are built only for the texts a search returns. Documents
+    added or deleted after loading are tracked in memory on top of the
+    store until the index is saved again.
+    """
+
+    def __init__(self, store: ChunkStore):
+        self.store = store
+        self._added: Dict[str, Document] = {}
+        self._deleted: Set[str] = set()
+
+    def text(self, search: str) -> Optional[str]:
+        """Text of a document without building a Document, or None if unknown"""
+        if search in self._added:
+            return self._added[search].page_content
+        return None if search in self._deleted else self.store.text(int(search, 16))
+
+    def pending(self, search: str) -> Optional[Document]:
+        """Document added since the store was written, if any"""
+        return self._added.get(search)
+
+    def search(self, search: str) -> Union[str, Document]:
+        if search in self._added:
+            return self._added[search]
+        text = self.text(search)
+        if text is None:
+            return f"ID {search} not found."
+        return Document(page_content=text, metadata={})
+
+    def add(self, texts: Dict[str, Document]) -> None:
+        overlapping = [key for key in texts if not isinstance(self.search(key), str)]
+        if overlapping:
+            raise ValueError(f"Tried to add ids that already exist: {overlapping}")
+        self._added.update(texts)
+
+    def delete(self, ids: List) -> None:
+        missing = [key for key in ids if isinstance(self.search(key), str)]
+        if missing:
+            raise ValueError(f"Tried to delete ids that does not exist: {missing}")
+        for key in ids:
+            if self._added.pop(key, None) is None:
+                self._deleted.add(key)
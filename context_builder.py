@@ -0,0 +1,164 @@
+# context_builder.py
+"""
+Packing of retrieved chunks into an LLM context within a token budget
+"""
+import re
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+from langchain_core.documents import Document
+
+# Context tokens given to the LLM by default
+DEFAULT_CONTEXT_TOKENS = 2048
+
+# Share of a chunk's word shingles already in the context above which the
+# chunk is dropped as a near-duplicate
+DEFAULT_DUPLICATE_THRESHOLD = 0.8
+
+# Words per shingle used to compare chunks
+SHINGLE_SIZE = 3
+
+# A chunk that overflows the budget is truncated only if at least this many
+# tokens of it fit; otherwise it is skipped
+MIN_TRUNCATED_TOKENS = 32
+
+CONTEXT_SEPARATOR = "\n\n"
+
+_SENTENCE_RE = re.compile(r"\S.*?(?:[.!?]+(?=\s)|$)", re.S)
+_WORD_RE = re.compile(r"\w+")
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+_tokenizers: Dict[str, Any] = {}
+_tokenizers_lock = threading.Lock()
+
+
+def get_tokenizer(name: str):
+    """Return the process-wide Hugging Face tokenizer of a model"""
+    with _tokenizers_lock:
+        if name not in _tokenizers:
+            from transformers import AutoTokenizer
+            _tokenizers[name] = AutoTokenizer.from_pretrained(name)
+        return _tokenizers[name]
+
+
+def _shingles(text: str) -> set:
+    words = _WORD_RE.findall(text.lower())
+    if len(words) < SHINGLE_SIZE:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def _sentence_key(sentence: str) -> str:
+    return " ".join(_WORD_RE.findall(sentence.lower()))
+
+
+class ContextBuilder:
+    """
+    Builds the LLM context from ranked chunks
+
+    Chunks are taken best first. A chunk whose word shingles are mostly
+    (duplicate_threshold) covered by chunks already taken is dropped, and
+    sentences repeated from earlier chunks, such as the overlap between
+    consecutive chunks of a document, are removed from the rest. Chunks are
+    added until max_tokens is reached; the chunk that crosses the budget is
+    cut at a word boundary when enough of it fits. Tokens are counted with
+    the target model's tokenizer when one is given, else approximated.
+    """
+
+    def __init__(self, max_tokens: Optional[int] = DEFAULT_CONTEXT_TOKENS,
+                 duplicate_threshold: Optional[float] = DEFAULT_DUPLICATE_THRESHOLD,
+                 tokenizer=None):
+        """
+        Initialize the builder
+
+        Args:
+            max_tokens: Token budget of the context (None means unlimited)
+            duplicate_threshold: Shingle coverage above which a chunk is a
+                near-duplicate (None keeps every chunk)
+            tokenizer: Hugging Face tokenizer, or its model name, matching
+                the LLM; a word/punctuation approximation is used when omitted
+        """
+        self.max_tokens = max_tokens
+        self.duplicate_threshold = duplicate_threshold
+        if isinstance(tokenizer, str):
+            tokenizer = get_tokenizer(tokenizer)
+        self.tokenizer = tokenizer
+
+    def count_tokens(self, texts: List[str]) -> List[int]:
+        """Return the token count of each text"""
+        if not texts:
+            return []
+        if self.tokenizer is None:
+            return [len(_TOKEN_RE.findall(text)) for text in texts]
+        return [len(ids) for ids in
+                self.tokenizer(texts, add_special_tokens=False)["input_ids"]]
+
+    def build(self, docs: List[Document]) -> Tuple[str, Dict[str, int]]:
+        """
+        Pack ranked documents into a context string
+
+        Args:
+            docs: Retrieved documents, best first
+
+        Returns:
+            (context, stats); stats has the token count of the context and of
+            the unpacked concatenation, tokens_saved, and the number of chunks
+            used, dropped as duplicates, trimmed of repeated sentences,
+            truncated and skipped for the budget
+        """
+        stats = {"chunks": 0, "duplicates": 0, "trimmed": 0, "truncated": 0, "skipped": 0}
+        texts = [doc.page_content for doc in docs]
+        separator_tokens = self.count_tokens([CONTEXT_SEPARATOR])[0]
+        original = sum(self.count_tokens(texts)) + separator_tokens * max(len(texts) - 1, 0)
+
+        seen_shingles: set = set()
+        seen_sentences: set = set()
+        parts: List[str] = []
+        used = 0
+        for text in texts:
+            shingles = _shingles(text)
+            if (self.duplicate_threshold is not None and shingles and seen_shingles
+                    and len(shingles & seen_shingles) / len(shingles) >= self.duplicate_threshold):
+                stats["duplicates"] += 1
+                continue
+
+            sentences = [m.group() for m in _SENTENCE_RE.finditer(text)]
+            kept = [s for s in sentences if _sentence_key(s) not in seen_sentences]
+            if not kept:
+                stats["duplicates"] += 1
+                continue
+            if len(kept) < len(sentences):
+                stats["trimmed"] += 1
+                text = " ".join(kept)
+
+            cost = self.count_tokens([text])[0] + (separator_tokens if parts else 0)
+            if self.max_tokens is not None and used + cost > self.max_tokens:
+                room = self.max_tokens - used - (separator_tokens if parts else 0)
+                if room < MIN_TRUNCATED_TOKENS:
+                    stats["skipped"] += 1
+                    continue
+                text = self._truncate(text, room)
+                cost = self.count_tokens([text])[0] + (separator_tokens if parts else 0)
+                stats["truncated"] += 1
+
+            parts.append(text)
+            used += cost
+            stats["chunks"] += 1
+            seen_shingles |= shingles
+            seen_sentences.update(_sentence_key(s) for s in kept)
+
+        stats["original_tokens"] = original
+        stats["tokens"] = used
+        stats["tokens_saved"] = original - used
+        return CONTEXT_SEPARATOR.join(parts), stats
+
+    def _truncate(self, text: str, max_tokens: int) -> str:
+        """Longest word-boundary prefix of a text within max_tokens"""
+        ends = [m.end() for m in re.finditer(r"\S+", text)]
+        low, high = 0, len(ends)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.count_tokens([text[:ends[middle - 1]]])[0] <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        return text[:ends[low - 1]] if low else ""
@@ -0,0 +1,171 @@
+# embedding_cache.py
+"""
+Persistent, content-addressed cache of text embeddings
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Dict, List, Optional
+import numpy as np
+
+DEFAULT_CACHE_PATH = os.environ.get(
+    "FLOWQUERY_EMBEDDING_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "flowquery", "embeddings.sqlite"),
+)
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+# SQLite limits the number of bound parameters per statement
+_QUERY_CHUNK = 500
+
+
+def text_key(text: str) -> str:
+    """Hash of a text after Unicode and whitespace normalization"""
+    normalized = " ".join(unicodedata.normalize("NFC", text).split())
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    SQLite-backed store of float32 embeddings keyed by (model name, text hash)
+
+    When the stored vectors exceed max_bytes, the least recently used entries
+    are evicted until the cache is back under 90% of the limit.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_bytes: int = DEFAULT_MAX_BYTES):
+        """
+        Open (or create) a cache
+
+        Args:
+            path: SQLite database file
+            max_bytes: Maximum total size of the stored vectors
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL, key TEXT NOT NULL, dim INTEGER NOT NULL,"
+            " vector BLOB NOT NULL, last_used REAL NOT NULL,"
+            " PRIMARY KEY (model, key))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_lru ON embeddings (last_used)")
+        self._conn.commit()
+        self._size = self._conn.execute(
+            "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+
+    def get_many(self, model_name: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """
+        Look up embeddings for texts
+
+        Args:
+            model_name: The embedding model the vectors belong to
+            texts: Texts to look up
+
+        Returns:
+            One float32 vector or None per text, in input order
+        """
+        keys = [text_key(text) for text in texts]
+        found: Dict[str, np.ndarray] = {}
+        with self._lock:
+            for start in range(0, len(keys), _QUERY_CHUNK):
+                chunk = keys[start:start + _QUERY_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE model = ? AND key IN ({placeholders})",
+                    [model_name, *chunk],
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype="float32")
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND key = ?",
+                    [(now, model_name, key) for key in found],
+                )
+                self._conn.commit()
+            results = [found.get(key) for key in keys]
+            hit_count = sum(result is not None for result in results)
+            self.hits += hit_count
+            self.misses += len(results) - hit_count
+        return results
+
+    def put_many(self, model_name: str, texts: List[str], embeddings: np.ndarray) -> None:
+        """
+        Store embeddings for texts
+
+        Args:
+            model_name: The embedding model the vectors belong to
+            texts: Texts that were embedded
+            embeddings: Matrix with one row per text
+        """
+        embeddings = np.asarray(embeddings, dtype="float32")
+        now = time.time()
+        rows = list({key: (model_name, key, vector.shape[0], vector.tobytes(), now)
+                     for key, vector in zip(map(text_key, texts), embeddings)}.values())
+        with self._lock:
+            for start in range(0, len(rows), _QUERY_CHUNK):
+                chunk = [row[1] for row in rows[start:start + _QUERY_CHUNK]]
+                placeholders = ",".join("?" * len(chunk))
+                self._size -= self._conn.execute(
+                    "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+                    f" WHERE model = ? AND key IN ({placeholders})",
+                    [model_name, *chunk],
+                ).fetchone()[0]
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)", rows)
+            self._size += sum(len(row[3]) for row in rows)
+            if self._size > self.max_bytes:
+                self._evict(int(self.max_bytes * 0.9))
+            self._conn.commit()
+
+    def _evict(self, target_bytes: int) -> None:
+        """Delete least recently used entries until the cache fits target_bytes"""
+        while self._size > target_bytes:
+            rows = self._conn.execute(
+                "SELECT model, key, LENGTH(vector) FROM embeddings ORDER BY last_used LIMIT 1000"
+            ).fetchall()
+            if not rows:
+                self._size = 0
+                return
+            evicted = []
+            for model, key, size in rows:
+                evicted.append((model, key))
+                self._size -= size
+                if self._size <= target_bytes:
+                    break
+            self._conn.executemany("DELETE FROM embeddings WHERE model = ? AND key = ?", evicted)
+
+    def stats(self) -> Dict[str, float]:
+        """Return hit/miss counters, hit rate, entry count and stored bytes"""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": entries,
+                "bytes": self._size,
+            }
+
+    def clear(self) -> None:
+        """Remove every cached embedding"""
+        with self._lock:
+            self._conn.execute("DELETE FROM embeddings")
+            self._conn.commit()
+            self._size = 0
+
+    def close(self) -> None:
+        """Close the underlying database connection"""
+        with self._lock:
+            self._conn.close()
@@ -2,42 +2,343 @@
 """
 Centralized utilities for embedding operations
 """
-from typing import List, Optional
-from langchain_community.embeddings import SentenceTransformerEmbeddings
-from langchain_huggingface import HuggingFaceEmbeddings
+import os
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+from metrics import span, record_batch_size, record_cache
 
+DEFAULT_MODEL_NAME = "all-MiniLM-L6-v2"
 
-def get_embedding_model(model_name: str = "all-MiniLM-L6-v2"):
+# Models are kept in memory until their combined size exceeds this budget
+DEFAULT_MEMORY_BUDGET_MB = float(os.environ.get("FLOWQUERY_MODEL_MEMORY_MB", "2048"))
+
+# How models run: PyTorch, or an ONNX export on ONNX Runtime (optionally int8)
+EMBEDDING_BACKENDS = ("torch", "onnx", "onnx-int8")
+DEFAULT_BACKEND = os.environ.get("FLOWQUERY_EMBEDDING_BACKEND", "torch")
+
+
+def _estimate_model_bytes(model) -> int:
+    """Approximate resident size of a torch module from its parameters and buffers"""
+    if hasattr(model, "model_bytes"):
+        return model.model_bytes
+    try:
+        size = sum(p.numel() * p.element_size() for p in model.parameters())
+        size += sum(b.numel() * b.element_size() for b in model.buffers())
+        return size
+    except Exception:
+        return 0
+
+
+class EmbeddingModelRegistry:
+    """
+    Process-wide cache of loaded SentenceTransformer models
+
+    Models are keyed by (model name, device, normalization, backend) and
+    evicted in least-recently-used order once the memory budget is exceeded.
+    The most recently requested model is never evicted, even if it alone
+    exceeds the budget. Models are loaded with the registry's backend
+    unless a call names another one; each model records the backend it
+    runs on in its embedding_backend attribute.
+    """
+
+    def __init__(self, memory_budget_mb: float = DEFAULT_MEMORY_BUDGET_MB,
+                 backend: str = DEFAULT_BACKEND):
+        """
+        Initialize the registry
+
+        Args:
+            memory_budget_mb: Maximum combined size of cached models in megabytes
+            backend: Default backend, one of EMBEDDING_BACKENDS
+        """
+        self.memory_budget_bytes = int(memory_budget_mb * 1024 * 1024)
+        self.backend = backend
+        self._models: "OrderedDict[Tuple[str, Optional[str], bool, str], Tuple[object, int]]" = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, model_name: str = DEFAULT_MODEL_NAME,
+            device: Optional[str] = None,
+            normalize: bool = False,
+            backend: Optional[str] = None):
+        """
+        Return a cached model, loading it on first use
+
+        Args:
+            model_name: The name of the SentenceTransformer model
+            device: Torch device to load the model on (None lets the library choose)
+            normalize: Whether embeddings from this entry are L2-normalized
+            backend: One of EMBEDDING_BACKENDS (defaults to the registry's backend)
+
+        Returns:
+            A SentenceTransformer, or an OnnxEncoder with the same encode interface
+        """
+        backend = backend or self.backend
+        key = (model_name, device, normalize, backend)
+        with self._lock:
+            entry = self._models.get(key)
+            if entry is not None:
+                self._models.move_to_end(key)
+                return entry[0]
+
+            with span("load_model", model=model_name, backend=backend):
+                model = self._load(model_name, device, backend)
+            model.embedding_backend = backend
+            self._models[key] = (model, _estimate_model_bytes(model))
+            self._evict()
+            return model
+
+    @staticmethod
+    def _load(model_name: str, device: Optional[str], backend: str):
+        if backend not in EMBEDDING_BACKENDS:
+            raise ValueError(f"Unknown embedding backend '{backend}', "
+                             f"expected one of {EMBEDDING_BACKENDS}")
+        if backend != "torch":
+            # No silent fallback: vectors of another backend would be mixed
+            # into the index and the embedding cache under this backend's name
+            try:
+                from onnx_backend import load_onnx_encoder
+                return load_onnx_encoder(model_name, quantize=backend == "onnx-int8")
+            except Exception as e:
+                raise RuntimeError(f"{backend} backend unavailable for {model_name} ({e}); "
+                                   f"use --backend torch") from e
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(model_name, device=device)
+
+    def set_backend(self, backend: str) -> None:
+        """Change the default backend of models loaded from now on"""
+        if backend not in EMBEDDING_BACKENDS:
+            raise ValueError(f"Unknown embedding backend '{backend}', "
+                             f"expected one of {EMBEDDING_BACKENDS}")
+        with self._lock:
+            self.backend = backend
+
+    def set_memory_budget(self, memory_budget_mb: float) -> None:
+        """Change the memory budget and evict models that no longer fit"""
+        with self._lock:
+            self.memory_budget_bytes = int(memory_budget_mb * 1024 * 1024)
+            self._evict()
+
+    def memory_usage(self) -> int:
+        """Return the estimated size in bytes of all cached models"""
+        with self._lock:
+            return sum(size for _, size in self._models.values())
+
+    def clear(self) -> None:
+        """Drop every cached model"""
+        with self._lock:
+            self._models.clear()
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._models
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._models)
+
+    def _evict(self) -> None:
+        while len(self._models) > 1 and self.memory_usage() > self.memory_budget_bytes:
+            key, _ = self._models.popitem(last=False)
+            print(f"Evicted embedding model {key[0]} from cache")
+
+
+_registry = EmbeddingModelRegistry()
+
+
+def get_model_registry() -> EmbeddingModelRegistry:
+    """Return the process-wide embedding model registry"""
+    return _registry
+
+
+def set_embedding_backend(backend: str) -> None:
+    """Run embedding models of this process on a backend from EMBEDDING_BACKENDS"""
+    _registry.set_backend(backend)
+
+
+def _cache_model_key(model_name: str, model) -> str:
+    """Embedding cache key of a loaded model; approximate backends get their own entries"""
+    backend = getattr(model, "embedding_backend", "torch")
+    return model_name if backend == "torch" else f"{model_name}@{backend}"
+
+
+class RegistryEmbeddings:
+    """
+    LangChain embeddings backed by a model from the shared registry
+
+    LangChain's Embeddings interface is slow to import, so the class is
+    registered as its virtual subclass when the first instance is created
+    rather than inheriting from it at module import.
+    """
+
+    _registered = False
+
+    def __init__(self, model_name: str = DEFAULT_MODEL_NAME,
+                 device: Optional[str] = None,
+                 normalize: bool = False):
+        if not RegistryEmbeddings._registered:
+            from langchain_core.embeddings import Embeddings
+            Embeddings.register(RegistryEmbeddings)
+            RegistryEmbeddings._registered = True
+        self.model_name = model_name
+        self.device = device
+        self.normalize = normalize
+
+    @property
+    def client(self):
+        return _registry.get(self.model_name, self.device, self.normalize)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        embeddings = self.client.encode(texts, normalize_embeddings=self.normalize)
+        return embeddings.tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def get_embedding_model(model_name: str = DEFAULT_MODEL_NAME,
+                        device: Optional[str] = None,
+                        normalize: bool = False):
     """
     Returns a consistent embedding model using LangChain's wrapper
-    
+
     Args:
         model_name: The name of the SentenceTransformer model to use
-        
+        device: Torch device to run the model on
+        normalize: Whether to L2-normalize the embeddings
+
     Returns:
         A LangChain embedding model instance
     """
     try:
-        return SentenceTransformerEmbeddings(model_name=model_name)
+        embeddings = RegistryEmbeddings(model_name, device, normalize)
+        embeddings.client  # load eagerly so errors surface here
+        return embeddings
     except Exception as e:
         print(f"Error loading embedding model: {e}")
         raise
-        
-def encode_query(query: str, model_name: str = "all-MiniLM-L6-v2") -> List[float]:
+
+def encode_query(query: str, model_name: str = DEFAULT_MODEL_NAME,
+                 device: Optional[str] = None,
+                 normalize: bool = False) -> List[float]:
     """
     Encode a query string directly using SentenceTransformer for vector search
-    
+
     Args:
         query: The query string to encode
         model_name: The name of the SentenceTransformer model to use
-        
+        device: Torch device to run the model on
+        normalize: Whether to L2-normalize the embedding
+
     Returns:
         Query embedding as a list of floats
     """
     try:
-        from sentence_transformers import SentenceTransformer
-        model = SentenceTransformer(model_name)
-        return model.encode(query)
+        model = _registry.get(model_name, device, normalize)
+        with span("encode_query"):
+            return model.encode(query, normalize_embeddings=normalize)
     except Exception as e:
         print(f"Error encoding query: {e}")
-        raise
\ No newline at end of file
+        raise
+
+def encode_queries(queries: List[str], model_name: str = DEFAULT_MODEL_NAME,
+                   batch_size: int = 64,
+                   device: Optional[str] = None,
+                   normalize: bool = False):
+    """
+    Encode many query strings in batched forward passes
+
+    Args:
+        queries: The query strings to encode
+        model_name: The name of the SentenceTransformer model to use
+        batch_size: Number of queries per forward pass
+        device: Torch device to run the model on
+        normalize: Whether to L2-normalize the embeddings
+
+    Returns:
+        float32 numpy matrix with one row per query, in input order
+    """
+    try:
+        model = _registry.get(model_name, device, normalize)
+        record_batch_size("encode_queries", len(queries))
+        with span("encode_queries", queries=len(queries)):
+            embeddings = model.encode(queries, batch_size=batch_size,
+                                      normalize_embeddings=normalize,
+                                      convert_to_numpy=True)
+        return embeddings.astype("float32", copy=False)
+    except Exception as e:
+        print(f"Error encoding queries: {e}")
+        raise
+
+def encode_documents(texts: List[str], model_name: str = DEFAULT_MODEL_NAME,
+                     batch_size: int = 64,
+                     cache=None):
+    """
+    Encode document texts, reusing cached embeddings where available
+
+    Args:
+        texts: The texts to encode
+        model_name: The name of the SentenceTransformer model to use
+        batch_size: Number of texts per forward pass
+        cache: Optional EmbeddingCache consulted before running the model
+
+    Returns:
+        float32 numpy matrix with one row per text, in input order
+    """
+    import numpy as np
+
+    if cache is None:
+        model = _registry.get(model_name)
+        record_batch_size("encode_documents", len(texts))
+        with span("encode_documents", texts=len(texts)):
+            return model.encode(texts, batch_size=batch_size,
+                                convert_to_numpy=True).astype("float32", copy=False)
+
+    # The key names the backend the model actually runs on
+    model = _registry.get(model_name)
+    cache_key = _cache_model_key(model_name, model)
+    cached = cache.get_many(cache_key, texts)
+    missing = [i for i, vector in enumerate(cached) if vector is None]
+    record_cache("embedding", "hit", len(texts) - len(missing))
+    record_cache("embedding", "miss", len(missing))
+    if missing:
+        record_batch_size("encode_documents", len(missing))
+        with span("encode_documents", texts=len(missing)):
+            computed = model.encode([texts[i] for i in missing], batch_size=batch_size,
+                                    convert_to_numpy=True).astype("float32", copy=False)
+        cache.put_many(cache_key, [texts[i] for i in missing], computed)
+        for i, vector in zip(missing, computed):
+            cached[i] = vector
+    return np.vstack(cached)
+
+def get_tokenizer(model_name: str = DEFAULT_MODEL_NAME):
+    """
+    Return the tokenizer of a registry model, for token-aware chunking
+
+    Args:
+        model_name: The name of the SentenceTransformer model
+
+    Returns:
+        The model's Hugging Face tokenizer, or None if it has none
+    """
+    return getattr(_registry.get(model_name), "tokenizer", None)
+
+def warmup_embedding_model(model_name: str = DEFAULT_MODEL_NAME,
+                           device: Optional[str] = None,
+                           normalize: bool = False) -> bool:
+    """
+    Load a model into the registry and run one forward pass
+
+    Args:
+        model_name: The name of the SentenceTransformer model to use
+        device: Torch device to run the model on
+        normalize: Whether to L2-normalize the embeddings
+
+    Returns:
+        True if the model is ready, False otherwise
+    """
+    try:
+        encode_query("warmup", model_name, device, normalize)
+        return True
+    except Exception as e:
+        print(f"Error warming up embedding model {model_name}: {e}")
+        return False
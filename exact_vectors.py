@@ -0,0 +1,160 @@
+# exact_vectors.py
+"""
+Full-precision vectors stored next to a compact FAISS index, for rescoring
+"""
+import os
+from typing import Callable, List, Optional, Sequence, Set, Tuple
+import numpy as np
+
+VECTORS_DIR = "vectors"
+_IDS_FILE = "ids.npy"
+_VECTORS_FILE = "vectors.npy"
+
+# Vectors gathered and written per step, bounding memory while saving
+_WRITE_BLOCK_SIZE = 65536
+
+
+class ExactVectors:
+    """
+    float32 vectors keyed by chunk ID, read through memory maps
+
+    Compact indexes (float16, int8 or binary codes) only give approximate
+    distances; their candidates are rescored against these vectors. On
+    disk, ids.npy holds the sorted chunk IDs and vectors.npy one row per
+    ID. Both are mapped on first access, so rescoring touches only the rows
+    of the candidates and the vectors stay out of resident memory. Vectors
+    added or removed since the store was written (or of an index that was
+    never saved) are kept in memory until the index is saved again.
+    """
+
+    def __init__(self, index_name: Optional[str] = None):
+        """
+        Open the vectors of an index folder (nothing is read until first use)
+
+        Args:
+            index_name: Path to the index folder, or None for a new index
+        """
+        self.path = os.path.join(index_name, VECTORS_DIR) if index_name else None
+        self._ids: Optional[np.ndarray] = None
+        self._vectors: Optional[np.ndarray] = None
+        self._added_ids: List[np.ndarray] = []
+        self._added_vectors: List[np.ndarray] = []
+        self._added: Optional[Tuple[np.ndarray, np.ndarray]] = None
+        self._removed: Set[int] = set()
+
+    @staticmethod
+    def exists(index_name: str) -> bool:
+        """Whether an index folder has full-precision vectors"""
+        return os.path.exists(os.path.join(index_name, VECTORS_DIR, _VECTORS_FILE))
+
+    @staticmethod
+    def write(index_name: str, ids: Sequence[int],
+              vectors_of: Callable[[np.ndarray], np.ndarray]) -> None:
+        """
+        Write the vectors of the given chunk IDs, replacing any existing store
+
+        Files are written next to their predecessors and renamed over them,
+        so processes (and the vectors_of source) still mapping the old files
+        keep reading the previous version.
+
+        Args:
+            index_name: Path to the index folder
+            ids: Every chunk ID of the index
+            vectors_of: Returns the float32 vectors of an array of chunk IDs
+        """
+        path = os.path.join(index_name, VECTORS_DIR)
+        os.makedirs(path, exist_ok=True)
+        ids = np.unique(np.asarray(ids, dtype="int64"))
+        first = np.asarray(vectors_of(ids[:_WRITE_BLOCK_SIZE]), dtype="float32")
+        tmp_path = os.path.join(path, _VECTORS_FILE + ".tmp")
+        if not len(ids):
+            with open(tmp_path, "wb") as f:
+                np.save(f, first)
+        else:
+            vectors = np.lib.format.open_memmap(tmp_path, mode="w+", dtype="float32",
+                                                shape=(len(ids), first.shape[1]))
+            vectors[:len(first)] = first
+            for start in range(_WRITE_BLOCK_SIZE, len(ids), _WRITE_BLOCK_SIZE):
+                vectors[start:start + _WRITE_BLOCK_SIZE] = vectors_of(
+                    ids[start:start + _WRITE_BLOCK_SIZE])
+            vectors.flush()
+            del vectors
+        np.save(os.path.join(path, _IDS_FILE + ".tmp.npy"), ids)
+        os.replace(tmp_path, os.path.join(path, _VECTORS_FILE))
+        os.replace(os.path.join(path, _IDS_FILE + ".tmp.npy"), os.path.join(path, _IDS_FILE))
+
+    def _stored(self) -> Tuple[np.ndarray, np.ndarray]:
+        if self._ids is None:
+            if self.path is not None and os.path.exists(os.path.join(self.path, _VECTORS_FILE)):
+                self._ids = np.load(os.path.join(self.path, _IDS_FILE), mmap_mode="r")
+                self._vectors = np.load(os.path.join(self.path, _VECTORS_FILE), mmap_mode="r")
+            else:
+                self._ids = np.empty(0, dtype="int64")
+                self._vectors = np.empty((0, 0), dtype="float32")
+        return self._ids, self._vectors
+
+    def _pending(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Vectors added since the store was written, sorted by ID"""
+        if self._added is None:
+            if self._added_ids:
+                ids = np.concatenate(self._added_ids)
+                vectors = np.vstack(self._added_vectors)
+                order = np.argsort(ids, kind="stable")
+                self._added = (ids[order], vectors[order])
+            else:
+                self._added = (np.empty(0, dtype="int64"), np.empty((0, 0), dtype="float32"))
+            kept = bool(len(self._added[0]))
+            self._added_ids = [self._added[0]] if kept else []
+            self._added_vectors = [self._added[1]] if kept else []
+        return self._added
+
+    def add(self, ids: Sequence[int], vectors: np.ndarray) -> None:
+        """Register the vectors of newly added chunk IDs"""
+        ids = np.asarray(ids, dtype="int64")
+        self._added_ids.append(ids)
+        self._added_vectors.append(np.asarray(vectors, dtype="float32"))
+        self._added = None
+        self._removed.difference_update(ids.tolist())
+
+    def remove(self, ids: Sequence[int]) -> None:
+        """Forget the vectors of removed chunk IDs"""
+        ids = np.asarray(ids, dtype="int64")
+        added_ids, added_vectors = self._pending()
+        if len(added_ids):
+            keep = ~np.isin(added_ids, ids)
+            self._added_ids, self._added_vectors = [added_ids[keep]], [added_vectors[keep]]
+            self._added = None
+        self._removed.update(ids.tolist())
+
+    def vectors(self, ids: Sequence[int]) -> np.ndarray:
+        """
+        float32 vectors of the given chunk IDs, one row each
+
+        Raises:
+            KeyError: If an ID has no vector
+        """
+        ids = np.asarray(ids, dtype="int64")
+        added_ids, added_vectors = self._pending()
+        stored_ids, stored_vectors = self._stored()
+        dim = added_vectors.shape[1] if len(added_ids) else stored_vectors.shape[1]
+        result = np.empty((len(ids), dim), dtype="float32")
+
+        pending = np.zeros(len(ids), dtype=bool)
+        if len(added_ids):
+            rows = np.searchsorted(added_ids, ids)
+            pending = rows < len(added_ids)
+            pending[pending] = added_ids[rows[pending]] == ids[pending]
+            result[pending] = added_vectors[rows[pending]]
+
+        rest = np.flatnonzero(~pending)
+        if len(rest):
+            rows = np.searchsorted(stored_ids, ids[rest])
+            found = rows < len(stored_ids)
+            found[found] = stored_ids[rows[found]] == ids[rest][found]
+            if self._removed:
+                found &= ~np.isin(ids[rest], list(self._removed))
+            if not found.all():
+                raise KeyError(int(ids[rest][~found][0]))
+            order = np.argsort(rows)
+            result[rest[order]] = stored_vectors[rows[order]]
+        return result
@@ -0,0 +1,196 @@
+# index_factory.py
+"""
+Construction and query-time tuning of FAISS index types
+"""
+from typing import Any, Dict, Optional, Tuple
+import faiss
+import numpy as np
+
+INDEX_TYPES = ("flat", "ivf-flat", "ivf-pq", "hnsw")
+
+# How vectors are stored in the index: full precision, half precision,
+# scalar-quantized bytes, or one sign bit per dimension (flat index only).
+# Compact types keep a full-precision copy on disk to rescore candidates.
+VECTOR_DTYPES = ("float32", "float16", "int8", "binary")
+
+DEFAULT_INDEX_PARAMS: Dict[str, Any] = {
+    "nlist": 1024,            # IVF: number of inverted lists
+    "pq_m": 0,                # IVF-PQ: sub-quantizers (0 picks dim // 8)
+    "pq_bits": 8,             # IVF-PQ: bits per sub-quantizer code
+    "hnsw_m": 32,             # HNSW: graph neighbours per node
+    "ef_construction": 200,   # HNSW: candidate list size while building
+    "nprobe": 16,             # IVF: lists visited per query
+    "ef_search": 64,          # HNSW: candidate list size per query
+    "train_size": 50000,      # vectors sampled to train IVF and int8 quantizers
+    "vector_dtype": "float32", # one of VECTOR_DTYPES
+    "rescore_factor": 0,      # compact vectors: candidates rescored per result (0 calibrates)
+    "min_recall": 0.95,       # compact vectors: recall@k the calibrated factor must reach
+}
+
+# FAISS recommends at least this many training points per IVF centroid
+_POINTS_PER_CENTROID = 39
+
+_SQ_TYPES = {"float16": faiss.ScalarQuantizer.QT_fp16, "int8": faiss.ScalarQuantizer.QT_8bit}
+_IVF_CODES = {"float32": "Flat", "float16": "SQfp16", "int8": "SQ8"}
+
+
+def resolve_index_params(params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Merge user parameters over DEFAULT_INDEX_PARAMS"""
+    resolved = dict(DEFAULT_INDEX_PARAMS)
+    resolved.update({key: value for key, value in (params or {}).items() if value is not None})
+    return resolved
+
+
+def needs_training(index_type: str, params: Optional[Dict[str, Any]] = None) -> bool:
+    """Whether an index type (with the given vector_dtype) must be trained before vectors are added"""
+    return (index_type in ("ivf-flat", "ivf-pq")
+            or (params or {}).get("vector_dtype") in ("int8", "binary"))
+
+
+def training_size(index_type: str, params: Dict[str, Any]) -> int:
+    """Number of vectors to buffer before building an index of this type"""
+    if not needs_training(index_type, params):
+        return 0
+    if index_type not in ("ivf-flat", "ivf-pq"):
+        return params["train_size"]
+    needed = params["nlist"] * _POINTS_PER_CENTROID
+    if index_type == "ivf-pq":
+        needed = max(needed, _POINTS_PER_CENTROID * 2 ** params["pq_bits"])
+    return max(params["train_size"], needed)
+
+
+def _pq_subquantizers(dim: int, requested: int) -> int:
+    """Largest divisor of dim not above the requested (or default) count"""
+    target = requested or max(1, dim // 8)
+    for m in range(min(target, dim), 0, -1):
+        if dim % m == 0:
+            return m
+    return 1
+
+
+def build_index(index_type: str, dim: int, params: Dict[str, Any],
+                train_vectors: Optional[np.ndarray] = None) -> Tuple[faiss.Index, Dict[str, Any]]:
+    """
+    Create an empty, trained FAISS index that accepts add_with_ids
+
+    IVF list counts are reduced when the training sample is too small for the
+    requested nlist, and IVF-PQ falls back to IVF-Flat when there are fewer
+    training vectors than PQ centroids. params["vector_dtype"] selects how
+    vectors are stored: float16 and int8 use FAISS scalar quantizers (2 and 1
+    bytes per dimension instead of 4), binary keeps one sign bit per dimension
+    of a random rotation (IndexLSH, searched by Hamming distance).
+
+    Args:
+        index_type: One of INDEX_TYPES
+        dim: Vector dimension
+        params: Parameters as returned by resolve_index_params
+        train_vectors: Sample used to train IVF and int8 quantizers
+
+    Returns:
+        The index and the parameters actually used (recorded in the manifest)
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type '{index_type}', expected one of {INDEX_TYPES}")
+    vector_dtype = params.get("vector_dtype", "float32")
+    if vector_dtype not in VECTOR_DTYPES:
+        raise ValueError(f"Unknown vector dtype '{vector_dtype}', expected one of {VECTOR_DTYPES}")
+    if vector_dtype == "binary" and index_type != "flat":
+        raise ValueError("Binary vectors are only supported by the flat index type")
+    if vector_dtype != "float32" and index_type == "ivf-pq":
+        raise ValueError("IVF-PQ already compresses vectors; use it with float32")
+    config: Dict[str, Any] = {"index_type": index_type, "dim": dim}
+    if vector_dtype != "float32":
+        config.update(vector_dtype=vector_dtype, rescore_factor=params["rescore_factor"],
+                      min_recall=params["min_recall"])
+
+    if index_type == "flat":
+        if vector_dtype == "float32":
+            return faiss.IndexIDMap2(faiss.IndexFlatL2(dim)), config
+        if vector_dtype == "binary":
+            index = faiss.IndexLSH(dim, dim, True, True)
+            index.train(np.ascontiguousarray(train_vectors, dtype="float32"))
+            return faiss.IndexIDMap2(index), config
+        index = faiss.IndexScalarQuantizer(dim, _SQ_TYPES[vector_dtype])
+        if not index.is_trained:
+            index.train(np.ascontiguousarray(train_vectors, dtype="float32"))
+        return faiss.IndexIDMap2(index), config
+
+    if index_type == "hnsw":
+        if vector_dtype == "float32":
+            hnsw = faiss.IndexHNSWFlat(dim, params["hnsw_m"])
+        else:
+            hnsw = faiss.IndexHNSWSQ(dim, _SQ_TYPES[vector_dtype], params["hnsw_m"])
+            if not hnsw.is_trained:
+                hnsw.train(np.ascontiguousarray(train_vectors, dtype="float32"))
+        hnsw.hnsw.efConstruction = params["ef_construction"]
+        hnsw.hnsw.efSearch = params["ef_search"]
+        config.update(hnsw_m=params["hnsw_m"], ef_construction=params["ef_construction"],
+                      ef_search=params["ef_search"])
+        return faiss.IndexIDMap2(hnsw), config
+
+    train_vectors = np.ascontiguousarray(train_vectors, dtype="float32")
+    n_train = len(train_vectors)
+    # Each PQ codebook has 2 ** pq_bits centroids and needs as many points per
+    # centroid as the coarse quantizer; fewer gives poor codes and low recall
+    if index_type == "ivf-pq" and n_train < _POINTS_PER_CENTROID * 2 ** params["pq_bits"]:
+        print(f"Only {n_train} vectors available to train IVF-PQ; using IVF-Flat instead")
+        return build_index("ivf-flat", dim, params, train_vectors)
+
+    nlist = max(1, min(params["nlist"], n_train // _POINTS_PER_CENTROID))
+    if index_type == "ivf-flat":
+        factory = f"IVF{nlist},{_IVF_CODES[vector_dtype]}"
+    else:
+        pq_m = _pq_subquantizers(dim, params["pq_m"])
+        factory = f"IVF{nlist},PQ{pq_m}x{params['pq_bits']}"
+        config.update(pq_m=pq_m, pq_bits=params["pq_bits"])
+    index = faiss.index_factory(dim, factory)
+    index.train(train_vectors)
+    faiss.extract_index_ivf(index).nprobe = min(params["nprobe"], nlist)
+    config.update(factory=factory, nlist=nlist, nprobe=min(params["nprobe"], nlist),
+                  trained_on=n_train)
+    return index, config
+
+
+def _hnsw_of(index: faiss.Index) -> Optional[faiss.IndexHNSW]:
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        index = faiss.downcast_index(index.index)
+    return index if isinstance(index, faiss.IndexHNSW) else None
+
+
+def search_parameters(index: faiss.Index, nprobe: Optional[int] = None,
+                      ef_search: Optional[int] = None,
+                      selector: Optional[faiss.IDSelector] = None) -> Optional[faiss.SearchParameters]:
+    """
+    Per-query search parameters overriding the values stored in the index
+
+    Args:
+        index: The index to be searched
+        nprobe: IVF lists to visit (ignored for non-IVF indexes)
+        ef_search: HNSW candidate list size (ignored for non-HNSW indexes)
+        selector: Restricts the search to the selected IDs
+
+    Returns:
+        SearchParameters to pass to index.search, or None to use the defaults
+    """
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and (nprobe or selector is not None):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=nprobe or ivf.nprobe)
+    hnsw = _hnsw_of(index)
+    if hnsw is not None and (ef_search or selector is not None):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=ef_search or hnsw.hnsw.efSearch)
+    if selector is not None:
+        return faiss.SearchParameters(sel=selector)
+    return None
+
+
+def reconstruct(index: faiss.Index, ids: np.ndarray) -> np.ndarray:
+    """
+    Stored vectors of the given IDs (approximate for PQ and compact indexes)
+
+    IVF indexes get a hash-table direct map on first use so that arbitrary
+    IDs can be looked up.
+    """
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+        ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+    return index.reconstruct_batch(np.ascontiguousarray(ids, dtype="int64"))
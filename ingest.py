@@ -2,15 +2,23 @@
 """
 Document ingestion and processing
 """
+import glob
 import json
 import os
-from typing import List
-from langchain.schema import Document
-from vectorstore_utils import create_vectorstore
-
-# Additional imports for new file types
-from docx import Document as DocxDocument
-import PyPDF2
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+from importlib import import_module
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+from langchain_core.documents import Document
+from vectorstore_utils import create_vectorstore, INDEX_MODES
+from sharded_index import create_sharded_index, is_sharded, unshard, SHARD_STRATEGIES
+from index_factory import INDEX_TYPES, VECTOR_DTYPES
+from chunk_store import CHUNK_COMPRESSIONS
+from embedding_utils import (get_tokenizer, set_embedding_backend, EMBEDDING_BACKENDS,
+                             DEFAULT_BACKEND)
+from text_splitter import TextSplitter
+from embedding_cache import EmbeddingCache, DEFAULT_CACHE_PATH
+from metrics import span, enable_metrics, write_prometheus
 
 def load_chunks_from_json(file_path: str) -> List[Document]:
     try:
@@ -33,6 +41,66 @@ def load_chunks_from_json(file_path: str) -> List[Document]:
         print(f"Error loading chunks from {file_path}: {e}")
         return []
 
+def iter_json_chunks(file_path: str) -> Iterator[Document]:
+    """Yield the chunks of a JSON list file, raising on invalid content"""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if not isinstance(data, list):
+        raise ValueError(f"Expected JSON list in {file_path}")
+    for chunk in data:
+        yield Document(page_content=chunk.get("page_content", ""),
+                       metadata=chunk.get("metadata", {}))
+
+def iter_txt_paragraphs(file_path: str) -> Iterator[Document]:
+    """Yield blank-line separated paragraphs from a text file without reading it whole"""
+    def make(lines, start, index):
+        text = "".join(lines)
+        return Document(page_content=text.strip(),
+                        metadata={"source": file_path, "paragraph": index,
+                                  "start_index": start + len(text) - len(text.lstrip())})
+
+    paragraph = []
+    index = 0
+    offset = start = 0
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                if not paragraph:
+                    start = offset
+                paragraph.append(line)
+            elif paragraph:
+                yield make(paragraph, start, index)
+                paragraph = []
+                index += 1
+            offset += len(line)
+    if paragraph:
+        yield make(paragraph, start, index)
+
+def iter_docx_paragraphs(file_path: str) -> Iterator[Document]:
+    """Yield non-empty paragraphs from a DOCX file"""
+    from docx import Document as DocxDocument
+
+    doc = DocxDocument(file_path)
+    offset = 0
+    for index, para in enumerate(doc.paragraphs):
+        if para.text.strip():
+            yield Document(page_content=para.text,
+                           metadata={"source": file_path, "paragraph": index,
+                                     "start_index": offset})
+        offset += len(para.text) + 1
+
+def iter_pdf_pages(file_path: str) -> Iterator[Document]:
+    """Yield one document per PDF page"""
+    import PyPDF2
+
+    with open(file_path, 'rb') as f:
+        reader = PyPDF2.PdfReader(f)
+        for number, page in enumerate(reader.pages, start=1):
+            text = page.extract_text() or ""
+            if text.strip():
+                yield Document(page_content=text,
+                               metadata={"source": file_path, "page": number})
+
 def load_chunks_from_txt(file_path: str) -> List[Document]:
     try:
         with open(file_path, 'r', encoding='utf-8') as f:
@@ -44,8 +112,7 @@ def load_chunks_from_txt(file_path: str) -> List[Document]:
 
 def load_chunks_from_docx(file_path: str) -> List[Document]:
     try:
-        doc = DocxDocument(file_path)
-        text = "\n".join([para.text for para in doc.paragraphs])
+        text = "\n".join(doc.page_content for doc in iter_docx_paragraphs(file_path))
         return [Document(page_content=text, metadata={"source": file_path})]
     except Exception as e:
         print(f"Error reading DOCX file {file_path}: {e}")
@@ -53,11 +120,7 @@ def load_chunks_from_docx(file_path: str) -> List[Document]:
 
 def load_chunks_from_pdf(file_path: str) -> List[Document]:
     try:
-        text = ""
-        with open(file_path, 'rb') as f:
-            reader = PyPDF2.PdfReader(f)
-            for page in reader.pages:
-                text += page.extract_text() + "\n"
+        text = "".join(doc.page_content + "\n" for doc in iter_pdf_pages(file_path))
         return [Document(page_content=text, metadata={"source": file_path})]
     except Exception as e:
         print(f"Error reading PDF file {file_path}: {e}")
@@ -77,19 +140,240 @@ def load_chunks_from_file(file_path: str) -> List[Document]:
         print(f"Unsupported file extension: {ext}")
         return []
 
-def process_documents(input_file: str,
-                      index_name: str = "faiss_index",
-                      model_name: str = "all-MiniLM-L6-v2") -> bool:
+# Streaming parser of each supported file extension: a function, or the
+# "module:function" name of one, imported when such a file is first read
+DOCUMENT_ITERATORS: Dict[str, Union[str, Callable[[str], Iterator[Document]]]] = {
+    ".json": iter_json_chunks,
+    ".txt": iter_txt_paragraphs,
+    ".docx": iter_docx_paragraphs,
+    ".pdf": iter_pdf_pages,
+}
+
+def register_document_iterator(extension: str,
+                               iterator: Union[str, Callable[[str], Iterator[Document]]]) -> None:
+    """
+    Add or replace the parser of a file extension
+
+    Args:
+        extension: File extension including the dot, e.g. ".md"
+        iterator: Function yielding the documents of a file path, or its
+            "module:function" name so the module is only imported when a
+            file of this type is ingested
+    """
+    DOCUMENT_ITERATORS[extension.lower()] = iterator
+
+def _document_iterator(ext: str) -> Callable[[str], Iterator[Document]]:
+    """Parser of an extension, importing it on first use"""
+    iterator = DOCUMENT_ITERATORS[ext]
+    if isinstance(iterator, str):
+        module, _, name = iterator.partition(":")
+        iterator = DOCUMENT_ITERATORS[ext] = getattr(import_module(module), name)
+    return iterator
+
+def iter_documents_from_file(file_path: str) -> Iterator[Document]:
+    """
+    Stream documents from a file page by page or paragraph by paragraph
+
+    JSON input is parsed in one go because it is already a list of chunks.
+    Read errors are reported and end the stream instead of raising.
+    """
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext not in DOCUMENT_ITERATORS:
+        print(f"Unsupported file extension: {ext}")
+        return
+    if not os.path.exists(file_path):
+        print(f"File not found: {file_path}")
+        return
     try:
-        chunks = load_chunks_from_file(input_file)
-        if not chunks:
-            print("No document chunks loaded. Check your input file.")
-            return False
+        yield from _document_iterator(ext)(file_path)
+    except Exception as e:
+        print(f"Error reading {file_path}: {e}")
+
+def expand_inputs(inputs: Union[str, Sequence[str]]) -> List[str]:
+    """
+    Resolve input files, directories and glob patterns to a list of files
 
-        print(f"Loaded {len(chunks)} document chunks")
+    Directories are searched recursively and glob patterns may use ** ; both
+    only contribute files with a supported extension. Plain paths are kept
+    as given so that missing or unsupported files are reported as failures.
 
-        vectorstore = create_vectorstore(chunks, index_name, model_name)
-        print(f"Successfully created vector index with {len(chunks)} documents")
+    Args:
+        inputs: One input or a list of them
+
+    Returns:
+        Unique file paths in a stable (sorted per input) order
+    """
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, dirs, files in os.walk(item):
+                dirs.sort()
+                paths.extend(os.path.join(root, name) for name in sorted(files)
+                             if os.path.splitext(name)[1].lower() in DOCUMENT_ITERATORS)
+        elif any(char in item for char in "*?["):
+            paths.extend(path for path in sorted(glob.glob(item, recursive=True))
+                         if os.path.isfile(path)
+                         and os.path.splitext(path)[1].lower() in DOCUMENT_ITERATORS)
+        else:
+            paths.append(item)
+    return list(dict.fromkeys(paths))
+
+def parse_file(file_path: str) -> Tuple[str, List[Document], Optional[str]]:
+    """
+    Parse a whole file in one call, as done by the parser worker processes
+
+    Returns:
+        (file path, non-empty documents, error message or None)
+    """
+    try:
+        ext = os.path.splitext(file_path)[1].lower()
+        if ext not in DOCUMENT_ITERATORS:
+            raise ValueError(f"Unsupported file extension: {ext}")
+        docs = [doc for doc in _document_iterator(ext)(file_path) if doc.page_content.strip()]
+        return file_path, docs, None
+    except Exception as e:
+        return file_path, [], f"{type(e).__name__}: {e}"
+
+def iter_documents_parallel(paths: Sequence[str], workers: int = 0,
+                            failures: Optional[List[Tuple[str, str]]] = None) -> Iterator[Document]:
+    """
+    Parse files in a process pool and stream their documents as files complete
+
+    Each file's documents are yielded together, in completion order across
+    files. At most a few files per worker are in flight, so memory stays
+    bounded for any number of inputs. A file that fails to parse is
+    reported and skipped; the others continue.
+
+    Args:
+        paths: Files to parse
+        workers: Parser processes (0 uses one per CPU core; 1 parses in this
+            process without a pool)
+        failures: Optional list that receives (path, error) for failed files
+
+    Returns:
+        Iterator over the documents of every file that parsed
+    """
+    workers = min(workers or os.cpu_count() or 1, max(len(paths), 1))
+
+    def report(path: str, error: str) -> None:
+        print(f"Failed to parse {path}: {error}")
+        if failures is not None:
+            failures.append((path, error))
+
+    if workers == 1:
+        for path in paths:
+            _, docs, error = parse_file(path)
+            if error:
+                report(path, error)
+            yield from docs
+        return
+
+    remaining = iter(paths)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(parse_file, path) for path in islice(remaining, workers * 4)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, docs, error = future.result()
+                for next_path in islice(remaining, 1):
+                    pending.add(pool.submit(parse_file, next_path))
+                if error:
+                    report(path, error)
+                yield from docs
+
+def process_documents(input_file: Union[str, Sequence[str]],
+                      index_name: str = "faiss_index",
+                      model_name: str = "all-MiniLM-L6-v2",
+                      batch_size: int = 256,
+                      chunk_size: int = 200,
+                      chunk_overlap: int = 40,
+                      mode: str = "rebuild",
+                      source: Optional[str] = None,
+                      cache_path: Optional[str] = DEFAULT_CACHE_PATH,
+                      index_type: str = "flat",
+                      index_params: Optional[Dict] = None,
+                      workers: int = 0,
+                      chunk_compression: Optional[str] = None,
+                      shards: int = 1,
+                      shard_by: str = "hash") -> bool:
+    """
+    Load, chunk and index document files
+
+    A single file is streamed in this process. Several files (directories,
+    globs or lists) are parsed by a pool of worker processes, and their
+    documents are embedded as soon as each file is parsed; files that fail
+    to parse are listed at the end without aborting the run.
+
+    Args:
+        input_file: File, directory or glob pattern to ingest (JSON, PDF,
+            DOCX, TXT), or a list of them
+        index_name: Folder of the FAISS index
+        model_name: SentenceTransformer model to use
+        batch_size: Number of chunks embedded and indexed per batch
+        chunk_size: Maximum tokens per chunk (0 disables splitting)
+        chunk_overlap: Tokens shared between consecutive chunks
+        mode: How to treat an existing index: rebuild, append or upsert
+        source: Name recorded as the chunks' source instead of the file path
+            (e.g. the original name of an uploaded temporary file)
+        cache_path: SQLite embedding cache to reuse vectors from (None disables it)
+        index_type: FAISS index type for a new index (flat, ivf-flat, ivf-pq, hnsw)
+        index_params: Overrides for index_factory.DEFAULT_INDEX_PARAMS
+        workers: Parser processes for multi-file input (0 uses one per CPU core)
+        chunk_compression: How chunk texts are stored (none or zstd); defaults
+            to the index's current setting
+        shards: Number of shards of a rebuilt index (1 for an unsharded
+            index); updates of a sharded index keep its shards
+        shard_by: How chunks are assigned to shards: hash or source
+
+    Returns:
+        True if the index was written successfully, False otherwise
+    """
+    paths = expand_inputs(input_file)
+    failures: List[Tuple[str, str]] = []
+
+    def relabel(doc: Document) -> Document:
+        if source and doc.metadata.get("source", paths[0]) == paths[0]:
+            doc.metadata["source"] = source
+        return doc
+
+    try:
+        with span("ingest", index=index_name, mode=mode, files=len(paths)) as current:
+            if not paths:
+                raise ValueError(f"No supported files found in {input_file}")
+            if len(paths) == 1:
+                documents = iter_documents_from_file(paths[0])
+            else:
+                documents = iter_documents_parallel(paths, workers, failures)
+            chunks = (relabel(doc) for doc in documents if doc.page_content.strip())
+            if chunk_size > 0:
+                splitter = TextSplitter(chunk_size, chunk_overlap, get_tokenizer(model_name))
+                chunks = splitter.split_documents(chunks)
+            sharded = shards > 1 or (mode != "rebuild" and is_sharded(index_name))
+            if not sharded and mode == "rebuild" and is_sharded(index_name):
+                unshard(index_name)
+            cache = EmbeddingCache(cache_path) if cache_path else None
+            try:
+                if sharded:
+                    count = create_sharded_index(chunks, index_name, model_name, shards, shard_by,
+                                                 batch_size, mode, cache, index_type,
+                                                 index_params, chunk_compression)
+                else:
+                    count = create_vectorstore(chunks, index_name, model_name, batch_size,
+                                               mode=mode, embedding_cache=cache,
+                                               index_type=index_type,
+                                               index_params=index_params,
+                                               chunk_compression=chunk_compression).index.ntotal
+            finally:
+                if cache is not None:
+                    cache.close()
+            current.set(chunks=count, failed_files=len(failures))
+        if len(paths) > 1:
+            print(f"Parsed {len(paths) - len(failures)} of {len(paths)} files")
+            for path, error in failures:
+                print(f"  failed: {path}: {error}")
+        print(f"Vector index now holds {count} documents")
         print(f"Index saved to '{index_name}' folder")
 
         return True
@@ -102,16 +386,91 @@ if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description="Process documents into vector embeddings")
-    parser.add_argument("--input", "-i", required=True,
-                        help="Input file (JSON, PDF, DOCX, TXT)")
+    parser.add_argument("--input", "-i", required=True, nargs="+",
+                        help="Input files, directories or glob patterns (JSON, PDF, DOCX, TXT)")
     parser.add_argument("--output", "-o", default="faiss_index",
                         help="Output folder for the FAISS index")
     parser.add_argument("--model", "-m", default="all-MiniLM-L6-v2",
                         help="SentenceTransformer model to use")
+    parser.add_argument("--backend", choices=EMBEDDING_BACKENDS, default=DEFAULT_BACKEND,
+                        help="Run the embedding model on PyTorch, or exported to ONNX "
+                             "(onnx-int8 also quantizes its weights)")
+    parser.add_argument("--batch-size", "-b", type=int, default=256,
+                        help="Number of chunks embedded and indexed per batch")
+    parser.add_argument("--chunk-size", type=int, default=200,
+                        help="Maximum tokens per chunk (0 disables splitting)")
+    parser.add_argument("--chunk-overlap", type=int, default=40,
+                        help="Tokens shared between consecutive chunks")
+    parser.add_argument("--mode", choices=INDEX_MODES, default="rebuild",
+                        help="rebuild the index, append new chunks, or upsert "
+                             "(append and drop stale chunks of ingested sources)")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_PATH,
+                        help="SQLite file used to cache embeddings between runs")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always re-embed every chunk")
+    parser.add_argument("--index-type", choices=INDEX_TYPES, default="flat",
+                        help="FAISS index type used when building a new index")
+    parser.add_argument("--nlist", type=int,
+                        help="IVF: number of inverted lists")
+    parser.add_argument("--pq-m", type=int,
+                        help="IVF-PQ: number of sub-quantizers (must divide the dimension)")
+    parser.add_argument("--hnsw-m", type=int,
+                        help="HNSW: neighbours per graph node")
+    parser.add_argument("--nprobe", type=int,
+                        help="IVF: default lists visited per query")
+    parser.add_argument("--ef-search", type=int,
+                        help="HNSW: default search depth per query")
+    parser.add_argument("--train-size", type=int,
+                        help="IVF and int8: number of vectors used for training")
+    parser.add_argument("--vector-dtype", choices=VECTOR_DTYPES,
+                        help="Store vectors as float32 (default), float16, int8 or binary "
+                             "codes; compact types are rescored against full-precision "
+                             "vectors kept on disk")
+    parser.add_argument("--rescore-factor", type=int,
+                        help="Compact vectors: candidates rescored per result "
+                             "(calibrated to --min-recall when omitted)")
+    parser.add_argument("--min-recall", type=float,
+                        help="Compact vectors: recall@10 the calibrated rescore factor must reach "
+                             "(default 0.95)")
+    parser.add_argument("--workers", "-w", type=int, default=0,
+                        help="Parser processes for multi-file input (0 = one per CPU core)")
+    parser.add_argument("--chunk-compression", choices=CHUNK_COMPRESSIONS,
+                        help="Store chunk texts raw or zstd-compressed "
+                             "(defaults to the index's current setting, else none)")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="Partition a rebuilt index into this many shards, searched in "
+                             "parallel (updates keep the index's shards)")
+    parser.add_argument("--shard-by", choices=SHARD_STRATEGIES, default="hash",
+                        help="Assign chunks to shards by hash (even spread) or by source "
+                             "(all chunks of a file in one shard)")
+    parser.add_argument("--metrics-file",
+                        help="Write stage latencies, batch sizes and index size to this file "
+                             "in the Prometheus text format")
+    parser.add_argument("--log-json",
+                        help="Append one JSON line per pipeline stage to this file (- for stderr)")
 
     args = parser.parse_args()
+    set_embedding_backend(args.backend)
+    if args.metrics_file or args.log_json:
+        enable_metrics(args.log_json)
 
-    if process_documents(args.input, args.output, args.model):
+    succeeded = process_documents(args.input, args.output, args.model, args.batch_size,
+                                  args.chunk_size, args.chunk_overlap, args.mode,
+                                  cache_path=None if args.no_cache else args.cache,
+                                  index_type=args.index_type,
+                                  index_params={"nlist": args.nlist, "pq_m": args.pq_m,
+                                                "hnsw_m": args.hnsw_m, "nprobe": args.nprobe,
+                                                "ef_search": args.ef_search,
+                                                "train_size": args.train_size,
+                                                "vector_dtype": args.vector_dtype,
+                                                "rescore_factor": args.rescore_factor,
+                                                "min_recall": args.min_recall},
+                                  workers=args.workers,
+                                  chunk_compression=args.chunk_compression,
+                                  shards=args.shards, shard_by=args.shard_by)
+    if args.metrics_file:
+        write_prometheus(args.metrics_file)
+    if succeeded:
         print("Processing completed successfully")
     else:
         print("Processing failed")
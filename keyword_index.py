@@ -0,0 +1,260 @@
+# keyword_index.py
+"""
+BM25 keyword index stored as memory-mapped postings arrays next to a FAISS index
+"""
+import hashlib
+import json
+import math
+import os
+import re
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+
+KEYWORD_DIR = "keywords"
+_STATS_FILE = "stats.json"
+_ARRAYS = ("ids", "lengths", "terms", "offsets", "rows", "tf", "weights")
+
+# BM25 term-frequency saturation and length normalization
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Postings read per query term. Lists are stored highest weight first, so for
+# terms in more chunks than this only the strongest matches are scored; rare
+# terms such as identifiers are always scored exhaustively.
+MAX_POSTINGS_PER_TERM = 4096
+
+# Words, plus identifiers such as ERR-1042, v2.3.1 or AB_77/X as a single term
+_TOKEN_RE = re.compile(r"\w+(?:[-./:]\w+)*")
+_PART_RE = re.compile(r"[^\W_]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lower-cased index terms of a text
+
+    Compound identifiers are kept whole and also split into their parts, so
+    "ERR-1042" matches both the exact code and the words "err" and "1042".
+    """
+    terms = []
+    for match in _TOKEN_RE.finditer(text.lower()):
+        token = match.group()
+        terms.append(token)
+        parts = _PART_RE.findall(token)
+        if len(parts) > 1 or (parts and parts[0] != token):
+            terms.extend(parts)
+    return terms
+
+
+def term_hash(term: str) -> int:
+    """Signed 64-bit hash of a term, used as its key in the postings arrays"""
+    digest = hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+class KeywordIndex:
+    """
+    BM25 inverted index over the chunks of a FAISS index
+
+    On disk, ids.npy holds the sorted chunk IDs (one row each) and
+    lengths.npy their token counts. Terms are stored as sorted 64-bit hashes
+    (terms.npy) with offsets into three postings arrays: the row of each
+    posting (int32), its term frequency (uint16) and its precomputed BM25
+    term weight (float16). Each term's postings are ordered by decreasing
+    weight, and a query reads at most MAX_POSTINGS_PER_TERM of them per term
+    from the memory-mapped arrays, which bounds its cost on large corpora.
+    """
+
+    def __init__(self, index_name: str):
+        """
+        Open the keyword index of an index folder (nothing is read until first use)
+
+        Args:
+            index_name: Path to the index folder
+        """
+        self.path = os.path.join(index_name, KEYWORD_DIR)
+        self._arrays: Dict[str, np.ndarray] = {}
+        self._stats: Optional[Dict[str, float]] = None
+
+    @staticmethod
+    def exists(index_name: str) -> bool:
+        """Whether an index folder has a keyword index"""
+        return os.path.exists(os.path.join(index_name, KEYWORD_DIR, _STATS_FILE))
+
+    @staticmethod
+    def write(index_name: str, ids: Sequence[int], text_of: Callable[[int], str]) -> None:
+        """
+        Write the keyword index for the given chunk IDs
+
+        Postings of chunks already in the existing keyword index are reused,
+        so only new chunks are tokenized; postings of chunks no longer in ids
+        are dropped.
+
+        Args:
+            index_name: Path to the index folder
+            ids: Every chunk ID of the index
+            text_of: Returns the text of a chunk ID
+        """
+        ids = np.unique(np.asarray(ids, dtype="int64"))
+        terms_parts, rows_parts, tf_parts = [], [], []
+        lengths = np.zeros(len(ids), dtype="int32")
+
+        known = np.zeros(len(ids), dtype=bool)
+        if KeywordIndex.exists(index_name):
+            old = KeywordIndex(index_name)
+            old_ids = np.array(old._array("ids"))
+            old_rows = np.array(old._array("rows"))
+            positions = np.minimum(np.searchsorted(ids, old_ids), max(len(ids) - 1, 0))
+            kept = (ids[positions] == old_ids) if len(ids) else np.zeros(len(old_ids), bool)
+            known[positions[kept]] = True
+            lengths[positions[kept]] = np.array(old._array("lengths"))[kept]
+            posting_kept = kept[old_rows]
+            old_terms = np.repeat(np.array(old._array("terms")), np.diff(old._array("offsets")))
+            terms_parts.append(old_terms[posting_kept])
+            rows_parts.append(positions[old_rows[posting_kept]].astype("int32"))
+            tf_parts.append(np.array(old._array("tf"))[posting_kept])
+            del old
+
+        hashes: Dict[str, int] = {}
+        new_terms, new_rows, new_tf = [], [], []
+        for row in np.flatnonzero(~known):
+            counts = Counter(tokenize(text_of(int(ids[row]))))
+            lengths[row] = sum(counts.values())
+            for term, count in counts.items():
+                if term not in hashes:
+                    hashes[term] = term_hash(term)
+                new_terms.append(hashes[term])
+                new_rows.append(row)
+                new_tf.append(min(count, 65535))
+        terms_parts.append(np.asarray(new_terms, dtype="int64"))
+        rows_parts.append(np.asarray(new_rows, dtype="int32"))
+        tf_parts.append(np.asarray(new_tf, dtype="uint16"))
+
+        terms = np.concatenate(terms_parts)
+        rows = np.concatenate(rows_parts)
+        tf = np.concatenate(tf_parts)
+        avg_length = float(lengths.mean()) if len(lengths) and lengths.any() else 1.0
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[rows] / avg_length)
+        weights = (tf * (BM25_K1 + 1) / (tf + norm)).astype("float16")
+
+        # Group by term, strongest postings first
+        order = np.lexsort((rows, -weights, terms))
+        terms, rows, tf, weights = terms[order], rows[order], tf[order], weights[order]
+        unique_terms, counts = np.unique(terms, return_counts=True)
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype("int64")
+
+        # Files are written under temporary names and renamed over the old
+        # ones, stats last, so processes mapping the old version are unaffected
+        path = os.path.join(index_name, KEYWORD_DIR)
+        os.makedirs(path, exist_ok=True)
+        arrays = dict(zip(_ARRAYS, (ids, lengths, unique_terms, offsets, rows, tf, weights)))
+        for name, array in arrays.items():
+            np.save(os.path.join(path, f"{name}.tmp.npy"), array)
+        with open(os.path.join(path, _STATS_FILE + ".tmp"), "w", encoding="utf-8") as f:
+            json.dump({"num_docs": len(ids), "avg_length": avg_length,
+                       "k1": BM25_K1, "b": BM25_B}, f)
+        for name in arrays:
+            os.replace(os.path.join(path, f"{name}.tmp.npy"), os.path.join(path, f"{name}.npy"))
+        os.replace(os.path.join(path, _STATS_FILE + ".tmp"), os.path.join(path, _STATS_FILE))
+
+    def _array(self, name: str) -> np.ndarray:
+        if not self._arrays:
+            # Map every array at once, so a later write cannot mix two versions
+            self._arrays = {key: np.load(os.path.join(self.path, f"{key}.npy"), mmap_mode="r")
+                            for key in _ARRAYS}
+        return self._arrays[name]
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        """Document count, average length and BM25 parameters"""
+        if self._stats is None:
+            with open(os.path.join(self.path, _STATS_FILE), "r", encoding="utf-8") as f:
+                self._stats = json.load(f)
+        return self._stats
+
+    @property
+    def ids(self) -> np.ndarray:
+        """Sorted chunk IDs, one per row"""
+        return self._array("ids")
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def rows(self, ids: Sequence[int]) -> np.ndarray:
+        """Row numbers of the given IDs that are present in the index"""
+        ids = np.asarray(ids, dtype="int64")
+        stored = self.ids
+        if not len(stored) or not len(ids):
+            return np.empty(0, dtype="int64")
+        positions = np.minimum(np.searchsorted(stored, ids), len(stored) - 1)
+        return positions[stored[positions] == ids]
+
+    def _positions(self, query: str) -> np.ndarray:
+        """Positions in terms.npy of the query terms present in the index"""
+        hashes = np.unique(np.asarray([term_hash(t) for t in tokenize(query)], dtype="int64"))
+        terms = self._array("terms")
+        if not len(hashes) or not len(terms):
+            return np.empty(0, dtype="int64")
+        positions = np.minimum(np.searchsorted(terms, hashes), len(terms) - 1)
+        return positions[terms[positions] == hashes]
+
+    def document_frequencies(self, query: str) -> Dict[int, int]:
+        """Number of chunks containing each query term, keyed by term hash"""
+        terms, offsets = self._array("terms"), self._array("offsets")
+        return {int(terms[position]): int(offsets[position + 1] - offsets[position])
+                for position in self._positions(query)}
+
+    def search(self, query: str, k: int,
+               allowed_rows: Optional[np.ndarray] = None,
+               collection: Optional[Tuple[int, Dict[int, int]]] = None
+               ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Top-k chunks for a query by BM25 score
+
+        Args:
+            query: The query string
+            k: Number of results
+            allowed_rows: Restrict results to these rows (e.g. a metadata filter)
+            collection: Chunk count and document frequencies (by term hash) of
+                a whole collection this index is a shard of; IDF is computed
+                from them instead of this index's own counts, so scores of
+                different shards are comparable
+
+        Returns:
+            (ids, scores) arrays sorted by decreasing score; only chunks that
+            contain at least one query term are returned
+        """
+        empty = (np.empty(0, dtype="int64"), np.empty(0, dtype="float32"))
+        positions = self._positions(query)
+        if not len(positions):
+            return empty
+
+        terms = self._array("terms")
+        offsets, rows, weights = self._array("offsets"), self._array("rows"), self._array("weights")
+        num_docs = len(self) if collection is None else collection[0]
+        row_parts, score_parts = [], []
+        for position in positions:
+            start, end = int(offsets[position]), int(offsets[position + 1])
+            df = end - start if collection is None else collection[1][int(terms[position])]
+            idf = math.log(1 + (num_docs - df + 0.5) / (df + 0.5))
+            term_rows, term_weights = rows[start:end], weights[start:end]
+            if allowed_rows is not None:
+                # Filter before truncating, so a common term still contributes
+                # its best postings inside the allowed set
+                keep = np.isin(term_rows, allowed_rows)
+                term_rows, term_weights = term_rows[keep], term_weights[keep]
+            row_parts.append(term_rows[:MAX_POSTINGS_PER_TERM])
+            score_parts.append(term_weights[:MAX_POSTINGS_PER_TERM].astype("float32") * idf)
+        matched = np.concatenate(row_parts)
+        contributions = np.concatenate(score_parts)
+
+        candidates, inverse = np.unique(matched, return_inverse=True)
+        scores = np.bincount(inverse, contributions).astype("float32")
+        if not len(candidates):
+            return empty
+
+        if len(candidates) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            candidates, scores = candidates[top], scores[top]
+        order = np.argsort(-scores, kind="stable")
+        return np.asarray(self.ids[candidates[order]], dtype="int64"), scores[order]
@@ -1,22 +1,51 @@
 # llm_integration.py
 """
 Optional integration with local LLMs for answer generation
-(This is a template module to show how you could integrate with a local LLM)
+
+LocalLLM is a template for in-process models; OllamaLLM talks to an
+Ollama-compatible HTTP server and streams tokens asynchronously.
 """
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, AsyncIterator, Iterator
+import asyncio
+import json
 import os
+import queue
+import threading
+import time
+
+DEFAULT_OLLAMA_URL = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
+
+class LLMError(RuntimeError):
+    """Raised when the LLM server fails or times out"""
+
+_DONE = object()
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+def _background_loop() -> asyncio.AbstractEventLoop:
+    """Event loop running in a daemon thread, shared by all synchronous callers"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="llm-event-loop",
+                             daemon=True).start()
+        return _loop
 
 class LocalLLM:
     """Interface for local LLM integration"""
     
-    def __init__(self, model_name: str = "default"):
+    def __init__(self, model_name: str = "default", tokenizer: Optional[str] = None):
         """
         Initialize LLM connector
         
         Args:
             model_name: Name of the model to use
+            tokenizer: Hugging Face tokenizer matching the model, used to
+                count context tokens (approximated when omitted)
         """
         self.model_name = model_name
+        self.tokenizer = tokenizer
         self.model = None
         
     def load(self) -> bool:
@@ -74,6 +103,25 @@ class LocalLLM:
         except Exception as e:
             return f"Error generating answer: {e}"
             
+    def stream_answer(self, query: str, context: str) -> Iterator[str]:
+        """
+        Generate an answer piece by piece
+        
+        Models without native streaming yield their whole answer at once.
+        
+        Args:
+            query: User's question
+            context: Retrieved document context
+            
+        Returns:
+            Iterator over answer fragments
+        """
+        yield self.generate_answer(query, context)
+        
+    async def astream_answer(self, query: str, context: str) -> AsyncIterator[str]:
+        """Async variant of stream_answer (runs the model in a worker thread)"""
+        yield await asyncio.to_thread(self.generate_answer, query, context)
+            
     def _create_prompt(self, query: str, context: str) -> str:
         """
         Create a prompt for the LLM
@@ -99,50 +147,169 @@ Answer:
 # Example of integrating with specific LLMs:
 
 class OllamaLLM(LocalLLM):
-    """Integration with Ollama LLM server"""
+    """
+    Integration with an Ollama-compatible LLM server
+    
+    Answers are streamed from POST /api/generate, one JSON line per token
+    batch. A pooled httpx.AsyncClient keeps connections to the server alive
+    between questions. The async methods can be awaited from any event loop;
+    the synchronous ones run on a shared background loop and bridge tokens
+    through a queue, so closing their iterator (or interrupting the caller)
+    cancels the request.
+    """
+    
+    def __init__(self, model_name: str = "llama3",
+                 base_url: str = DEFAULT_OLLAMA_URL,
+                 timeout: float = 120.0,
+                 connect_timeout: float = 5.0,
+                 token_timeout: float = 30.0,
+                 max_connections: int = 10,
+                 options: Optional[Dict[str, Any]] = None,
+                 tokenizer: Optional[str] = None):
+        """
+        Initialize the Ollama connector (no connection is made until first use)
+        
+        Args:
+            model_name: Model served by the Ollama server
+            base_url: Server URL, e.g. http://localhost:11434
+            timeout: Maximum seconds for a whole answer
+            connect_timeout: Maximum seconds to open a connection
+            token_timeout: Maximum seconds to wait for the next token
+            max_connections: Size of the connection pool
+            options: Ollama generation options (temperature, num_ctx, ...)
+            tokenizer: Hugging Face tokenizer matching the model, used to
+                count context tokens
+        """
+        super().__init__(model_name, tokenizer)
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.token_timeout = token_timeout
+        self.max_connections = max_connections
+        self.options = options or {}
+        self._clients: Dict[int, Any] = {}
+        
+    def _client(self):
+        """Pooled client of the running event loop (clients cannot cross loops)"""
+        import httpx
+        loop_id = id(asyncio.get_running_loop())
+        client = self._clients.get(loop_id)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=httpx.Timeout(self.token_timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+            )
+            self._clients[loop_id] = client
+        return client
     
     def load(self) -> bool:
-        """Load Ollama model"""
+        """Check that the server is reachable and serves the model"""
         try:
-            # Check if ollama is installed/available
-            # For an actual implementation, uncomment and use the requests library
-            """
-            import requests
-            self.api_base = "http://localhost:11434/api"
-            # Test connection
-            response = requests.get(f"{self.api_base}/tags")
-            if response.status_code != 200:
-                print("Error connecting to Ollama server")
-                return False
-            """
-            print(f"Connected to Ollama server, using model: {self.model_name}")
-            return True
+            future = asyncio.run_coroutine_threadsafe(self._aload(), _background_loop())
+            return future.result(self.connect_timeout + self.token_timeout)
         except Exception as e:
             print(f"Error connecting to Ollama: {e}")
             return False
             
+    async def _aload(self) -> bool:
+        response = await self._client().get("/api/tags")
+        if response.status_code != 200:
+            print(f"Error connecting to Ollama server: HTTP {response.status_code}")
+            return False
+        models = {model.get("name", "") for model in response.json().get("models", [])}
+        if models and not any(name == self.model_name or name.split(":")[0] == self.model_name
+                              for name in models):
+            print(f"Model '{self.model_name}' not found on Ollama server; "
+                  f"available: {', '.join(sorted(models))}")
+            return False
+        self.model = self.model_name
+        print(f"Connected to Ollama server, using model: {self.model_name}")
+        return True
+        
+    async def astream_answer(self, query: str, context: str) -> AsyncIterator[str]:
+        """
+        Stream answer tokens from the server
+        
+        Raises:
+            LLMError: On HTTP errors, server-reported errors or timeouts
+        """
+        import httpx
+        payload = {"model": self.model_name, "prompt": self._create_prompt(query, context),
+                   "stream": True}
+        if self.options:
+            payload["options"] = self.options
+        deadline = time.monotonic() + self.timeout
+        try:
+            async with self._client().stream("POST", "/api/generate", json=payload) as response:
+                if response.status_code != 200:
+                    body = (await response.aread()).decode("utf-8", "replace")
+                    raise LLMError(f"HTTP {response.status_code}: {body[:200]}")
+                async for line in response.aiter_lines():
+                    if time.monotonic() > deadline:
+                        raise LLMError(f"Answer not finished within {self.timeout:.0f}s")
+                    if not line.strip():
+                        continue
+                    message = json.loads(line)
+                    if message.get("error"):
+                        raise LLMError(message["error"])
+                    if message.get("response"):
+                        yield message["response"]
+                    if message.get("done"):
+                        return
+        except httpx.TimeoutException as e:
+            raise LLMError(f"Timed out waiting for the LLM server ({type(e).__name__})") from e
+        except httpx.HTTPError as e:
+            raise LLMError(f"Could not reach the LLM server at {self.base_url}: {e}") from e
+            
+    async def agenerate_answer(self, query: str, context: str) -> str:
+        """Generate a complete answer asynchronously"""
+        return "".join([token async for token in self.astream_answer(query, context)])
+        
+    def stream_answer(self, query: str, context: str) -> Iterator[str]:
+        """
+        Stream answer tokens synchronously
+        
+        Closing the returned iterator early cancels the request.
+        
+        Raises:
+            LLMError: On HTTP errors, server-reported errors or timeouts
+        """
+        tokens: "queue.Queue" = queue.Queue()
+        
+        async def pump():
+            try:
+                async for token in self.astream_answer(query, context):
+                    tokens.put(token)
+                tokens.put(_DONE)
+            except asyncio.CancelledError:
+                tokens.put(_DONE)
+                raise
+            except Exception as e:
+                tokens.put(e)
+                
+        future = asyncio.run_coroutine_threadsafe(pump(), _background_loop())
+        try:
+            while True:
+                item = tokens.get()
+                if item is _DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            future.cancel()
+            
     def generate_answer(self, query: str, context: str) -> str:
         """Generate answer using Ollama API"""
-        prompt = self._create_prompt(query, context)
-        
         try:
-            # For an actual implementation, uncomment and use the requests library
-            """
-            import requests
-            response = requests.post(
-                f"{self.api_base}/generate",
-                json={
-                    "model": self.model_name,
-                    "prompt": prompt,
-                    "stream": False
-                }
-            )
-            if response.status_code == 200:
-                return response.json()["response"]
-            else:
-                return f"Error: {response.text}"
-            """
-            # Placeholder
-            return "This is a placeholder for Ollama-generated response."
+            return "".join(self.stream_answer(query, context))
         except Exception as e:
-            return f"Error generating answer: {e}"
\ No newline at end of file
+            return f"Error generating answer: {e}"
+            
+    async def aclose(self) -> None:
+        """Close the pooled client of the running event loop"""
+        client = self._clients.pop(id(asyncio.get_running_loop()), None)
+        if client is not None:
+            await client.aclose()
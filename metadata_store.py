@@ -0,0 +1,248 @@
+# metadata_store.py
+"""
+Columnar, lazily loaded chunk metadata stored next to a FAISS index
+"""
+import json
+import os
+from typing import Any, Dict, List, Optional, Sequence
+import numpy as np
+
+# Operators accepted in range conditions of a metadata filter
+_RANGE_OPERATORS = {
+    "$gt": lambda value, bound: value > bound,
+    "$gte": lambda value, bound: value >= bound,
+    "$lt": lambda value, bound: value < bound,
+    "$lte": lambda value, bound: value <= bound,
+    "$ne": lambda value, bound: value != bound,
+}
+
+METADATA_DIR = "metadata"
+_COLUMNS_FILE = "columns.json"
+_IDS_FILE = "ids.npy"
+
+
+def value_matches(value: Any, condition: Any) -> bool:
+    """
+    Whether one metadata value satisfies a filter condition
+
+    A condition is a plain value (equality), a list/tuple/set (any of), or a
+    dict of operators: $in, $gt, $gte, $lt, $lte, $ne. Values that cannot be
+    compared with a range bound do not match.
+    """
+    if isinstance(condition, dict):
+        for operator, bound in condition.items():
+            if operator == "$in":
+                if value not in bound:
+                    return False
+                continue
+            if operator not in _RANGE_OPERATORS:
+                raise ValueError(f"Unsupported filter operator '{operator}'")
+            try:
+                if not _RANGE_OPERATORS[operator](value, bound):
+                    return False
+            except TypeError:
+                return False
+        return True
+    if isinstance(condition, (list, tuple, set)):
+        return value in condition
+    return value == condition
+
+
+def metadata_matches(metadata: Dict[str, Any], filter: Dict[str, Any]) -> bool:
+    """Whether a metadata dictionary satisfies every condition of a filter"""
+    return all(key in metadata and value_matches(metadata[key], condition)
+               for key, condition in filter.items())
+
+
+class MetadataStore:
+    """
+    Dictionary-encoded metadata columns keyed by chunk ID
+
+    On disk, ids.npy holds the sorted chunk IDs and each metadata key is one
+    int32 code array (-1 where the key is missing) plus its list of distinct
+    values in columns.json. Each key also has an inverted index: its row
+    numbers grouped by code (postings) with per-code offsets, so the rows
+    holding a value are found without scanning the column. Arrays are
+    memory-mapped on first access, so opening a store costs nothing and a
+    lookup only touches the rows it needs.
+    """
+
+    def __init__(self, index_name: str):
+        """
+        Open the store of an index folder (nothing is read until first use)
+
+        Args:
+            index_name: Path to the index folder
+        """
+        self.path = os.path.join(index_name, METADATA_DIR)
+        self._ids: Optional[np.ndarray] = None
+        self._columns: Optional[Dict[str, Dict[str, Any]]] = None
+        self._codes: Dict[str, np.ndarray] = {}
+
+    @staticmethod
+    def exists(index_name: str) -> bool:
+        """Whether an index folder has a metadata sidecar"""
+        return os.path.exists(os.path.join(index_name, METADATA_DIR, _COLUMNS_FILE))
+
+    @staticmethod
+    def write(index_name: str, ids: Sequence[int], metadatas: Sequence[Dict[str, Any]]) -> None:
+        """
+        Write metadata for the given chunk IDs, replacing any existing sidecar
+
+        Args:
+            index_name: Path to the index folder
+            ids: Chunk IDs
+            metadatas: One metadata dictionary per ID
+        """
+        path = os.path.join(index_name, METADATA_DIR)
+        os.makedirs(path, exist_ok=True)
+        ids = np.asarray(ids, dtype="int64")
+        order = np.argsort(ids, kind="stable")
+
+        encoders: Dict[str, Dict[str, int]] = {}
+        values: Dict[str, List[Any]] = {}
+        codes: Dict[str, np.ndarray] = {}
+        for row, position in enumerate(order):
+            for key, value in metadatas[position].items():
+                if key not in encoders:
+                    encoders[key], values[key] = {}, []
+                    codes[key] = np.full(len(ids), -1, dtype="int32")
+                token = json.dumps(value, sort_keys=True, default=str)
+                code = encoders[key].get(token)
+                if code is None:
+                    code = encoders[key][token] = len(values[key])
+                    values[key].append(json.loads(token))
+                codes[key][row] = code
+
+        # Files are written under temporary names and renamed over the old
+        # ones, columns.json last, so processes mapping the old version are
+        # unaffected; files of columns that no longer exist are removed after
+        columns = {}
+        arrays = {_IDS_FILE: ids[order]}
+        for number, key in enumerate(sorted(codes)):
+            filename = f"col{number}.npy"
+            present = np.flatnonzero(codes[key] >= 0)
+            postings = present[np.argsort(codes[key][present], kind="stable")].astype("int64")
+            counts = np.bincount(codes[key][present], minlength=len(values[key]))
+            offsets = np.concatenate([[0], np.cumsum(counts)]).astype("int64")
+            arrays[filename] = codes[key]
+            arrays[f"col{number}.postings.npy"] = postings
+            arrays[f"col{number}.offsets.npy"] = offsets
+            columns[key] = {"file": filename, "values": values[key]}
+        for filename, array in arrays.items():
+            np.save(os.path.join(path, filename[:-len(".npy")] + ".tmp.npy"), array)
+        with open(os.path.join(path, _COLUMNS_FILE + ".tmp"), "w", encoding="utf-8") as f:
+            json.dump(columns, f)
+        for filename in arrays:
+            os.replace(os.path.join(path, filename[:-len(".npy")] + ".tmp.npy"),
+                       os.path.join(path, filename))
+        os.replace(os.path.join(path, _COLUMNS_FILE + ".tmp"), os.path.join(path, _COLUMNS_FILE))
+        for filename in os.listdir(path):
+            if filename not in arrays and filename != _COLUMNS_FILE:
+                os.remove(os.path.join(path, filename))
+
+    def _load(self) -> None:
+        if self._columns is None:
+            # Map every file at once, so a later write cannot mix two versions
+            with open(os.path.join(self.path, _COLUMNS_FILE), "r", encoding="utf-8") as f:
+                columns = json.load(f)
+            self._ids = np.load(os.path.join(self.path, _IDS_FILE), mmap_mode="r")
+            for key, column in columns.items():
+                for suffix in ("", ".postings", ".offsets"):
+                    filename = column["file"].replace(".npy", f"{suffix}.npy")
+                    self._codes[f"{key}\0{suffix[1:]}" if suffix else key] = np.load(
+                        os.path.join(self.path, filename), mmap_mode="r")
+            self._columns = columns
+
+    @property
+    def ids(self) -> np.ndarray:
+        """Sorted chunk IDs"""
+        self._load()
+        return self._ids
+
+    @property
+    def keys(self) -> List[str]:
+        """Metadata keys present in the store"""
+        self._load()
+        return list(self._columns)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def rows(self, ids: Sequence[int]) -> np.ndarray:
+        """Row number of each ID, or -1 if the ID is not in the store"""
+        ids = np.asarray(ids, dtype="int64")
+        stored = self.ids
+        if not len(stored):
+            return np.full(len(ids), -1, dtype="int64")
+        positions = np.minimum(np.searchsorted(stored, ids), len(stored) - 1)
+        return np.where(stored[positions] == ids, positions, -1)
+
+    def codes(self, key: str) -> np.ndarray:
+        """Per-row value codes of one column (-1 where missing)"""
+        self._load()
+        return self._codes[key]
+
+    def values(self, key: str) -> List[Any]:
+        """Distinct values of one column, indexed by code"""
+        self._load()
+        return self._columns[key]["values"]
+
+    def _postings(self, key: str, suffix: str) -> np.ndarray:
+        self._load()
+        return self._codes[f"{key}\0{suffix}"]
+
+    def ids_for(self, filter: Dict[str, Any]) -> np.ndarray:
+        """
+        IDs of the chunks whose metadata satisfies a filter
+
+        Conditions are evaluated against each column's distinct values, and
+        the matching rows are read from the inverted index, so the cost grows
+        with the number of matches rather than with the corpus.
+
+        Args:
+            filter: Mapping of metadata key to condition (see value_matches)
+
+        Returns:
+            Sorted int64 array of matching chunk IDs
+        """
+        self._load()
+        rows = None
+        for key, condition in filter.items():
+            if key not in self._columns:
+                return np.empty(0, dtype="int64")
+            offsets = self._postings(key, "offsets")
+            postings = self._postings(key, "postings")
+            matched = [code for code, value in enumerate(self.values(key))
+                       if value_matches(value, condition)]
+            key_rows = np.concatenate([postings[offsets[code]:offsets[code + 1]]
+                                       for code in matched]) if matched else np.empty(0, "int64")
+            rows = key_rows if rows is None else np.intersect1d(rows, key_rows, assume_unique=True)
+            if not len(rows):
+                break
+        if rows is None:
+            return np.asarray(self.ids, dtype="int64")
+        return np.asarray(self.ids[np.sort(rows)], dtype="int64")
+
+    def lookup(self, ids: Sequence[int]) -> List[Dict[str, Any]]:
+        """
+        Metadata dictionaries for the given IDs
+
+        Args:
+            ids: Chunk IDs
+
+        Returns:
+            One dictionary per ID ({} for unknown IDs)
+        """
+        rows = self.rows(ids)
+        results: List[Dict[str, Any]] = [{} for _ in rows]
+        hits = np.flatnonzero(rows >= 0)
+        if not len(hits):
+            return results
+        for key in self.keys:
+            key_codes = self.codes(key)[rows[hits]]
+            key_values = self.values(key)
+            for position, code in zip(hits, key_codes):
+                if code >= 0:
+                    results[position][key] = key_values[code]
+        return results
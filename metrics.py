@@ -0,0 +1,370 @@
+# metrics.py
+"""
+Per-stage latency tracing and metrics export
+
+Collection is off until enable_metrics() is called. Until then span()
+returns one shared do-nothing context manager and every record_* call
+returns after a single flag check, so the hooks left in the pipeline cost
+next to nothing. Once enabled, each finished span feeds a latency
+histogram of its stage, and, with a log file, is written as one JSON line
+carrying its trace and parent span so a slow query can be followed stage
+by stage. Metrics render in the Prometheus text exposition format.
+"""
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+STAGE_SECONDS = "flowquery_stage_seconds"
+STAGE_ERRORS = "flowquery_stage_errors_total"
+BATCH_SIZE = "flowquery_batch_size"
+CACHE_REQUESTS = "flowquery_cache_requests_total"
+INDEX_VECTORS = "flowquery_index_vectors"
+INDEX_BYTES = "flowquery_index_bytes"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    STAGE_SECONDS: ("histogram", "Latency of each pipeline stage in seconds", LATENCY_BUCKETS),
+    STAGE_ERRORS: ("counter", "Pipeline stages that ended with an exception", None),
+    BATCH_SIZE: ("histogram", "Items processed together by a batched stage", BATCH_SIZE_BUCKETS),
+    CACHE_REQUESTS: ("counter", "Cache lookups by cache and result", None),
+    INDEX_VECTORS: ("gauge", "Vectors held by a loaded or written index", None),
+    INDEX_BYTES: ("gauge", "Size of an index folder on disk in bytes", None),
+}
+
+
+class _Histogram:
+    """Cumulative bucket counts, sum and count of observed values"""
+
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float, buckets: Tuple[float, ...]) -> None:
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """Thread-safe store of every metric series of this process"""
+
+    def __init__(self):
+        self._series: Dict[str, Dict[Tuple[Tuple[str, str], ...], object]] = {
+            name: {} for name in METRICS}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _labels(labels: Dict[str, object]) -> Tuple[Tuple[str, str], ...]:
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """Add a value to a histogram"""
+        buckets = METRICS[name][2]
+        key = self._labels(labels)
+        with self._lock:
+            series = self._series[name]
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = _Histogram(buckets)
+            histogram.observe(value, buckets)
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        """Increase a counter"""
+        key = self._labels(labels)
+        with self._lock:
+            series = self._series[name]
+            series[key] = series.get(key, 0) + amount
+
+    def set(self, name: str, value: float, **labels) -> None:
+        """Set a gauge"""
+        key = self._labels(labels)
+        with self._lock:
+            self._series[name][key] = value
+
+    def clear(self) -> None:
+        """Drop every recorded value"""
+        with self._lock:
+            for series in self._series.values():
+                series.clear()
+
+    def render(self) -> str:
+        """All series in the Prometheus text exposition format"""
+        lines: List[str] = []
+        with self._lock:
+            for name, (kind, help_text, buckets) in METRICS.items():
+                series = self._series[name]
+                if not series:
+                    continue
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in sorted(series.items()):
+                    if kind != "histogram":
+                        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(buckets, value.counts):
+                        cumulative += count
+                        le = (("le", _format_value(bound)),)
+                        lines.append(f"{name}_bucket{_format_labels(labels + le)} {cumulative}")
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))}"
+                                 f" {value.count}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(value.sum)}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {value.count}")
+        return "\n".join(lines) + "\n" if lines else ""
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+_registry = MetricsRegistry()
+_enabled = False
+_log = None
+_log_lock = threading.Lock()
+_local = threading.local()
+_trace_ids = itertools.count(1)
+
+
+class Span:
+    """
+    Times one stage of the pipeline (use as a context manager)
+
+    Spans opened while another span is active on the same thread become
+    its children and share its trace id. Attributes given to the
+    constructor or to set() go into the JSON log only, so values with many
+    distinct settings (queries, paths) never become metric labels.
+    """
+
+    __slots__ = ("stage", "attrs", "trace", "parent", "start")
+
+    def __init__(self, stage: str, attrs: Dict[str, object]):
+        self.stage = stage
+        self.attrs = attrs
+
+    def set(self, **attrs) -> None:
+        """Attach more attributes to the span's log record"""
+        self.attrs.update(attrs)
+
+    def __enter__(self) -> "Span":
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        if stack:
+            self.trace, self.parent = stack[-1].trace, stack[-1].stage
+        else:
+            self.trace, self.parent = next(_trace_ids), None
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        seconds = time.perf_counter() - self.start
+        stack = getattr(_local, "stack", [])
+        if stack and stack[-1] is self:
+            stack.pop()
+        elif self in stack:
+            stack.remove(self)
+        _finish(self.stage, seconds, self.trace, self.parent, self.attrs,
+                None if exc_type is None else f"{exc_type.__name__}: {exc}")
+        return False
+
+
+class _NoSpan:
+    """Stand-in returned by span() while metrics are disabled"""
+
+    __slots__ = ()
+
+    def set(self, **attrs) -> None:
+        pass
+
+    def __enter__(self) -> "_NoSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def _finish(stage: str, seconds: float, trace: int, parent: Optional[str],
+            attrs: Dict[str, object], error: Optional[str]) -> None:
+    """Record a finished span in the histogram and the JSON log"""
+    _registry.observe(STAGE_SECONDS, seconds, stage=stage)
+    if error is not None:
+        _registry.inc(STAGE_ERRORS, stage=stage)
+    if _log is not None:
+        record = {"time": round(time.time(), 6), "span": stage,
+                  "ms": round(seconds * 1000, 3), "trace": f"{os.getpid()}-{trace}",
+                  "parent": parent}
+        record.update(attrs)
+        if error is not None:
+            record["error"] = error
+        _write_log(record)
+
+
+def _write_log(record: Dict[str, object]) -> None:
+    line = json.dumps(record, default=str)
+    with _log_lock:
+        if _log is not None:
+            _log.write(line + "\n")
+            _log.flush()
+
+
+def enable_metrics(log_path: Optional[str] = None) -> None:
+    """
+    Start collecting metrics in this process
+
+    Args:
+        log_path: File that receives one JSON line per finished span
+            ("-" for stderr; None logs nothing)
+    """
+    global _enabled, _log
+    with _log_lock:
+        if _log is not None and _log is not sys.stderr:
+            _log.close()
+        _log = None
+        if log_path == "-":
+            _log = sys.stderr
+        elif log_path:
+            _log = open(log_path, "a", encoding="utf-8")
+    _enabled = True
+
+
+def disable_metrics() -> None:
+    """Stop collecting (recorded values are kept until reset_metrics)"""
+    global _enabled, _log
+    _enabled = False
+    with _log_lock:
+        if _log is not None and _log is not sys.stderr:
+            _log.close()
+        _log = None
+
+
+def metrics_enabled() -> bool:
+    """Whether metrics are being collected"""
+    return _enabled
+
+
+def reset_metrics() -> None:
+    """Drop every recorded value"""
+    _registry.clear()
+
+
+def span(stage: str, **attrs):
+    """
+    Context manager timing one stage of the pipeline
+
+    Args:
+        stage: Stage name, used as the "stage" label of the latency histogram
+        **attrs: Extra fields of the span's JSON log record
+
+    Returns:
+        A Span, or a shared no-op stand-in while metrics are disabled
+    """
+    if not _enabled:
+        return _NO_SPAN
+    return Span(stage, attrs)
+
+
+def record_duration(stage: str, seconds: float, error: Optional[str] = None,
+                    **attrs) -> None:
+    """
+    Record a stage timed by the caller as a span of the active trace
+
+    For work that cannot sit inside a with block, such as a generator that
+    yields answer tokens between its start and its end.
+    """
+    if not _enabled:
+        return
+    stack = getattr(_local, "stack", None)
+    if stack:
+        trace, parent = stack[-1].trace, stack[-1].stage
+    else:
+        trace, parent = next(_trace_ids), None
+    _finish(stage, seconds, trace, parent, attrs, error)
+
+
+def traced(items: Iterable, stage: str) -> Iterator:
+    """
+    Yield from an iterable, timing each item it produces as a span
+
+    Meant for lazy pipelines (e.g. batches read from a document generator),
+    where the work of a stage happens while the consumer pulls items.
+    """
+    iterator = iter(items)
+    while True:
+        with span(stage) as current:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                current.set(done=True)
+                return
+        yield item
+
+
+def record_batch_size(stage: str, size: int) -> None:
+    """Record the number of items a batched stage processed at once"""
+    if _enabled:
+        _registry.observe(BATCH_SIZE, size, stage=stage)
+
+
+def record_cache(cache: str, result: str, count: int = 1) -> None:
+    """Count cache lookups, e.g. record_cache("query", "exact")"""
+    if _enabled and count:
+        _registry.inc(CACHE_REQUESTS, count, cache=cache, result=result)
+
+
+def record_index_size(index_name: str, vectors: int) -> None:
+    """Record the vector count and on-disk size of an index folder"""
+    if not _enabled:
+        return
+    size = 0
+    for root, _, files in os.walk(index_name):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    index = os.path.abspath(index_name)
+    _registry.set(INDEX_VECTORS, vectors, index=index)
+    _registry.set(INDEX_BYTES, size, index=index)
+
+
+def render_prometheus() -> str:
+    """Every recorded metric in the Prometheus text exposition format"""
+    return _registry.render()
+
+
+def write_prometheus(path: str) -> None:
+    """
+    Write the metrics to a file, e.g. for the node_exporter textfile collector
+
+    The file is replaced atomically, so a scraper never reads half of it.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(render_prometheus())
+    os.replace(tmp_path, path)
@@ -0,0 +1,293 @@
+# onnx_backend.py
+"""
+ONNX Runtime inference for SentenceTransformer embedding models
+"""
+import json
+import os
+import re
+import shutil
+import warnings
+from typing import Dict, List, Optional, Union
+import numpy as np
+
+# Exported models are kept here, one folder per model and precision
+DEFAULT_ONNX_DIR = os.environ.get(
+    "FLOWQUERY_ONNX_DIR", os.path.join(os.path.expanduser("~"), ".cache", "flowquery", "onnx"))
+
+# Lowest cosine similarity to the PyTorch embeddings an export may have
+DEFAULT_MIN_COSINE = float(os.environ.get("FLOWQUERY_ONNX_MIN_COSINE", "0.99"))
+
+ONNX_OPSET = 17
+FORMAT_VERSION = 1
+
+_MODEL_FILE = "model.onnx"
+_INFO_FILE = "info.json"
+_TOKENIZER_DIR = "tokenizer"
+
+# Sentences embedded by both backends to check an export
+_CHECK_SENTENCES = [
+    "How do I reset my password?",
+    "The quarterly report shows revenue growth of 12% year over year.",
+    "Install the package with pip and restart the service.",
+    "Error handling: retries are attempted three times before the request fails.",
+    "a",
+    "Machine learning models convert text into dense vectors that capture meaning, "
+    "so that passages about similar topics end up close to each other even when "
+    "they share few words. " * 4,
+]
+
+_POOLING_FLAGS = {"pooling_mode_cls_token": "cls", "pooling_mode_max_tokens": "max",
+                  "pooling_mode_mean_tokens": "mean"}
+
+
+def default_threads() -> int:
+    """Cores this process may run on, honouring CPU affinity"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _pooling_mode(module) -> str:
+    """Pooling of a SentenceTransformer Pooling module (mean, cls or max)"""
+    config = module.get_config_dict()
+    mode = config.get("pooling_mode")
+    if mode is None:
+        modes = [name for flag, name in _POOLING_FLAGS.items() if config.get(flag)]
+        mode = modes[0] if len(modes) == 1 else None
+    if mode not in ("mean", "cls", "max"):
+        raise ValueError(f"Unsupported pooling {config} for the ONNX backend")
+    return mode
+
+
+def _pool(token_embeddings: np.ndarray, attention_mask: np.ndarray, mode: str) -> np.ndarray:
+    if mode == "cls":
+        return token_embeddings[:, 0]
+    mask = attention_mask[:, :, None].astype(token_embeddings.dtype)
+    if mode == "max":
+        return np.where(mask > 0, token_embeddings, -np.inf).max(axis=1)
+    return (token_embeddings * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+
+
+def _normalize(embeddings: np.ndarray) -> np.ndarray:
+    return embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+
+def export_path(model_name: str, quantize: bool = False,
+                cache_dir: str = DEFAULT_ONNX_DIR) -> str:
+    """Folder holding the export of a model"""
+    slug = re.sub(r"[^\w.-]+", "_", model_name.strip("/\\")).strip("_")
+    return os.path.join(cache_dir, slug + ("-int8" if quantize else ""))
+
+
+def export_model(model_name: str, quantize: bool = False,
+                 cache_dir: str = DEFAULT_ONNX_DIR) -> str:
+    """
+    Export a SentenceTransformer model to ONNX and check it against PyTorch
+
+    The transformer is exported with dynamic batch and sequence axes, and
+    its weights are optionally quantized to int8 (dynamic quantization:
+    activations are quantized on the fly, so no calibration data is
+    needed). Pooling and normalization run in numpy. Both backends then
+    embed a few sample sentences and the lowest cosine similarity between
+    them is recorded, so loading can reject an export that drifted too far.
+
+    Args:
+        model_name: The name of the SentenceTransformer model
+        quantize: Whether to quantize the weights to int8
+        cache_dir: Folder receiving the export
+
+    Returns:
+        Path to the export folder
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_name, device="cpu")
+    kinds = [type(module).__name__ for module in model]
+    if kinds[:2] != ["Transformer", "Pooling"] or any(k != "Normalize" for k in kinds[2:]):
+        raise ValueError(f"The ONNX backend does not support the modules {kinds} of {model_name}")
+    if not getattr(model.tokenizer, "is_fast", False):
+        raise ValueError(f"The ONNX backend needs a fast tokenizer, {model_name} has none")
+    transformer = model[0]
+    pooling = _pooling_mode(model[1])
+    reference = model.encode(_CHECK_SENTENCES, convert_to_numpy=True, normalize_embeddings=True)
+
+    path = export_path(model_name, quantize, cache_dir)
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    sample = model.tokenizer(_CHECK_SENTENCES[:2], padding=True, return_tensors="pt")
+    names = list(sample.keys())
+    auto_model = transformer.auto_model.eval()
+    if hasattr(auto_model, "set_attn_implementation"):
+        # Eager attention exports as plain MatMul/Softmax, which runs (and
+        # quantizes) better on ONNX Runtime than the fused SDPA kernel's decomposition
+        auto_model.set_attn_implementation("eager")
+
+    class TokenEmbeddings(torch.nn.Module):
+        def __init__(self, auto_model):
+            super().__init__()
+            self.auto_model = auto_model
+
+        def forward(self, *inputs):
+            return self.auto_model(**dict(zip(names, inputs))).last_hidden_state
+
+    fp32_file = os.path.join(tmp_path, "model-fp32.onnx" if quantize else _MODEL_FILE)
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        torch.onnx.export(TokenEmbeddings(auto_model),
+                          tuple(sample[name] for name in names), fp32_file,
+                          input_names=names, output_names=["token_embeddings"],
+                          dynamic_axes={name: {0: "batch", 1: "sequence"}
+                                        for name in names + ["token_embeddings"]},
+                          opset_version=ONNX_OPSET, dynamo=False)
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(fp32_file, os.path.join(tmp_path, _MODEL_FILE),
+                         weight_type=QuantType.QInt8)
+        os.remove(fp32_file)
+
+    model.tokenizer.save_pretrained(os.path.join(tmp_path, _TOKENIZER_DIR))
+    info = {"format": FORMAT_VERSION, "model_name": model_name, "quantized": quantize,
+            "pooling": pooling, "normalize": len(kinds) > 2,
+            "max_seq_length": transformer.max_seq_length,
+            "pad_token": model.tokenizer.pad_token, "pad_token_id": model.tokenizer.pad_token_id}
+    with open(os.path.join(tmp_path, _INFO_FILE), "w", encoding="utf-8") as f:
+        json.dump(info, f)
+
+    exported = OnnxEncoder(tmp_path, threads=default_threads()).encode(
+        _CHECK_SENTENCES, normalize_embeddings=True)
+    info["min_cosine"] = float((reference * exported).sum(axis=1).min())
+    with open(os.path.join(tmp_path, _INFO_FILE), "w", encoding="utf-8") as f:
+        json.dump(info, f)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    print(f"Exported {model_name} to ONNX{' (int8)' if quantize else ''}: "
+          f"cosine similarity to PyTorch >= {info['min_cosine']:.4f}")
+    return path
+
+
+class OnnxEncoder:
+    """
+    Embedding model running an exported transformer on ONNX Runtime
+
+    Mirrors the parts of the SentenceTransformer interface the rest of the
+    code uses (encode and tokenizer), so registry entries of either backend
+    are interchangeable. Texts are tokenized straight to arrays by the Rust
+    tokenizer and sorted by length before batching, so each batch pads to
+    similar lengths as SentenceTransformer does.
+    """
+
+    def __init__(self, path: str, threads: Optional[int] = None):
+        """
+        Open an export folder
+
+        Args:
+            path: Folder written by export_model
+            threads: Intra-op threads per inference (defaults to the usable cores)
+        """
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        self.path = path
+        with open(os.path.join(path, _INFO_FILE), "r", encoding="utf-8") as f:
+            self.info = json.load(f)
+        if self.info.get("format") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported ONNX export format {self.info.get('format')} in {path}")
+        self.max_seq_length = self.info["max_seq_length"]
+        self._tokenizer = Tokenizer.from_file(os.path.join(path, _TOKENIZER_DIR, "tokenizer.json"))
+        self._tokenizer.enable_truncation(self.max_seq_length)
+        self._tokenizer.enable_padding(pad_id=self.info["pad_token_id"],
+                                       pad_token=self.info["pad_token"])
+        self._hf_tokenizer = None
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads or default_threads()
+        options.inter_op_num_threads = 1
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        model_file = os.path.join(path, _MODEL_FILE)
+        self.session = onnxruntime.InferenceSession(model_file, options,
+                                                    providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.model_bytes = os.path.getsize(model_file)
+
+    @property
+    def tokenizer(self):
+        """Hugging Face tokenizer of the model (loaded on first use)"""
+        if self._hf_tokenizer is None:
+            from transformers import AutoTokenizer
+            self._hf_tokenizer = AutoTokenizer.from_pretrained(
+                os.path.join(self.path, _TOKENIZER_DIR))
+        return self._hf_tokenizer
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        encodings = self._tokenizer.encode_batch(texts)
+        features = {"input_ids": np.array([e.ids for e in encodings], dtype="int64"),
+                    "attention_mask": np.array([e.attention_mask for e in encodings],
+                                               dtype="int64"),
+                    "token_type_ids": np.array([e.type_ids for e in encodings], dtype="int64")}
+        inputs: Dict[str, np.ndarray] = {name: features[name] for name in self.input_names}
+        (token_embeddings,) = self.session.run(None, inputs)
+        return _pool(token_embeddings, features["attention_mask"], self.info["pooling"])
+
+    def encode(self, sentences: Union[str, List[str]], batch_size: int = 32,
+               normalize_embeddings: bool = False, convert_to_numpy: bool = True,
+               **kwargs) -> np.ndarray:
+        """
+        Embed texts like SentenceTransformer.encode
+
+        Args:
+            sentences: A text or a list of texts
+            batch_size: Number of texts per inference
+            normalize_embeddings: Whether to L2-normalize the embeddings
+
+        Returns:
+            float32 numpy matrix with one row per text (a vector for a single text)
+        """
+        single = isinstance(sentences, str)
+        texts = [str(text).strip() for text in ([sentences] if single else sentences)]
+        order = np.argsort([-len(text) for text in texts], kind="stable")
+        embeddings = np.empty((len(texts), 0), dtype="float32")
+        for start in range(0, len(texts), batch_size):
+            batch = order[start:start + batch_size]
+            vectors = self._embed([texts[i] for i in batch])
+            if not start:
+                embeddings = np.empty((len(texts), vectors.shape[1]), dtype="float32")
+            embeddings[batch] = vectors
+        if normalize_embeddings or self.info["normalize"]:
+            embeddings = _normalize(embeddings)
+        return embeddings[0] if single else embeddings
+
+
+def load_onnx_encoder(model_name: str, quantize: bool = False,
+                      threads: Optional[int] = None,
+                      min_cosine: float = DEFAULT_MIN_COSINE,
+                      cache_dir: str = DEFAULT_ONNX_DIR) -> OnnxEncoder:
+    """
+    Open the ONNX export of a model, exporting it on first use
+
+    Args:
+        model_name: The name of the SentenceTransformer model
+        quantize: Whether to use int8-quantized weights
+        threads: Intra-op threads per inference (defaults to the usable cores)
+        min_cosine: Lowest accepted cosine similarity to the PyTorch embeddings
+        cache_dir: Folder holding exported models
+
+    Returns:
+        An OnnxEncoder
+
+    Raises:
+        ValueError: If the export is not accurate enough or the model is unsupported
+    """
+    path = export_path(model_name, quantize, cache_dir)
+    if not os.path.exists(os.path.join(path, _INFO_FILE)):
+        export_model(model_name, quantize, cache_dir)
+    encoder = OnnxEncoder(path, threads)
+    if encoder.info["min_cosine"] < min_cosine:
+        raise ValueError(f"ONNX export of {model_name} deviates from PyTorch "
+                         f"(cosine similarity {encoder.info['min_cosine']:.4f} < {min_cosine})")
+    return encoder
@@ -0,0 +1,257 @@
+# query_cache.py
+"""
+Two-layer (exact + semantic) cache of RAG query results
+"""
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+import numpy as np
+from keyword_index import tokenize
+from metrics import record_cache
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_TTL_SECONDS = 3600.0
+
+# Cosine similarity above which a cached result is reused for a new query
+DEFAULT_SIMILARITY_THRESHOLD = 0.95
+
+
+def normalize_query(query: str) -> str:
+    """Case-, whitespace- and trailing-punctuation-insensitive form of a query"""
+    text = " ".join(unicodedata.normalize("NFKC", query).lower().split())
+    return text.strip(" ?!.")
+
+
+def _identifiers(query: str) -> frozenset:
+    """Terms containing digits (codes, versions, part numbers) of a query"""
+    return frozenset(term for term in tokenize(query) if any(c.isdigit() for c in term))
+
+
+class _Entry:
+    __slots__ = ("result", "embedding", "identifiers", "created")
+
+    def __init__(self, result, embedding, identifiers, created):
+        self.result = result
+        self.embedding = embedding
+        self.identifiers = identifiers
+        self.created = created
+
+
+class _Scope:
+    """Keys and stacked unit embeddings of the entries of one scope"""
+    __slots__ = ("keys", "positions", "matrix")
+
+    def __init__(self):
+        self.keys: list = []
+        self.positions: Dict[Tuple[str, Hashable], int] = {}
+        self.matrix: Optional[np.ndarray] = None
+
+    def add(self, key: Tuple[str, Hashable], vector: np.ndarray) -> None:
+        if self.matrix is None:
+            self.matrix = np.empty((16, len(vector)), dtype="float32")
+        elif len(self.keys) == len(self.matrix):
+            self.matrix = np.concatenate([self.matrix, np.empty_like(self.matrix)])
+        self.positions[key] = len(self.keys)
+        self.matrix[len(self.keys)] = vector
+        self.keys.append(key)
+
+    def remove(self, key: Tuple[str, Hashable]) -> None:
+        """Remove a key by moving the last row into its place"""
+        position = self.positions.pop(key, None)
+        if position is None:
+            return
+        last = self.keys.pop()
+        if last != key:
+            self.keys[position] = last
+            self.positions[last] = position
+            self.matrix[position] = self.matrix[len(self.keys)]
+
+
+class QueryCache:
+    """
+    LRU/TTL cache of query results for one index
+
+    The exact layer is keyed by normalized query plus a scope (k, filter and
+    retrieval settings). The semantic layer reuses the result of a cached
+    query in the same scope whose embedding has cosine similarity of at least
+    similarity_threshold with the new one; both queries must mention the same
+    identifiers (terms with digits), so "error 1042" never answers
+    "error 1043". Every entry belongs to an index version, and entries of
+    other versions are dropped as soon as a new version is seen.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 ttl_seconds: Optional[float] = DEFAULT_TTL_SECONDS,
+                 similarity_threshold: Optional[float] = DEFAULT_SIMILARITY_THRESHOLD):
+        """
+        Initialize the cache
+
+        Args:
+            max_entries: Maximum number of cached results
+            ttl_seconds: Age after which an entry expires (None never expires)
+            similarity_threshold: Minimum cosine similarity for a semantic hit
+                (None disables the semantic layer)
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._version: Hashable = None
+        self._entries: "OrderedDict[Tuple[str, Hashable], _Entry]" = OrderedDict()
+        # Per scope: keys and stacked unit embeddings of its entries
+        self._scopes: Dict[Hashable, _Scope] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def semantic(self) -> bool:
+        """Whether lookups use the semantic layer"""
+        return self.similarity_threshold is not None
+
+    def _set_version(self, version: Hashable) -> None:
+        if version != self._version:
+            self._entries.clear()
+            self._scopes.clear()
+            self._version = version
+
+    def _expired(self, entry: _Entry) -> bool:
+        return self.ttl_seconds is not None and time.time() - entry.created > self.ttl_seconds
+
+    def _remove(self, key: Tuple[str, Hashable]) -> None:
+        self._entries.pop(key, None)
+        scope = self._scopes.get(key[1])
+        if scope is not None:
+            scope.remove(key)
+
+    @staticmethod
+    def _unit(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype="float32").ravel()
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def get_exact(self, query: str, scope: Hashable, version: Hashable) -> Optional[Any]:
+        """
+        Look a query up in the exact layer
+
+        Misses are not counted here, since get_similar is expected to follow,
+        so callers only pay for a query embedding when the exact layer misses.
+
+        Args:
+            query: The query string
+            scope: Everything besides the query that determines the result
+            version: Current version of the index
+
+        Returns:
+            The cached result, or None
+        """
+        key = (normalize_query(query), scope)
+        with self._lock:
+            self._set_version(version)
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry):
+                self._remove(key)
+                entry = None
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            self.exact_hits += 1
+            record_cache("query", "exact")
+            return entry.result
+
+    def get_similar(self, query: str, scope: Hashable, version: Hashable,
+                    embedding=None) -> Optional[Any]:
+        """
+        Look a query up in the semantic layer after an exact miss
+
+        Args:
+            query: The query string
+            scope: Everything besides the query that determines the result
+            version: Current version of the index
+            embedding: Query embedding (None, or a disabled semantic layer,
+                just records the miss)
+
+        Returns:
+            The result of the most similar cached query, or None
+        """
+        with self._lock:
+            self._set_version(version)
+            if self.semantic and embedding is not None:
+                match = self._nearest(scope, self._unit(embedding), _identifiers(query))
+                if match is not None:
+                    self._entries.move_to_end(match)
+                    self.semantic_hits += 1
+                    record_cache("query", "semantic")
+                    return self._entries[match].result
+            self.misses += 1
+            record_cache("query", "miss")
+            return None
+
+    def _nearest(self, scope: Hashable, vector: np.ndarray,
+                 identifiers: frozenset) -> Optional[Tuple[str, Hashable]]:
+        """Most similar live entry of a scope above the threshold"""
+        entries = self._scopes.get(scope)
+        if entries is None or not entries.keys:
+            return None
+        similarities = entries.matrix[:len(entries.keys)] @ vector
+        candidates = np.flatnonzero(similarities >= self.similarity_threshold)
+        for position in candidates[np.argsort(-similarities[candidates])]:
+            entry = self._entries[entries.keys[position]]
+            if entry.identifiers == identifiers and not self._expired(entry):
+                return entries.keys[position]
+        return None
+
+    def put(self, query: str, scope: Hashable, version: Hashable, result: Any,
+            embedding=None) -> None:
+        """
+        Store the result of a query
+
+        Args:
+            query: The query string
+            scope: Everything besides the query that determines the result
+            version: Index version the result was computed against
+            result: The value to cache
+            embedding: Query embedding, indexed by the semantic layer
+        """
+        key = (normalize_query(query), scope)
+        with self._lock:
+            self._set_version(version)
+            self._remove(key)
+            vector = self._unit(embedding) if self.semantic and embedding is not None else None
+            self._entries[key] = _Entry(result, vector, _identifiers(query), time.time())
+            if vector is not None:
+                self._scopes.setdefault(scope, _Scope()).add(key, vector)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        """Drop every cached result"""
+        with self._lock:
+            self._entries.clear()
+            self._scopes.clear()
+
+    def stats(self) -> Dict[str, float]:
+        """Return exact/semantic hits, misses, hit rate and entry count"""
+        with self._lock:
+            hits = self.exact_hits + self.semantic_hits
+            lookups = hits + self.misses
+            return {
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+            }
+
+
+_caches: Dict[str, QueryCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_query_cache(index_name: str) -> QueryCache:
+    """Return the process-wide result cache of an index"""
+    with _caches_lock:
+        if index_name not in _caches:
+            _caches[index_name] = QueryCache()
+        return _caches[index_name]
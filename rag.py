@@ -2,42 +2,94 @@
 """
 Retrieval Augmented Generation components
 """
-from typing import List, Dict, Any, Optional
-from langchain.schema import Document
-from vectorstore_utils import load_vectorstore, similarity_search
+import json
+import os
+import time
+from typing import List, Dict, Any, Iterator, Optional, Tuple
+import numpy as np
+from langchain_core.documents import Document
+from vectorstore_utils import (similarity_search, similarity_search_many,
+                                keyword_search, hybrid_search, hybrid_search_many,
+                                FUSION_METHODS, MANIFEST_FILE, read_manifest)
+from sharded_index import ShardedIndex, load_index, search_shards
+from embedding_utils import encode_query, encode_queries
+from reranker import get_reranker
+from query_cache import QueryCache, get_query_cache
+from context_builder import (ContextBuilder, DEFAULT_CONTEXT_TOKENS,
+                             DEFAULT_DUPLICATE_THRESHOLD)
+from metrics import span, record_batch_size, record_duration
+
+# Retrieval strategies of DocumentRetriever
+SEARCH_MODES = ("vector", "keyword", "hybrid")
 
 class DocumentRetriever:
     """Class for retrieving relevant documents from a vector store"""
     
-    def __init__(self, index_name: str = "faiss_index", model_name: str = "all-MiniLM-L6-v2"):
+    def __init__(self, index_name: str = "faiss_index", model_name: str = "all-MiniLM-L6-v2",
+                 nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                 search_mode: str = "vector", fusion: str = "rrf",
+                 vector_weight: float = 0.5, vectorstore=None,
+                 shard_processes: int = 0):
         """
         Initialize the retriever
         
         Args:
             index_name: Path to the FAISS index
             model_name: SentenceTransformer model to use
+            nprobe: IVF lists visited per query (None uses the index default)
+            ef_search: HNSW search depth (None uses the index default)
+            search_mode: vector (embeddings), keyword (BM25) or hybrid (both, fused)
+            fusion: How hybrid mode merges rankings: rrf or weighted
+            vector_weight: Share of the vector score in weighted fusion
+            vectorstore: Already loaded vector store (or ShardedIndex) of
+                index_name to use instead of loading it on first retrieval
+            shard_processes: Worker processes searching the shards of a
+                sharded index (0 searches them on threads in this process)
         """
+        if search_mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode '{search_mode}', expected one of {SEARCH_MODES}")
+        if fusion not in FUSION_METHODS:
+            raise ValueError(f"Unknown fusion method '{fusion}', expected one of {FUSION_METHODS}")
         self.index_name = index_name
         self.model_name = model_name
-        self.vectorstore = None
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.search_mode = search_mode
+        self.fusion = fusion
+        self.vector_weight = vector_weight
+        self.vectorstore = vectorstore
+        self.shard_processes = shard_processes
         
     def load(self) -> bool:
         """
-        Load the vector store
+        Load the vector store, or the shards of a sharded index
         
         Returns:
             True if loaded successfully, False otherwise
         """
-        self.vectorstore = load_vectorstore(self.index_name)
+        self.vectorstore = load_index(self.index_name, self.model_name, self.shard_processes)
+        if isinstance(self.vectorstore, ShardedIndex):
+            has_keyword_index = self.vectorstore.has_keyword_index()
+        else:
+            has_keyword_index = getattr(self.vectorstore, "keyword_index", None) is not None
+        if (self.vectorstore is not None and self.search_mode != "vector"
+                and not has_keyword_index):
+            print("Keyword index not found; re-ingest the documents to enable "
+                  f"{self.search_mode} search")
         return self.vectorstore is not None
         
-    def retrieve(self, query: str, k: int = 5) -> List[Document]:
+    def retrieve(self, query: str, k: int = 5,
+                 filter: Optional[Dict[str, Any]] = None,
+                 query_embedding=None) -> List[Document]:
         """
         Retrieve relevant documents for a query
         
         Args:
             query: The user's query string
             k: Number of documents to retrieve
+            filter: Only return chunks whose metadata matches, e.g.
+                {"source": "handbook.pdf"} or {"page": {"$gte": 3, "$lte": 5}}
+            query_embedding: Precomputed query embedding (skips encoding)
             
         Returns:
             List of relevant Document objects
@@ -47,7 +99,62 @@ class DocumentRetriever:
                 print("Error: Vector store not loaded")
                 return []
                 
-        return similarity_search(query, self.vectorstore, k, self.model_name)
+        with span("retrieve", mode=self.search_mode, k=k):
+            if isinstance(self.vectorstore, ShardedIndex):
+                embeddings = None if query_embedding is None else [query_embedding]
+                return self._search_shards([query], k, 1, filter, embeddings)[0]
+            if self.search_mode == "keyword":
+                return keyword_search(query, self.vectorstore, k, filter)
+            if self.search_mode == "hybrid":
+                return hybrid_search(query, self.vectorstore, k, self.model_name, self.nprobe,
+                                     self.ef_search, filter, self.fusion, self.vector_weight,
+                                     query_embedding=query_embedding)
+            return similarity_search(query, self.vectorstore, k, self.model_name,
+                                     self.nprobe, self.ef_search, filter, query_embedding)
+        
+    def retrieve_many(self, queries: List[str], k: int = 5,
+                      batch_size: int = 256,
+                      filter: Optional[Dict[str, Any]] = None,
+                      embeddings=None) -> List[List[Document]]:
+        """
+        Retrieve relevant documents for many queries at once
+        
+        Args:
+            queries: The query strings
+            k: Number of documents to retrieve per query
+            batch_size: Number of queries encoded and searched together
+            filter: Only return chunks whose metadata matches (applies to every query)
+            embeddings: Precomputed query embeddings, one row per query
+            
+        Returns:
+            One list of Document objects per query, in input order
+        """
+        if not self.vectorstore:
+            if not self.load():
+                print("Error: Vector store not loaded")
+                return [[] for _ in queries]
+                
+        with span("retrieve", mode=self.search_mode, k=k, queries=len(queries)):
+            if isinstance(self.vectorstore, ShardedIndex):
+                return self._search_shards(queries, k, batch_size, filter, embeddings)
+            if self.search_mode == "keyword":
+                return [keyword_search(query, self.vectorstore, k, filter) for query in queries]
+            if self.search_mode == "hybrid":
+                return hybrid_search_many(queries, self.vectorstore, k, self.model_name,
+                                          batch_size, self.nprobe, self.ef_search, filter,
+                                          self.fusion, self.vector_weight, embeddings=embeddings)
+            return similarity_search_many(queries, self.vectorstore, k,
+                                          self.model_name, batch_size,
+                                          self.nprobe, self.ef_search, filter, embeddings)
+        
+    def _search_shards(self, queries: List[str], k: int, batch_size: int,
+                       filter: Optional[Dict[str, Any]], embeddings) -> List[List[Document]]:
+        """Search every shard of a sharded index in parallel and merge the results"""
+        if embeddings is not None:
+            embeddings = np.asarray(embeddings, dtype="float32")
+        return search_shards(queries, self.vectorstore, k, self.model_name, batch_size,
+                             self.nprobe, self.ef_search, filter, self.search_mode,
+                             self.fusion, self.vector_weight, embeddings=embeddings)
         
     def format_retrieval_results(self, docs: List[Document]) -> str:
         """
@@ -67,7 +174,14 @@ class DocumentRetriever:
             # Extract metadata if available
             metadata = ""
             if hasattr(doc, 'metadata') and doc.metadata:
-                metadata = f" [Source: {doc.metadata.get('source', 'Unknown')}]"
+                details = [f"Source: {doc.metadata.get('source', 'Unknown')}"]
+                if doc.metadata.get('page') is not None:
+                    details.append(f"Page: {doc.metadata['page']}")
+                if doc.metadata.get('score') is not None:
+                    details.append(f"Score: {doc.metadata['score']:.3f}")
+                if doc.metadata.get('rerank_score') is not None:
+                    details.append(f"Rerank: {doc.metadata['rerank_score']:.3f}")
+                metadata = f" [{', '.join(details)}]"
                 
             result.append(f"Document {i+1}{metadata}:\n{doc.page_content}\n")
             
@@ -76,45 +190,362 @@ class DocumentRetriever:
 class RAGSystem:
     """Complete RAG system with retrieval and optional answer generation"""
     
-    def __init__(self, index_name: str = "faiss_index", llm=None):
+    def __init__(self, index_name: str = "faiss_index", llm=None,
+                 model_name: str = "all-MiniLM-L6-v2",
+                 rerank_model: Optional[str] = None,
+                 rerank_candidates: int = 50,
+                 rerank_budget_ms: Optional[float] = None,
+                 rerank_batch_size: int = 32,
+                 use_cache: bool = True,
+                 query_cache: Optional[QueryCache] = None,
+                 context_tokens: Optional[int] = DEFAULT_CONTEXT_TOKENS,
+                 duplicate_threshold: Optional[float] = DEFAULT_DUPLICATE_THRESHOLD,
+                 **retriever_options):
         """
         Initialize the RAG system
         
         Args:
             index_name: Path to the FAISS index
             llm: Optional language model for answer generation
+            model_name: SentenceTransformer model used for query embeddings
+            rerank_model: Cross-encoder that reorders the retrieved candidates
+                (None disables reranking)
+            rerank_candidates: Candidates fetched per query for reranking
+            rerank_budget_ms: Time after which reranking stops scoring new
+                batches (None scores every candidate)
+            rerank_batch_size: Candidates scored per cross-encoder forward pass
+            use_cache: Reuse results of identical and near-identical queries
+            query_cache: Result cache to use (defaults to the process-wide
+                cache of this index)
+            context_tokens: Token budget of the LLM context (None means unlimited)
+            duplicate_threshold: Shingle overlap above which a retrieved chunk
+                is left out of the context as a near-duplicate (None keeps all)
+            **retriever_options: Extra DocumentRetriever settings (e.g. nprobe,
+                search_mode)
         """
-        self.retriever = DocumentRetriever(index_name)
+        self.retriever = DocumentRetriever(index_name, model_name, **retriever_options)
         self.llm = llm  # Can be None for retrieval-only mode
+        self.reranker = get_reranker(rerank_model) if rerank_model else None
+        self.rerank_candidates = rerank_candidates
+        self.rerank_budget_ms = rerank_budget_ms
+        self.rerank_batch_size = rerank_batch_size
+        self.cache = (query_cache or get_query_cache(index_name)) if use_cache else None
+        self.context_builder = ContextBuilder(context_tokens, duplicate_threshold,
+                                              getattr(llm, "tokenizer", None))
+        self._manifest_mtime = None
+        self._index_version = None
         
-    def query(self, user_query: str, k: int = 5) -> Dict[str, Any]:
+    def query(self, user_query: str, k: int = 5,
+              filter: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """
         Process a user query through the RAG pipeline
         
         Args:
             user_query: The user's question
             k: Number of documents to retrieve
+            filter: Only retrieve chunks whose metadata matches these conditions
+            
+        Returns:
+            Dictionary with retrieved documents and generated answer (if LLM is
+            available); "cache" is "exact" or "semantic" for cached results
+        """
+        with span("query", k=k) as current:
+            result, cache_entry = self._retrieve_result(user_query, k, filter)
+            if result["answer"] is None and self.llm and result["retrieved_docs"]:
+                if not self._generate(result):
+                    cache_entry = None
+            if cache_entry is not None:
+                self.cache.put(user_query, *cache_entry[:2], result, cache_entry[2])
+            current.set(cache=result["cache"], docs=len(result["retrieved_docs"]))
+            return result
+        
+    def stream_query(self, user_query: str, k: int = 5,
+                     filter: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Retrieve documents, then stream the answer as it is generated
+        
+        Retrieval happens before this returns, so the documents can be shown
+        while the LLM is still working. The answer is produced lazily by
+        iterating result["answer_stream"]; closing that iterator early
+        cancels generation. Once it is exhausted, result["answer"] holds the
+        full text and the result is cached.
+        
+        Args:
+            user_query: The user's question
+            k: Number of documents to retrieve
+            filter: Only retrieve chunks whose metadata matches these conditions
             
         Returns:
-            Dictionary with retrieved documents and generated answer (if LLM is available)
+            Result dictionary as from query, plus "answer_stream"
+        """
+        with span("query", k=k, stream=True) as current:
+            result, cache_entry = self._retrieve_result(user_query, k, filter)
+            current.set(cache=result["cache"], docs=len(result["retrieved_docs"]))
+        if result["answer"] is not None or not (self.llm and result["retrieved_docs"]):
+            if cache_entry is not None:
+                self.cache.put(user_query, *cache_entry[:2], result, cache_entry[2])
+            result["answer_stream"] = iter([result["answer"]] if result["answer"] else [])
+            return result
+        
+        def tokens() -> Iterator[str]:
+            parts = []
+            # Timed by hand, since the consumer runs in between the tokens
+            start = time.perf_counter()
+            try:
+                for token in self.llm.stream_answer(user_query, self._context(result)):
+                    parts.append(token)
+                    yield token
+            except Exception as e:
+                record_duration("generate", time.perf_counter() - start, str(e), stream=True)
+                print(f"Error generating answer: {e}")
+                result["answer"] = "".join(parts) + f"\n[Error generating answer: {e}]"
+                yield f"\n[Error generating answer: {e}]"
+                return
+            except GeneratorExit:
+                record_duration("generate", time.perf_counter() - start, stream=True,
+                                cancelled=True)
+                raise
+            record_duration("generate", time.perf_counter() - start, stream=True,
+                            tokens=len(parts))
+            result["answer"] = "".join(parts)
+            if cache_entry is not None:
+                cached = {key: value for key, value in result.items() if key != "answer_stream"}
+                self.cache.put(user_query, *cache_entry[:2], cached, cache_entry[2])
+        
+        result["answer_stream"] = tokens()
+        return result
+        
+    def _retrieve_result(self, user_query: str, k: int,
+                         filter: Optional[Dict[str, Any]]) -> Tuple[Dict[str, Any], Optional[tuple]]:
         """
+        Cached result of a query, or a freshly retrieved one without an answer
+        
+        Returns:
+            The result and, for fresh results that should be cached once
+            answered, (scope, version, embedding); otherwise None
+        """
+        # Checked with or without the cache: a new version reloads the index
+        version = self._current_version()
+        if self.cache is None:
+            docs = self.retriever.retrieve(user_query, self._fetch_k(k), filter)
+            return self._build_result(user_query, self._rerank(user_query, docs, k)), None
+        
+        scope = self._cache_scope(k, filter)
+        cached = self.cache.get_exact(user_query, scope, version)
+        if cached is not None:
+            return dict(cached, query=user_query, cache="exact"), None
+        embedding = encode_query(user_query, self.retriever.model_name) if self.cache.semantic else None
+        cached = self.cache.get_similar(user_query, scope, version, embedding)
+        if cached is not None:
+            return dict(cached, query=user_query, cache="semantic"), None
+        
         # Retrieve relevant documents
-        docs = self.retriever.retrieve(user_query, k)
+        docs = self.retriever.retrieve(user_query, self._fetch_k(k), filter, embedding)
+        result = self._build_result(user_query, self._rerank(user_query, docs, k))
+        return result, (scope, version, embedding)
+        
+    def query_many(self, user_queries: List[str], k: int = 5,
+                   batch_size: int = 256,
+                   filter: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """
+        Process many queries with batched retrieval
         
+        Args:
+            user_queries: The user questions
+            k: Number of documents to retrieve per query
+            batch_size: Number of queries encoded and searched together
+            filter: Only retrieve chunks whose metadata matches these conditions
+            
+        Returns:
+            One result dictionary per query, in input order
+        """
+        record_batch_size("query_many", len(user_queries))
+        with span("query_many", k=k, queries=len(user_queries)):
+            return self._query_many(user_queries, k, batch_size, filter)
+        
+    def _query_many(self, user_queries: List[str], k: int, batch_size: int,
+                    filter: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Body of query_many"""
+        version = self._current_version()
+        if self.cache is None:
+            all_docs = self.retriever.retrieve_many(user_queries, self._fetch_k(k),
+                                                    batch_size, filter)
+            results = [self._build_result(user_query, self._rerank(user_query, docs, k))
+                       for user_query, docs in zip(user_queries, all_docs)]
+            if self.llm:
+                for result in results:
+                    if result["retrieved_docs"]:
+                        self._generate(result)
+            return results
+        
+        scope = self._cache_scope(k, filter)
+        results: List[Optional[Dict[str, Any]]] = []
+        for user_query in user_queries:
+            cached = self.cache.get_exact(user_query, scope, version)
+            results.append(None if cached is None
+                           else dict(cached, query=user_query, cache="exact"))
+        
+        missing = [i for i, result in enumerate(results) if result is None]
+        embeddings = (encode_queries([user_queries[i] for i in missing],
+                                     self.retriever.model_name, batch_size)
+                      if self.cache.semantic and missing else None)
+        unanswered = []
+        for row, i in enumerate(missing):
+            cached = self.cache.get_similar(user_queries[i], scope, version,
+                                            None if embeddings is None else embeddings[row])
+            if cached is None:
+                unanswered.append(row)
+            else:
+                results[i] = dict(cached, query=user_queries[i], cache="semantic")
+        
+        if unanswered:
+            all_docs = self.retriever.retrieve_many(
+                [user_queries[missing[row]] for row in unanswered], self._fetch_k(k),
+                batch_size, filter, None if embeddings is None else embeddings[unanswered])
+            for row, docs in zip(unanswered, all_docs):
+                i = missing[row]
+                results[i] = self._build_result(user_queries[i],
+                                                self._rerank(user_queries[i], docs, k))
+                if self.llm and docs and not self._generate(results[i]):
+                    continue
+                self.cache.put(user_queries[i], scope, version, results[i],
+                               None if embeddings is None else embeddings[row])
+        return results
+        
+    def cache_stats(self) -> Dict[str, float]:
+        """Hit/miss counters and hit rate of the result cache ({} when disabled)"""
+        return self.cache.stats() if self.cache is not None else {}
+        
+    def reload(self) -> bool:
+        """
+        Load the current index from disk, e.g. after it was re-ingested
+        
+        Returns:
+            True if loaded successfully, False otherwise
+        """
+        self._current_version()
+        return self.retriever.load()
+        
+    def with_index(self, index_name: str) -> "RAGSystem":
+        """
+        A RAG system with every setting of this one over another index
+        
+        The LLM, reranker and context builder are shared; the result cache
+        is the one of the other index.
+        
+        Args:
+            index_name: Path to the other index
+            
+        Returns:
+            A new RAGSystem (this one is left unchanged)
+        """
+        retriever = self.retriever
+        other = RAGSystem(index_name, llm=self.llm, model_name=retriever.model_name,
+                          rerank_candidates=self.rerank_candidates,
+                          rerank_budget_ms=self.rerank_budget_ms,
+                          rerank_batch_size=self.rerank_batch_size,
+                          use_cache=self.cache is not None,
+                          nprobe=retriever.nprobe, ef_search=retriever.ef_search,
+                          search_mode=retriever.search_mode, fusion=retriever.fusion,
+                          vector_weight=retriever.vector_weight,
+                          shard_processes=retriever.shard_processes)
+        other.reranker = self.reranker
+        other.context_builder = self.context_builder
+        return other
+        
+    def _current_version(self) -> Optional[int]:
+        """
+        Version of the index on disk, re-read only when its manifest changes
+        
+        A new version also makes the retriever reload the index, so results
+        are never computed from (or cached for) a stale copy.
+        """
+        path = os.path.join(self.retriever.index_name, MANIFEST_FILE)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        if mtime != self._manifest_mtime:
+            version = read_manifest(self.retriever.index_name).get("version")
+            if self._manifest_mtime is not None and version != self._index_version:
+                self.retriever.vectorstore = None
+            self._manifest_mtime = mtime
+            self._index_version = version
+        return self._index_version
+        
+    def _cache_scope(self, k: int, filter: Optional[Dict[str, Any]]) -> tuple:
+        """Everything besides the query text that determines a result"""
+        retriever = self.retriever
+        return (k, json.dumps(filter, sort_keys=True, default=str), retriever.model_name,
+                retriever.search_mode, retriever.fusion, retriever.vector_weight,
+                retriever.nprobe, retriever.ef_search,
+                self.reranker.model_name if self.reranker else None,
+                self.rerank_candidates, self.rerank_budget_ms, self._llm_scope(),
+                self.context_builder.max_tokens, self.context_builder.duplicate_threshold,
+                getattr(self.context_builder.tokenizer, "name_or_path", None))
+        
+    def _llm_scope(self) -> Optional[tuple]:
+        """Identity of the LLM, so answers of one model are not served for another"""
+        if self.llm is None:
+            return None
+        return (type(self.llm).__name__, getattr(self.llm, "model_name", None),
+                getattr(self.llm, "base_url", None))
+        
+    def _fetch_k(self, k: int) -> int:
+        """Number of first-stage candidates to retrieve for k results"""
+        return max(k, self.rerank_candidates) if self.reranker else k
+        
+    def _rerank(self, user_query: str, docs: List[Document], k: int) -> List[Document]:
+        """Keep the k best candidates by cross-encoder score, if reranking is enabled"""
+        if not self.reranker or not docs:
+            return docs[:k]
+        try:
+            with span("rerank", candidates=len(docs)):
+                return self.reranker.rerank(user_query, docs, k, self.rerank_batch_size,
+                                            self.rerank_budget_ms)
+        except Exception as e:
+            print(f"Error during reranking: {e}")
+            return docs[:k]
+        
+    def _build_result(self, user_query: str, docs: List[Document]) -> Dict[str, Any]:
+        """Assemble the result dictionary for one query"""
+        with span("format", docs=len(docs)):
+            formatted_docs = self.retriever.format_retrieval_results(docs)
         result = {
             "query": user_query,
             "retrieved_docs": docs,
-            "formatted_docs": self.retriever.format_retrieval_results(docs),
-            "answer": None
+            "formatted_docs": formatted_docs,
+            "answer": None,
+            "context_stats": None,
+            "cache": None
         }
+        return result
         
-        # Generate answer if LLM is available
-        if self.llm and docs:
-            # This is where you would integrate with a local LLM
-            # For now, we'll leave this as a placeholder
-            context = "\n\n".join([doc.page_content for doc in docs])
-            # result["answer"] = self.llm.generate_answer(user_query, context)
-            # For now, just note that generation is not implemented
-            result["answer"] = "(Answer generation requires an LLM integration)"
-            
-        return result
\ No newline at end of file
+    def _context(self, result: Dict[str, Any]) -> str:
+        """
+        LLM context packed from the retrieved documents of a result
+        
+        Packing statistics (tokens used and saved, chunks dropped) are
+        recorded in result["context_stats"].
+        """
+        with span("build_context", docs=len(result["retrieved_docs"])):
+            context, result["context_stats"] = self.context_builder.build(
+                result["retrieved_docs"])
+        return context
+        
+    def _generate(self, result: Dict[str, Any]) -> bool:
+        """
+        Fill in the answer of a result with the LLM
+        
+        Returns:
+            True if generation succeeded (failed answers are not cached)
+        """
+        try:
+            context = self._context(result)
+            with span("generate"):
+                result["answer"] = "".join(self.llm.stream_answer(result["query"], context))
+            return True
+        except Exception as e:
+            print(f"Error generating answer: {e}")
+            result["answer"] = f"Error generating answer: {e}"
+            return False
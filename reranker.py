@@ -0,0 +1,149 @@
+# reranker.py
+"""
+Cross-encoder reranking of retrieved chunks
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from langchain_core.documents import Document
+from embedding_cache import text_key
+
+DEFAULT_RERANK_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+# Number of (query, chunk) scores remembered per reranker
+DEFAULT_SCORE_CACHE_SIZE = 50000
+
+
+class CrossEncoderReranker:
+    """
+    Scores (query, chunk) pairs with a local cross-encoder and keeps the best
+
+    Scores are cached per (query, chunk) in an LRU, so repeated or refined
+    queries over the same candidates only score new pairs. Candidates are
+    scored in first-stage order, one batch at a time; when a time budget is
+    given and the next batch would exceed it, the remaining candidates keep
+    their first-stage order behind the scored ones. The first batch is always
+    scored.
+    """
+
+    def __init__(self, model_name: str = DEFAULT_RERANK_MODEL,
+                 device: Optional[str] = None,
+                 cache_size: int = DEFAULT_SCORE_CACHE_SIZE):
+        """
+        Initialize the reranker (the model is loaded on first use)
+
+        Args:
+            model_name: Hugging Face cross-encoder model
+            device: Torch device to run the model on
+            cache_size: Maximum number of cached (query, chunk) scores
+        """
+        self.model_name = model_name
+        self.device = device
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self.truncated = 0
+        self._model = None
+        self._scores: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        if self._model is None:
+            from sentence_transformers import CrossEncoder
+            self._model = CrossEncoder(self.model_name, device=self.device)
+        return self._model
+
+    @staticmethod
+    def _chunk_key(doc: Document) -> str:
+        chunk_id = (doc.metadata or {}).get("id")
+        return str(chunk_id) if chunk_id is not None else text_key(doc.page_content)
+
+    def rerank(self, query: str, docs: List[Document], k: int,
+               batch_size: int = 32,
+               time_budget_ms: Optional[float] = None) -> List[Document]:
+        """
+        Reorder candidates by cross-encoder relevance and keep the top k
+
+        Args:
+            query: The query string
+            docs: First-stage candidates, best first
+            k: Number of documents to keep
+            batch_size: Pairs scored per forward pass
+            time_budget_ms: Stop scoring new batches once this much time has
+                been spent (None scores every candidate)
+
+        Returns:
+            Up to k documents; scored ones carry "rerank_score" in their metadata
+        """
+        start = time.perf_counter()
+        query_key = text_key(query)
+        keys = [(query_key, self._chunk_key(doc)) for doc in docs]
+        scores: List[Optional[float]] = [None] * len(docs)
+        with self._lock:
+            for i, key in enumerate(keys):
+                if key in self._scores:
+                    self._scores.move_to_end(key)
+                    scores[i] = self._scores[key]
+            self.hits += sum(score is not None for score in scores)
+
+        pending = [i for i, score in enumerate(scores) if score is None]
+        batch_seconds = 0.0
+        for offset in range(0, len(pending), batch_size):
+            if time_budget_ms is not None and offset:
+                elapsed = time.perf_counter() - start
+                if (elapsed + batch_seconds) * 1000.0 > time_budget_ms:
+                    with self._lock:
+                        self.truncated += 1
+                    break
+            batch = pending[offset:offset + batch_size]
+            batch_start = time.perf_counter()
+            predicted = self.model.predict([(query, docs[i].page_content) for i in batch],
+                                           batch_size=batch_size, show_progress_bar=False)
+            batch_seconds = time.perf_counter() - batch_start
+            with self._lock:
+                for i, score in zip(batch, predicted):
+                    scores[i] = float(score)
+                    self._scores[keys[i]] = scores[i]
+                self.misses += len(batch)
+                while len(self._scores) > self.cache_size:
+                    self._scores.popitem(last=False)
+
+        scored = sorted((i for i, score in enumerate(scores) if score is not None),
+                        key=lambda i: scores[i], reverse=True)
+        unscored = [i for i, score in enumerate(scores) if score is None]
+        results = []
+        for i in (scored + unscored)[:k]:
+            doc = docs[i]
+            metadata = dict(doc.metadata or {})
+            if scores[i] is not None:
+                metadata["rerank_score"] = scores[i]
+            results.append(type(doc)(page_content=doc.page_content, metadata=metadata))
+        return results
+
+    def stats(self) -> Dict[str, float]:
+        """Return score cache hits/misses, hit rate and budget truncations"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "truncated": self.truncated,
+                "entries": len(self._scores),
+            }
+
+
+_rerankers: Dict[Tuple[str, Optional[str]], CrossEncoderReranker] = {}
+_rerankers_lock = threading.Lock()
+
+
+def get_reranker(model_name: str = DEFAULT_RERANK_MODEL,
+                 device: Optional[str] = None) -> CrossEncoderReranker:
+    """Return the process-wide reranker of a model, so its score cache is shared"""
+    with _rerankers_lock:
+        key = (model_name, device)
+        if key not in _rerankers:
+            _rerankers[key] = CrossEncoderReranker(model_name, device)
+        return _rerankers[key]
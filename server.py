@@ -0,0 +1,548 @@
+# server.py
+"""
+Async HTTP query service around a shared RAGSystem
+
+Concurrent /query requests are collected into micro-batches, so one
+embedding forward pass and one FAISS search serve many users. Several
+worker processes can share one port; they memory-map the same index, so
+its pages are held once in the OS page cache.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from aiohttp import web
+from rag import RAGSystem, SEARCH_MODES
+from vectorstore_utils import FUSION_METHODS
+from index_factory import INDEX_TYPES
+from ingest import process_documents, expand_inputs
+from llm_integration import OllamaLLM, DEFAULT_OLLAMA_URL, LLMError
+from context_builder import ContextBuilder, DEFAULT_CONTEXT_TOKENS
+from embedding_utils import (warmup_embedding_model, set_embedding_backend,
+                             EMBEDDING_BACKENDS, DEFAULT_BACKEND)
+from metrics import (enable_metrics, metrics_enabled, render_prometheus,
+                     record_batch_size, record_duration)
+
+try:
+    import fcntl
+except ImportError:  # Windows: single worker only
+    fcntl = None
+
+DEFAULT_MAX_BATCH_SIZE = 64
+DEFAULT_MAX_WAIT_MS = 5.0
+
+# Largest k and batch accepted from a client
+MAX_K = 100
+MAX_QUERIES_PER_REQUEST = 1024
+
+
+class MicroBatcher:
+    """
+    Groups concurrently submitted items into batches for one worker thread
+
+    The first item of a batch waits at most max_wait_ms for others to
+    arrive; a batch is cut as soon as it holds max_batch_size items. While
+    a batch is being processed, new items queue up and form the next one,
+    so under load batches fill without any waiting.
+    """
+
+    def __init__(self, process: Callable[[List[Any]], List[Any]],
+                 executor: ThreadPoolExecutor,
+                 max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+                 max_wait_ms: float = DEFAULT_MAX_WAIT_MS):
+        """
+        Initialize the batcher (call start() from the event loop)
+
+        Args:
+            process: Maps a list of items to a list of results, in order
+            executor: Thread pool that runs process
+            max_batch_size: Maximum items per batch
+            max_wait_ms: Maximum time the first item waits for a batch to fill
+        """
+        self.process = process
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.batches = 0
+        self.items = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._queue = asyncio.Queue()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def submit(self, item: Any) -> Any:
+        """Queue an item and wait for its result"""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait_ms / 1000.0
+            while len(batch) < self.max_batch_size:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            batch = [(item, future) for item, future in batch if not future.cancelled()]
+            if not batch:
+                continue
+            self.batches += 1
+            self.items += len(batch)
+            record_batch_size("micro_batch", len(batch))
+            try:
+                results = await loop.run_in_executor(self.executor, self.process,
+                                                     [item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def stats(self) -> Dict[str, float]:
+        """Return the number of batches and the mean batch size"""
+        return {"batches": self.batches, "queries": self.items,
+                "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+                "queued": self._queue.qsize() if self._queue is not None else 0}
+
+
+class QueryService:
+    """
+    One RAGSystem per process shared by every request
+
+    Retrieval (embedding, FAISS, reranking) runs on a single worker thread
+    fed by the micro-batcher; answers, when an LLM is configured, are
+    generated concurrently on the event loop. Ingestion runs on its own
+    thread, one job at a time, and queries pick up the new index version
+    as soon as it is written.
+    """
+
+    def __init__(self, rag: RAGSystem, llm: Optional[OllamaLLM] = None,
+                 max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+                 max_wait_ms: float = DEFAULT_MAX_WAIT_MS,
+                 ingest_root: Optional[str] = None):
+        """
+        Initialize the service
+
+        Args:
+            rag: Retrieval-only RAG system (its llm is not used)
+            llm: Optional LLM that answers each query
+            max_batch_size: Maximum queries per micro-batch
+            max_wait_ms: Maximum time a query waits for its batch to fill
+            ingest_root: Folder whose files /ingest may read by path (None
+                only accepts documents sent in the request)
+        """
+        self.rag = rag
+        self.llm = llm
+        self.ingest_root = os.path.realpath(ingest_root) if ingest_root else None
+        self.search_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="search")
+        self.ingest_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest")
+        self.batcher = MicroBatcher(self._search_batch, self.search_executor,
+                                    max_batch_size, max_wait_ms)
+        self._ingest_lock: Optional[asyncio.Lock] = None
+
+    def _search_batch(self, items: List[Tuple[str, int, Optional[Dict]]]) -> List[Dict]:
+        """Retrieve a micro-batch, one query_many call per (k, filter) group"""
+        groups: Dict[Tuple[int, str], List[int]] = {}
+        for i, (_, k, filter) in enumerate(items):
+            groups.setdefault((k, json.dumps(filter, sort_keys=True)), []).append(i)
+        results: List[Optional[Dict]] = [None] * len(items)
+        for positions in groups.values():
+            _, k, filter = items[positions[0]]
+            for i, result in zip(positions, self.rag.query_many(
+                    [items[i][0] for i in positions], k, len(positions), filter)):
+                results[i] = result
+        return results
+
+    async def _answer(self, result: Dict[str, Any]) -> Dict[str, Any]:
+        if self.llm is not None and result["retrieved_docs"]:
+            # The fresh result object is also the cached one
+            result = dict(result)
+            context, result["context_stats"] = self.rag.context_builder.build(
+                result["retrieved_docs"])
+            # Coroutines interleave on the loop thread, so spans are timed by hand
+            start = time.perf_counter()
+            try:
+                result["answer"] = await self.llm.agenerate_answer(result["query"], context)
+                record_duration("generate", time.perf_counter() - start)
+            except LLMError as e:
+                record_duration("generate", time.perf_counter() - start, str(e))
+                result["answer"] = f"Error generating answer: {e}"
+        return result
+
+    @staticmethod
+    def _to_json(result: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "query": result["query"],
+            "documents": [{"page_content": doc.page_content, "metadata": doc.metadata}
+                          for doc in result["retrieved_docs"]],
+            "answer": result.get("answer"),
+            "cache": result.get("cache"),
+            "context_stats": result.get("context_stats"),
+        }
+
+    @staticmethod
+    def _query_options(body: Dict[str, Any]) -> Tuple[int, Optional[Dict]]:
+        k = body.get("k", 5)
+        filter = body.get("filter")
+        if not isinstance(k, int) or not 1 <= k <= MAX_K:
+            raise ValueError(f"k must be an integer between 1 and {MAX_K}")
+        if filter is not None and not isinstance(filter, dict):
+            raise ValueError("filter must be an object")
+        return k, filter
+
+    @staticmethod
+    async def _body(request: web.Request) -> Dict[str, Any]:
+        try:
+            body = await request.json()
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid JSON: {e}")
+        if not isinstance(body, dict):
+            raise ValueError("Request body must be a JSON object")
+        return body
+
+    @staticmethod
+    def _error(message: str, status: int = 400) -> web.Response:
+        return web.json_response({"error": message}, status=status)
+
+    async def query(self, request: web.Request) -> web.Response:
+        """POST /query {"query": str, "k": int, "filter": {...}}"""
+        try:
+            body = await self._body(request)
+            k, filter = self._query_options(body)
+            query = body.get("query")
+            if not isinstance(query, str) or not query.strip():
+                raise ValueError("query must be a non-empty string")
+        except ValueError as e:
+            return self._error(str(e))
+        start = time.perf_counter()
+        try:
+            result = await self.batcher.submit((query, k, filter))
+            result = await self._answer(result)
+        except Exception as e:
+            record_duration("http_query", time.perf_counter() - start, str(e))
+            print(f"Error answering query: {e}")
+            return self._error(f"Error answering query: {e}", 500)
+        record_duration("http_query", time.perf_counter() - start, cache=result.get("cache"))
+        return web.json_response(self._to_json(result))
+
+    async def query_batch(self, request: web.Request) -> web.Response:
+        """POST /query_batch {"queries": [str, ...], "k": int, "filter": {...}}"""
+        try:
+            body = await self._body(request)
+            k, filter = self._query_options(body)
+            queries = body.get("queries")
+            if (not isinstance(queries, list) or not queries
+                    or not all(isinstance(q, str) and q.strip() for q in queries)):
+                raise ValueError("queries must be a non-empty list of non-empty strings")
+            if len(queries) > MAX_QUERIES_PER_REQUEST:
+                raise ValueError(f"At most {MAX_QUERIES_PER_REQUEST} queries per request")
+        except ValueError as e:
+            return self._error(str(e))
+        start = time.perf_counter()
+        try:
+            # Already a batch, so it skips the micro-batcher
+            results = await asyncio.get_running_loop().run_in_executor(
+                self.search_executor, self._search_batch, [(q, k, filter) for q in queries])
+            results = await asyncio.gather(*[self._answer(result) for result in results])
+        except Exception as e:
+            record_duration("http_query_batch", time.perf_counter() - start, str(e))
+            print(f"Error answering queries: {e}")
+            return self._error(f"Error answering queries: {e}", 500)
+        record_duration("http_query_batch", time.perf_counter() - start, queries=len(queries))
+        return web.json_response({"results": [self._to_json(result) for result in results]})
+
+    async def ingest(self, request: web.Request) -> web.Response:
+        """
+        POST /ingest {"paths": [...]} or {"documents": [{"page_content", "metadata"}]}
+
+        Optional keys: mode (rebuild, append, upsert; default upsert for
+        paths, append for documents), source, chunk_size, chunk_overlap,
+        index_type. Paths are read on the server, relative to --ingest-root
+        and only inside it; without that option only documents are accepted.
+        Documents are indexed as a JSON chunk file labelled with source
+        ("api" when omitted). Upsert replaces every chunk of that source, so
+        upserting documents requires an explicit source; otherwise each
+        request would remove the documents of the previous ones.
+        """
+        try:
+            body = await self._body(request)
+            paths, documents = body.get("paths"), body.get("documents")
+            if (paths is None) == (documents is None):
+                raise ValueError("Provide either paths or documents")
+            if paths is not None and (not isinstance(paths, list) or not paths
+                                      or not all(isinstance(p, str) for p in paths)):
+                raise ValueError("paths must be a non-empty list of strings")
+            if paths is not None:
+                paths = self._resolve_paths(paths)
+            if documents is not None and (not isinstance(documents, list) or not documents
+                                          or not all(isinstance(d, dict) for d in documents)):
+                raise ValueError("documents must be a non-empty list of objects")
+            mode = body.get("mode", "upsert" if paths is not None else "append")
+            if mode not in ("rebuild", "append", "upsert"):
+                raise ValueError("mode must be rebuild, append or upsert")
+            if documents is not None and mode == "upsert" and not body.get("source"):
+                raise ValueError("Upserting documents requires a source naming the "
+                                 "documents they replace")
+            index_type = body.get("index_type", "flat")
+            if index_type not in INDEX_TYPES:
+                raise ValueError(f"index_type must be one of {', '.join(INDEX_TYPES)}")
+            options = {"mode": mode, "index_type": index_type,
+                       "source": body.get("source"),
+                       "chunk_size": int(body.get("chunk_size", 200)),
+                       "chunk_overlap": int(body.get("chunk_overlap", 40))}
+        except PermissionError as e:
+            return self._error(str(e), 403)
+        except (ValueError, TypeError) as e:
+            return self._error(str(e))
+
+        if self._ingest_lock is None:
+            self._ingest_lock = asyncio.Lock()
+        async with self._ingest_lock:
+            start = time.perf_counter()
+            success = await asyncio.get_running_loop().run_in_executor(
+                self.ingest_executor, self._run_ingest, paths, documents, options)
+            if success:
+                # Swap the index in between two search batches
+                await asyncio.get_running_loop().run_in_executor(self.search_executor,
+                                                                 self.rag.reload)
+        if not success:
+            return self._error("Ingestion failed; see the server log", 500)
+        return web.json_response({"status": "ok", "index": self.rag.retriever.index_name,
+                                  "seconds": round(time.perf_counter() - start, 3)})
+
+    def _resolve_paths(self, paths: List[str]) -> List[str]:
+        """
+        Expand requested paths to real file paths inside the ingest root
+
+        Raises:
+            PermissionError: If paths are disabled or one resolves (e.g.
+                through .. or a symlink) outside the ingest root
+            ValueError: If a path does not name an existing file
+        """
+        if self.ingest_root is None:
+            raise PermissionError("Ingesting server paths is disabled; send documents "
+                                  "or start the server with --ingest-root")
+        files = expand_inputs([os.path.join(self.ingest_root, p) for p in paths])
+        resolved = [os.path.realpath(p) for p in files]
+        outside = [p for p, real in zip(files, resolved)
+                   if os.path.commonpath([self.ingest_root, real]) != self.ingest_root]
+        if outside:
+            raise PermissionError("Paths outside the ingest root are not allowed")
+        missing = [p for p, real in zip(files, resolved) if not os.path.isfile(real)]
+        if missing:
+            raise ValueError("Not found on the server: "
+                             + ", ".join(os.path.relpath(p, self.ingest_root)
+                                         for p in missing[:10]))
+        return resolved
+
+    def _run_ingest(self, paths: Optional[List[str]], documents: Optional[List[Dict]],
+                    options: Dict[str, Any]) -> bool:
+        with _index_file_lock(self.rag.retriever.index_name):
+            return self._ingest(paths, documents, options)
+
+    def _ingest(self, paths: Optional[List[str]], documents: Optional[List[Dict]],
+                options: Dict[str, Any]) -> bool:
+        retriever = self.rag.retriever
+        if paths is not None:
+            return process_documents(paths, retriever.index_name, retriever.model_name,
+                                     **options)
+        tmp_path = None
+        try:
+            with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False,
+                                             encoding="utf-8") as tmp:
+                json.dump([{"page_content": str(d.get("page_content", "")),
+                            "metadata": d.get("metadata") or {}} for d in documents], tmp)
+                tmp_path = tmp.name
+            options = dict(options, source=options["source"] or "api")
+            return process_documents(tmp_path, retriever.index_name, retriever.model_name,
+                                     **options)
+        finally:
+            if tmp_path and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    async def health(self, request: web.Request) -> web.Response:
+        """GET /health with batching and cache statistics"""
+        return web.json_response({"status": "ok", "batching": self.batcher.stats(),
+                                  "cache": self.rag.cache_stats()})
+
+    async def metrics(self, request: web.Request) -> web.Response:
+        """GET /metrics in the Prometheus text format (this worker process only)"""
+        if not metrics_enabled():
+            return self._error("Metrics are disabled (--no-metrics)", 404)
+        return web.Response(text=render_prometheus(), content_type="text/plain",
+                            charset="utf-8")
+
+    async def _on_startup(self, app: web.Application) -> None:
+        self.batcher.start()
+
+    async def _on_cleanup(self, app: web.Application) -> None:
+        await self.batcher.stop()
+        if self.llm is not None:
+            await self.llm.aclose()
+        self.search_executor.shutdown(wait=False)
+        self.ingest_executor.shutdown(wait=False)
+
+    def app(self) -> web.Application:
+        """Build the aiohttp application"""
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.add_routes([web.post("/query", self.query),
+                        web.post("/query_batch", self.query_batch),
+                        web.post("/ingest", self.ingest),
+                        web.get("/health", self.health),
+                        web.get("/metrics", self.metrics)])
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+
+@contextlib.contextmanager
+def _index_file_lock(index_name: str):
+    """Serialize index writes across the worker processes of one host"""
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.abspath(index_name).rstrip(os.sep) + ".lock", "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def serve(args: argparse.Namespace, reuse_port: bool = False) -> None:
+    """Load the models and index, then serve requests until interrupted"""
+    if not args.no_metrics:
+        enable_metrics(args.log_json)
+    print(f"[{os.getpid()}] Loading embedding model...")
+    set_embedding_backend(args.backend)
+    warmup_embedding_model(args.model)
+    llm = (OllamaLLM(args.llm_model, args.llm_url, timeout=args.llm_timeout,
+                     tokenizer=args.llm_tokenizer) if args.llm_model else None)
+    rag = RAGSystem(args.index, model_name=args.model,
+                    nprobe=args.nprobe, ef_search=args.ef_search,
+                    shard_processes=args.shard_processes,
+                    search_mode=args.search_mode, fusion=args.fusion,
+                    vector_weight=args.vector_weight,
+                    rerank_model=args.rerank_model,
+                    rerank_candidates=args.rerank_candidates,
+                    rerank_budget_ms=args.rerank_budget_ms,
+                    use_cache=not args.no_cache,
+                    context_tokens=args.context_tokens or None)
+    if llm is not None and llm.tokenizer:
+        # The service's LLM is not part of the RAG system; count for its tokenizer
+        rag.context_builder = ContextBuilder(args.context_tokens or None,
+                                             tokenizer=llm.tokenizer)
+    if not rag.retriever.load():
+        print(f"Index '{args.index}' not loaded yet; POST /ingest to create it")
+    service = QueryService(rag, llm, args.max_batch_size, args.max_wait_ms,
+                           args.ingest_root)
+    web.run_app(service.app(), host=args.host, port=args.port, access_log=None,
+                reuse_port=reuse_port or None)
+
+
+def main():
+    """Main entry point"""
+    parser = argparse.ArgumentParser(description="Document Q&A HTTP service")
+    parser.add_argument("--index", "-i", default="faiss_index",
+                        help="Path to the FAISS index folder")
+    parser.add_argument("--model", "-m", default="all-MiniLM-L6-v2",
+                        help="SentenceTransformer model used for query embeddings")
+    parser.add_argument("--backend", choices=EMBEDDING_BACKENDS, default=DEFAULT_BACKEND,
+                        help="Run the embedding model on PyTorch or ONNX Runtime (onnx, onnx-int8)")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", "-p", type=int, default=8000, help="Port to listen on")
+    parser.add_argument("--max-batch-size", type=int, default=DEFAULT_MAX_BATCH_SIZE,
+                        help="Maximum queries per micro-batch")
+    parser.add_argument("--max-wait-ms", type=float, default=DEFAULT_MAX_WAIT_MS,
+                        help="Maximum milliseconds a query waits for its batch to fill")
+    parser.add_argument("--search-mode", choices=SEARCH_MODES, default="vector",
+                        help="vector (embeddings), keyword (BM25) or hybrid (both, fused)")
+    parser.add_argument("--fusion", choices=FUSION_METHODS, default="rrf",
+                        help="How hybrid search merges rankings")
+    parser.add_argument("--vector-weight", type=float, default=0.5,
+                        help="Share of the vector score in weighted fusion")
+    parser.add_argument("--nprobe", type=int,
+                        help="IVF lists visited per query (defaults to the index setting)")
+    parser.add_argument("--ef-search", type=int,
+                        help="HNSW search depth per query (defaults to the index setting)")
+    parser.add_argument("--shard-processes", type=int, default=0,
+                        help="Worker processes searching the shards of a sharded index "
+                             "(0 searches them on threads)")
+    parser.add_argument("--rerank-model",
+                        help="Cross-encoder used to rerank candidates (off when omitted)")
+    parser.add_argument("--rerank-candidates", type=int, default=50,
+                        help="Candidates fetched per query for reranking")
+    parser.add_argument("--rerank-budget-ms", type=float,
+                        help="Stop reranking new batches after this many milliseconds")
+    parser.add_argument("--llm-model",
+                        help="Ollama model used to generate answers (retrieval only when omitted)")
+    parser.add_argument("--llm-url", default=DEFAULT_OLLAMA_URL,
+                        help="URL of the Ollama-compatible server")
+    parser.add_argument("--llm-timeout", type=float, default=120.0,
+                        help="Maximum seconds for one answer")
+    parser.add_argument("--llm-tokenizer",
+                        help="Hugging Face tokenizer matching the LLM, used to count "
+                             "context tokens (approximated when omitted)")
+    parser.add_argument("--context-tokens", type=int, default=DEFAULT_CONTEXT_TOKENS,
+                        help="Token budget of the context sent to the LLM (0 for no limit)")
+    parser.add_argument("--ingest-root",
+                        help="Folder whose files POST /ingest may read by path "
+                             "(by default only documents in the request are accepted)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Do not reuse results of identical or similar earlier queries")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Server processes sharing the port and the memory-mapped index")
+    parser.add_argument("--no-metrics", action="store_true",
+                        help="Do not collect the stage latencies served on GET /metrics")
+    parser.add_argument("--log-json",
+                        help="Append one JSON line per pipeline stage to this file (- for stderr)")
+    args = parser.parse_args()
+
+    if args.workers <= 1:
+        serve(args)
+        return
+    if fcntl is None:
+        parser.error("--workers needs SO_REUSEPORT and is not supported on this platform")
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=serve, args=(args, True), daemon=True)
+               for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+
+if __name__ == "__main__":
+    main()
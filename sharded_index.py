@@ -0,0 +1,538 @@
+# sharded_index.py
+"""
+Indexes partitioned into shards, searched in parallel and merged
+"""
+import hashlib
+import heapq
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Union
+import numpy as np
+from langchain_core.documents import Document
+from embedding_utils import encode_queries
+from metrics import span, record_index_size
+from vectorstore_utils import (MANIFEST_FILE, FAISS_FILE, LEGACY_DOCSTORE_FILE,
+                               create_vectorstore, delete_documents, fuse_rankings,
+                               load_vectorstore, read_manifest, vector_hits,
+                               _docs_for_ids, _keyword_hits, print_progress)
+from chunk_store import ChunkStore, CHUNK_DIR
+from exact_vectors import VECTORS_DIR
+from keyword_index import KEYWORD_DIR
+from metadata_store import METADATA_DIR
+
+# How chunks are assigned to shards: by chunk ID, or all chunks of a source together
+SHARD_STRATEGIES = ("hash", "source")
+
+_SHARD_DIR = "shard-{:03d}"
+_SPOOL_DIR = ".spool"
+
+
+def is_sharded(index_name: str) -> bool:
+    """Whether an index folder holds a sharded index"""
+    return "shards" in read_manifest(index_name)
+
+
+def shard_of(doc: Document, num_shards: int, shard_by: str = "hash") -> int:
+    """
+    Shard a chunk belongs to
+
+    hash spreads chunks evenly by a digest of their source and content;
+    source keeps every chunk of a source in the same shard, so deleting or
+    updating a source touches one shard only.
+    """
+    if shard_by not in SHARD_STRATEGIES:
+        raise ValueError(f"Unknown shard strategy '{shard_by}', expected one of {SHARD_STRATEGIES}")
+    source = str((doc.metadata or {}).get("source", ""))
+    key = source if shard_by == "source" else f"{source}\0{doc.page_content}"
+    return int(hashlib.sha1(key.encode("utf-8")).hexdigest()[:15], 16) % num_shards
+
+
+def shard_paths(index_name: str) -> List[str]:
+    """Folders of the shards of a sharded index that hold chunks"""
+    shards = read_manifest(index_name).get("shards", {})
+    paths = [os.path.join(index_name, name) for name in shards.get("dirs", [])]
+    return [path for path in paths if ChunkStore.exists(path)]
+
+
+def _write_manifest(index_name: str, manifest: Dict) -> None:
+    path = os.path.join(index_name, MANIFEST_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def remove_shards(index_name: str, keep: Iterable[str] = ()) -> None:
+    """Delete the shards of a sharded index, except the named shard folders"""
+    shards = read_manifest(index_name).get("shards", {})
+    for name in set(shards.get("dirs", [])) - set(keep):
+        shutil.rmtree(os.path.join(index_name, name), ignore_errors=True)
+
+
+def unshard(index_name: str) -> None:
+    """
+    Turn a sharded index folder into an empty unsharded one, before a rebuild
+
+    The manifest keeps its version, so readers notice the rebuilt index.
+    """
+    remove_shards(index_name)
+    _write_manifest(index_name, {"version": read_manifest(index_name).get("version", 0)})
+
+
+def _remove_unsharded(index_name: str) -> None:
+    """Delete the files of an unsharded index from its folder"""
+    for name in (FAISS_FILE, LEGACY_DOCSTORE_FILE, MANIFEST_FILE):
+        if os.path.exists(os.path.join(index_name, name)):
+            os.remove(os.path.join(index_name, name))
+    for name in (CHUNK_DIR, METADATA_DIR, KEYWORD_DIR, VECTORS_DIR):
+        shutil.rmtree(os.path.join(index_name, name), ignore_errors=True)
+
+
+def _spool(documents: Iterable[Document], path: str, num_shards: int,
+           shard_by: str) -> List[Set[str]]:
+    """
+    Write each chunk to the JSON-lines file of its shard
+
+    Returns:
+        The sources seen in each shard
+    """
+    os.makedirs(path, exist_ok=True)
+    files = [open(os.path.join(path, f"{shard}.jsonl"), "w", encoding="utf-8")
+             for shard in range(num_shards)]
+    sources: List[Set[str]] = [set() for _ in range(num_shards)]
+    try:
+        for doc in documents:
+            shard = shard_of(doc, num_shards, shard_by)
+            sources[shard].add(str(doc.metadata.get("source", "")))
+            files[shard].write(json.dumps({"page_content": doc.page_content,
+                                           "metadata": doc.metadata}, default=str) + "\n")
+    finally:
+        for f in files:
+            f.close()
+    return sources
+
+
+def _unspool(path: str) -> Iterator[Document]:
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            yield Document(page_content=record["page_content"], metadata=record["metadata"])
+
+
+def create_sharded_index(documents: Iterable[Document],
+                         index_name: str = "faiss_index",
+                         model_name: str = "all-MiniLM-L6-v2",
+                         num_shards: int = 2,
+                         shard_by: str = "hash",
+                         batch_size: int = 256,
+                         mode: str = "rebuild",
+                         embedding_cache=None,
+                         index_type: str = "flat",
+                         index_params: Optional[Dict] = None,
+                         chunk_compression: Optional[str] = None) -> int:
+    """
+    Create or update a sharded index
+
+    Chunks are first routed to per-shard spool files (so the input is read
+    once and never held in memory), then each shard is built with
+    create_vectorstore as an ordinary index folder (shard-000, shard-001,
+    ...). The index folder's manifest lists the shards and carries the
+    version that readers watch. Updates keep the shard count and strategy
+    the index was built with.
+
+    Args:
+        documents: Documents to embed (any iterable, including generators)
+        index_name: Folder of the sharded index
+        model_name: The embedding model to use
+        num_shards: Number of shards of a new index
+        shard_by: One of SHARD_STRATEGIES, for a new index
+        batch_size: Number of chunks embedded per forward pass
+        mode: One of INDEX_MODES; upsert also drops stale chunks of ingested
+            sources from shards that received none of their new chunks
+        embedding_cache: Optional EmbeddingCache checked before running the model
+        index_type: One of INDEX_TYPES, used for every shard of a new index
+        index_params: Overrides for index_factory.DEFAULT_INDEX_PARAMS
+        chunk_compression: How chunk texts are stored, one of CHUNK_COMPRESSIONS
+
+    Returns:
+        Number of vectors across all shards
+    """
+    manifest = read_manifest(index_name)
+    if mode != "rebuild" and manifest:
+        if "shards" not in manifest:
+            raise ValueError(f"'{index_name}' is not sharded; rebuild it to shard it")
+        num_shards, shard_by = manifest["shards"]["count"], manifest["shards"]["by"]
+    if num_shards < 1:
+        raise ValueError(f"Number of shards must be positive, got {num_shards}")
+    if shard_by not in SHARD_STRATEGIES:
+        raise ValueError(f"Unknown shard strategy '{shard_by}', expected one of {SHARD_STRATEGIES}")
+
+    dirs = [_SHARD_DIR.format(shard) for shard in range(num_shards)]
+    if mode == "rebuild" and manifest:
+        if "shards" in manifest:
+            remove_shards(index_name, keep=dirs)
+        else:
+            _remove_unsharded(index_name)
+            manifest = {"version": manifest.get("version", 0)}
+    os.makedirs(index_name, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix=_SPOOL_DIR, dir=index_name) as spool:
+        sources = _spool(documents, spool, num_shards, shard_by)
+        ingested = set().union(*sources)
+        if not ingested:
+            raise ValueError("No documents to index")
+        for shard, name in enumerate(dirs):
+            path = os.path.join(index_name, name)
+            print(f"Shard {shard + 1}/{num_shards} ({name})")
+            if not sources[shard]:
+                if mode == "rebuild":
+                    shutil.rmtree(path, ignore_errors=True)
+                elif mode == "upsert" and ChunkStore.exists(path):
+                    delete_documents(path, sorted(ingested))
+                continue
+            create_vectorstore(_unspool(os.path.join(spool, f"{shard}.jsonl")), path,
+                               model_name, batch_size, print_progress, mode,
+                               embedding_cache, index_type, index_params, chunk_compression)
+            if mode == "upsert" and ingested - sources[shard]:
+                delete_documents(path, sorted(ingested - sources[shard]))
+
+    total = sum(read_manifest(path).get("num_vectors", 0) for path in
+                (os.path.join(index_name, name) for name in dirs) if ChunkStore.exists(path))
+    manifest.update({
+        "model_name": model_name,
+        "version": manifest.get("version", 0) + 1,
+        "num_vectors": total,
+        "shards": {"count": num_shards, "by": shard_by, "dirs": dirs},
+    })
+    _write_manifest(index_name, manifest)
+    record_index_size(index_name, total)
+    return total
+
+
+class LocalShard:
+    """One shard searched in this process"""
+
+    def __init__(self, index_name: str, model_name: Optional[str] = None,
+                 load_model: bool = True):
+        self.index_name = index_name
+        self.vectorstore = load_vectorstore(index_name, model_name, load_model=load_model)
+        if self.vectorstore is None:
+            raise RuntimeError(f"Could not load shard '{index_name}'")
+
+    def has_keyword_index(self) -> bool:
+        return self.vectorstore.keyword_index is not None
+
+    def vector_hits(self, embeddings: np.ndarray, k: int, nprobe: Optional[int],
+                    ef_search: Optional[int], filter: Optional[Dict]) -> List[List[tuple]]:
+        return vector_hits(self.vectorstore, embeddings, k, nprobe, ef_search, filter)
+
+    def term_statistics(self, queries: List[str]) -> List[tuple]:
+        """(chunk count, document frequency by term hash) of each query"""
+        keyword_index = self.vectorstore.keyword_index
+        if keyword_index is None:
+            return [(0, {}) for _ in queries]
+        return [(len(keyword_index), keyword_index.document_frequencies(query))
+                for query in queries]
+
+    def keyword_hits(self, queries: List[str], k: int, filter: Optional[Dict],
+                     collections: Optional[List[tuple]] = None) -> List[List[tuple]]:
+        return [_keyword_hits(query, self.vectorstore, k, filter,
+                              collections[q] if collections else None)
+                for q, query in enumerate(queries)]
+
+    def documents(self, hits: List[tuple]) -> Dict[int, Document]:
+        return {doc.metadata["id"]: doc for doc in _docs_for_ids(self.vectorstore, hits)}
+
+
+def _serve_shards(connection, index_names: List[str], model_name: Optional[str]) -> None:
+    """Worker process loop: answer (shard, method, args) requests until closed"""
+    try:
+        shards = [LocalShard(name, model_name, load_model=False) for name in index_names]
+        connection.send(("ok", None))
+    except Exception as e:
+        connection.send(("error", f"{type(e).__name__}: {e}"))
+        return
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+        shard, method, args = request
+        try:
+            connection.send(("ok", getattr(shards[shard], method)(*args)))
+        except Exception as e:
+            connection.send(("error", f"{type(e).__name__}: {e}"))
+
+
+class _ShardProcess:
+    """Worker process hosting some shards, reached through a pipe"""
+
+    def __init__(self, context, index_names: List[str], model_name: Optional[str]):
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=_serve_shards, args=(child, index_names, model_name),
+                                       daemon=True)
+        self.process.start()
+        child.close()
+        self.lock = threading.Lock()
+        self._ready = False
+
+    def call(self, shard: int, method: str, *args) -> Any:
+        with self.lock:
+            if not self._ready:
+                self._receive()
+                self._ready = True
+            self.connection.send((shard, method, args))
+            return self._receive()
+
+    def _receive(self) -> Any:
+        status, value = self.connection.recv()
+        if status != "ok":
+            raise RuntimeError(f"Shard worker failed: {value}")
+        return value
+
+    def close(self) -> None:
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class RemoteShard:
+    """A shard searched in a worker process, with the same methods as LocalShard"""
+
+    def __init__(self, worker: _ShardProcess, number: int, index_name: str):
+        self.worker = worker
+        self.number = number
+        self.index_name = index_name
+
+    def __getattr__(self, method: str):
+        if method.startswith("_"):
+            raise AttributeError(method)
+        return lambda *args: self.worker.call(self.number, method, *args)
+
+
+def _shutdown(executor: ThreadPoolExecutor, workers: List[_ShardProcess]) -> None:
+    executor.shutdown(wait=False)
+    for worker in workers:
+        worker.close()
+
+
+def merge_hits(rankings: List[List[tuple]], k: int) -> List[tuple]:
+    """
+    Best k hits of several rankings, each sorted best first
+
+    A heap merges the rankings lazily, so only about k hits are compared.
+
+    Args:
+        rankings: One list of (id, score) pairs per shard
+        k: Number of hits to keep
+
+    Returns:
+        (id, score, shard) triples, best first
+    """
+    tagged = ([(i, score, shard) for i, score in hits] for shard, hits in enumerate(rankings))
+    return list(islice(heapq.merge(*tagged, key=lambda hit: -hit[1]), k))
+
+
+class ShardedIndex:
+    """
+    The shards of a sharded index, searched in parallel
+
+    Every query fans out to all shards at once, one thread per shard. With
+    processes, shards are spread over that many worker processes (a local
+    stand-in for shard servers) and the threads wait on their pipes, so
+    searches run on separate cores without sharing the GIL; workers only
+    receive query embeddings and never load the embedding model. Per-shard
+    rankings are merged with a heap, then documents are fetched from the
+    shards that own them.
+    """
+
+    def __init__(self, index_name: str, model_name: Optional[str] = None,
+                 processes: int = 0):
+        """
+        Open the shards of a sharded index
+
+        Args:
+            index_name: Folder of the sharded index
+            model_name: Embedding model of the index (defaults to the manifest's)
+            processes: Worker processes hosting the shards (0 searches them in
+                this process)
+        """
+        self.index_name = index_name
+        paths = shard_paths(index_name)
+        if not paths:
+            raise FileNotFoundError(f"no shards found in '{index_name}'")
+        workers: List[_ShardProcess] = []
+        if processes > 0:
+            context = multiprocessing.get_context("spawn")
+            groups = [paths[i::processes] for i in range(min(processes, len(paths)))]
+            workers = [_ShardProcess(context, group, model_name) for group in groups]
+            self.shards: List[Union[LocalShard, RemoteShard]] = [
+                RemoteShard(workers[i % len(workers)], i // len(workers), path)
+                for i, path in enumerate(paths)]
+        else:
+            self.shards = [LocalShard(path, model_name) for path in paths]
+        self._executor = ThreadPoolExecutor(max_workers=len(self.shards),
+                                            thread_name_prefix="shard")
+        self._finalizer = weakref.finalize(self, _shutdown, self._executor, workers)
+
+    def close(self) -> None:
+        """Stop the worker threads and processes"""
+        self._finalizer()
+
+    def _fan_out(self, method: str, *args) -> List[Any]:
+        """Call a method on every shard in parallel, results in shard order"""
+        futures = [self._executor.submit(getattr(shard, method), *args) for shard in self.shards]
+        return [future.result() for future in futures]
+
+    def has_keyword_index(self) -> bool:
+        return all(self._fan_out("has_keyword_index"))
+
+    def vector_hits(self, embeddings: np.ndarray, k: int,
+                    nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                    filter: Optional[Dict] = None) -> List[List[tuple]]:
+        """Merged (id, similarity, shard) hits of each query, best first"""
+        per_shard = self._fan_out("vector_hits", np.ascontiguousarray(embeddings, dtype="float32"),
+                                  k, nprobe, ef_search, filter)
+        return [merge_hits([hits[q] for hits in per_shard], k) for q in range(len(embeddings))]
+
+    def keyword_hits(self, queries: List[str], k: int,
+                     filter: Optional[Dict] = None) -> List[List[tuple]]:
+        """
+        Merged (id, BM25 score, shard) hits of each query, best first
+
+        A first round gathers the document frequencies of the query terms
+        from every shard, so each shard scores with collection-wide IDF and
+        the merged ranking matches one unsharded index (up to each shard's
+        own average chunk length, which hash sharding keeps close).
+        """
+        collections = []
+        for statistics in zip(*self._fan_out("term_statistics", queries)):
+            frequencies: Dict[int, int] = {}
+            for _, shard_frequencies in statistics:
+                for term, df in shard_frequencies.items():
+                    frequencies[term] = frequencies.get(term, 0) + df
+            collections.append((sum(count for count, _ in statistics), frequencies))
+        per_shard = self._fan_out("keyword_hits", queries, k, filter, collections)
+        return [merge_hits([hits[q] for hits in per_shard], k) for q in range(len(queries))]
+
+    def documents(self, results: List[List[tuple]]) -> List[List[Document]]:
+        """
+        Documents of (id, extra metadata, shard) hits, fetched shard by shard
+
+        Returns:
+            One list of Document objects per input list, in hit order
+        """
+        wanted: List[List[tuple]] = [[] for _ in self.shards]
+        for hits in results:
+            for i, extra, shard in hits:
+                wanted[shard].append((i, extra))
+        futures = [self._executor.submit(shard.documents, hits) if hits else None
+                   for shard, hits in zip(self.shards, wanted)]
+        found = [future.result() if future else {} for future in futures]
+        return [[found[shard][i] for i, _, shard in hits if i in found[shard]]
+                for hits in results]
+
+
+def load_index(index_name: str, model_name: Optional[str] = None,
+               processes: int = 0):
+    """
+    Open an index folder, sharded or not
+
+    Returns:
+        A ShardedIndex, a FAISS vectorstore, or None if loading fails
+    """
+    if not is_sharded(index_name):
+        return load_vectorstore(index_name, model_name)
+    try:
+        with span("load_index", index=index_name, processes=processes):
+            index = ShardedIndex(index_name, model_name, processes)
+        record_index_size(index_name, read_manifest(index_name).get("num_vectors", 0))
+        return index
+    except Exception as e:
+        print(f"Error loading sharded index from {index_name}: {e}")
+        return None
+
+
+def search_shards(queries: List[str],
+                  index: ShardedIndex,
+                  k: int = 5,
+                  model_name: str = "all-MiniLM-L6-v2",
+                  batch_size: int = 256,
+                  nprobe: Optional[int] = None,
+                  ef_search: Optional[int] = None,
+                  filter: Optional[Dict] = None,
+                  search_mode: str = "vector",
+                  fusion: str = "rrf",
+                  vector_weight: float = 0.5,
+                  candidates: Optional[int] = None,
+                  embeddings=None) -> List[List[Document]]:
+    """
+    Search a sharded index for many queries
+
+    Queries are encoded once here and searched on every shard; each shard
+    returns its own top-k, so the merged top-k is the same as a search of
+    one index holding every chunk. Hybrid search merges each side across
+    shards before fusing them, as hybrid_search_many does on one index.
+
+    Args:
+        queries: The query strings
+        index: The sharded index to search
+        k: Number of results to return per query
+        model_name: The embedding model to use
+        batch_size: Number of queries encoded and searched together
+        nprobe: IVF lists to visit, overriding the value saved with each shard
+        ef_search: HNSW search depth, overriding the value saved with each shard
+        filter: Only return chunks whose metadata matches these conditions
+        search_mode: vector, keyword or hybrid
+        fusion: One of FUSION_METHODS (hybrid only)
+        vector_weight: Weight of the vector ranking in weighted fusion
+        candidates: Results taken from each side before fusion (default 4 * k)
+        embeddings: Precomputed query embeddings, one row per query
+
+    Returns:
+        One list of Document objects per query, in input order
+    """
+    results: List[List[Document]] = []
+    depth = (candidates or max(4 * k, 20)) if search_mode == "hybrid" else k
+    try:
+        for start in range(0, len(queries), batch_size):
+            batch = queries[start:start + batch_size]
+            vector_side = keyword_side = None
+            if search_mode != "keyword":
+                batch_embeddings = (encode_queries(batch, model_name, batch_size=batch_size)
+                                    if embeddings is None else embeddings[start:start + batch_size])
+                with span("shard_vector_search", shards=len(index.shards), queries=len(batch)):
+                    vector_side = index.vector_hits(batch_embeddings, depth, nprobe,
+                                                    ef_search, filter)
+            if search_mode != "vector":
+                with span("shard_keyword_search", shards=len(index.shards), queries=len(batch)):
+                    keyword_side = index.keyword_hits(batch, depth, filter)
+            if search_mode != "hybrid":
+                hits = vector_side if keyword_side is None else keyword_side
+                batch_hits = [[(i, {"score": score}, shard) for i, score, shard in row]
+                              for row in hits]
+            else:
+                batch_hits = []
+                for vector_row, keyword_row in zip(vector_side, keyword_side):
+                    owner = {i: shard for i, _, shard in vector_row + keyword_row}
+                    fused = fuse_rankings([(i, s) for i, s, _ in vector_row],
+                                          [(i, s) for i, s, _ in keyword_row],
+                                          k, fusion, vector_weight)
+                    batch_hits.append([(i, extra, owner[i]) for i, extra in fused])
+            with span("shard_fetch_documents", queries=len(batch)):
+                results.extend(index.documents(batch_hits))
+        return results
+    except Exception as e:
+        print(f"Error during sharded search: {e}")
+        return results + [[] for _ in range(len(queries) - len(results))]
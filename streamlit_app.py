@@ -3,6 +3,8 @@ import streamlit as st
 import tempfile
 import os
 import sys
+import threading
+import time
 import traceback
 
 # Add current directory to path for module imports
@@ -20,7 +22,12 @@ with st.expander("🔧 Debug Info", expanded=False):
 # Import modules with error handling
 try:
     from rag import RAGSystem
+    from vectorstore_utils import MANIFEST_FILE
+    from sharded_index import load_index as open_index
     from ingest import process_documents
+    from embedding_utils import warmup_embedding_model
+    from reranker import DEFAULT_RERANK_MODEL
+    from llm_integration import OllamaLLM, DEFAULT_OLLAMA_URL
     st.success("✅ Modules imported successfully!", icon="✅")
 except ImportError as e:
     st.error(f"❌ Import Error: {str(e)}")
@@ -58,6 +65,92 @@ embed_model = st.sidebar.text_input(
     help="Sentence transformer model for embeddings"
 )
 
+index_mode = st.sidebar.selectbox(
+    "Index Mode",
+    options=["upsert", "append", "rebuild"],
+    help="upsert replaces this file's chunks in the existing index, append only adds "
+         "new chunks, rebuild starts a fresh index"
+)
+
+index_type = st.sidebar.selectbox(
+    "Index Type",
+    options=["flat", "ivf-flat", "ivf-pq", "hnsw"],
+    help="Flat is exact; IVF and HNSW trade a little recall for much faster search "
+         "on large corpora. Only used when a new index is built."
+)
+
+vector_dtype = st.sidebar.selectbox(
+    "Vector Storage",
+    options=["float32", "float16", "int8", "binary"],
+    help="float16, int8 and binary keep 2x, 4x and 32x smaller vectors in memory and "
+         "rescore the best candidates exactly from disk. Only used when a new index is built."
+)
+
+search_mode = st.sidebar.selectbox(
+    "Search Mode",
+    options=["hybrid", "vector", "keyword"],
+    help="Hybrid fuses semantic (vector) and keyword (BM25) matches, so exact "
+         "identifiers and error codes are found as well as paraphrases"
+)
+
+with st.sidebar.expander("⚙️ Search Tuning"):
+    fusion = st.selectbox("Hybrid fusion", options=["rrf", "weighted"],
+                          help="Reciprocal rank fusion, or a weighted mix of normalized scores")
+    vector_weight = st.slider("Vector weight", 0.0, 1.0, 0.5, 0.05,
+                              help="Share of the vector score in weighted fusion")
+    rerank = st.checkbox("Rerank with cross-encoder", value=False,
+                         help=f"Score candidates with {DEFAULT_RERANK_MODEL} and keep the best")
+    rerank_candidates = st.number_input("Rerank candidates", min_value=1, value=50,
+                                        help="Candidates fetched per query for reranking")
+    rerank_budget_ms = st.number_input("Rerank budget (ms)", min_value=0, value=0,
+                                       help="Stop reranking after this long (0 means no limit)")
+    nprobe = st.number_input("IVF nprobe", min_value=0, value=0,
+                             help="Lists visited per query (0 uses the index default)")
+    ef_search = st.number_input("HNSW efSearch", min_value=0, value=0,
+                                help="Search depth per query (0 uses the index default)")
+
+with st.sidebar.expander("🤖 Answer Generation"):
+    generate_answers = st.checkbox("Generate answers", value=False,
+                                   help="Stream an answer from an Ollama-compatible server")
+    llm_model = st.text_input("LLM model", value="llama3")
+    llm_url = st.text_input("Server URL", value=DEFAULT_OLLAMA_URL)
+    context_tokens = st.number_input("Context budget (tokens)", min_value=0, value=2048,
+                                     help="Maximum tokens of retrieved text sent to the LLM "
+                                          "(0 means no limit)")
+
+# Models live in a process-wide registry, so this only loads on the first run
+warmup_embedding_model(embed_model)
+
+def index_version(index_name: str):
+    """Modification times of the index files; they change whenever it is re-saved"""
+    version = []
+    for filename in (MANIFEST_FILE, "index.faiss"):
+        try:
+            version.append(os.stat(os.path.join(index_name, filename)).st_mtime_ns)
+        except OSError:
+            version.append(None)
+    return tuple(version)
+
+@st.cache_resource(show_spinner=False)
+def index_holder(index_name: str, model_name: str) -> dict:
+    """One loaded index per (index, model), shared by every session and rerun"""
+    return {"lock": threading.Lock(), "version": None, "vectorstore": None}
+
+def load_index(holder: dict, index_name: str, model_name: str):
+    """Return the index of a holder, reloading it only if it changed on disk"""
+    version = index_version(index_name)
+    with holder["lock"]:
+        if holder["vectorstore"] is None or holder["version"] != version:
+            holder["vectorstore"] = (open_index(index_name, model_name)
+                                     if version[0] is not None else None)
+            holder["version"] = version
+        return holder["vectorstore"]
+
+@st.cache_resource(show_spinner=False)
+def get_llm(model_name: str, base_url: str) -> OllamaLLM:
+    """One client per (model, server), so pooled connections survive reruns"""
+    return OllamaLLM(model_name, base_url)
+
 # Document processing section
 if uploaded_file:
     st.sidebar.info(f"📄 File loaded: {uploaded_file.name}")
@@ -82,9 +175,18 @@ if uploaded_file:
                 
                 # Process documents with progress indicator
                 with st.spinner("🔄 Processing and indexing documents..."):
-                    success = process_documents(tmp_path, index_name, embed_model)
+                    success = process_documents(tmp_path, index_name, embed_model,
+                                                mode=index_mode,
+                                                source=uploaded_file.name,
+                                                index_type=index_type,
+                                                index_params={"vector_dtype": vector_dtype})
                 
                 if success:
+                    # Load the new index in the background so the next search is fast
+                    threading.Thread(target=load_index,
+                                     args=(index_holder(index_name, embed_model),
+                                           index_name, embed_model),
+                                     daemon=True).start()
                     st.sidebar.success("✅ Documents indexed successfully!")
                     st.sidebar.balloons()
                 else:
@@ -132,9 +234,24 @@ if st.button("🔍 Search", type="primary", disabled=not query.strip()):
     else:
         try:
             with st.spinner("🔄 Retrieving relevant documents..."):
-                # Initialize RAG system
-                rag = RAGSystem(index_name)
-                results = rag.query(query, k=num_results)
+                vectorstore = load_index(index_holder(index_name, embed_model),
+                                         index_name, embed_model)
+                if vectorstore is None:
+                    raise FileNotFoundError(index_name)
+                # Settings are cheap to apply per search; the index is shared
+                llm = get_llm(llm_model, llm_url) if generate_answers else None
+                rag = RAGSystem(index_name, llm=llm, model_name=embed_model,
+                                vectorstore=vectorstore,
+                                nprobe=nprobe or None, ef_search=ef_search or None,
+                                search_mode=search_mode, fusion=fusion,
+                                vector_weight=vector_weight,
+                                rerank_model=DEFAULT_RERANK_MODEL if rerank else None,
+                                rerank_candidates=rerank_candidates,
+                                rerank_budget_ms=rerank_budget_ms or None,
+                                context_tokens=context_tokens or None)
+                start = time.perf_counter()
+                results = rag.stream_query(query, k=num_results)
+                search_ms = (time.perf_counter() - start) * 1000
             
             # Display results
             st.markdown("### 📄 Retrieved Documents")
@@ -144,12 +261,32 @@ if st.button("🔍 Search", type="primary", disabled=not query.strip()):
                 with st.expander("📋 View Retrieved Documents", expanded=True):
                     st.code(results["formatted_docs"], language="text")
                 
-                # Display generated answer if available
-                if results.get("answer"):
+                # Display generated answer if available, token by token
+                if llm and results["retrieved_docs"]:
                     st.markdown("### 🤖 Generated Answer")
-                    st.success(results["answer"])
+                    placeholder = st.empty()
+                    answer = ""
+                    for token in results["answer_stream"]:
+                        answer += token
+                        placeholder.markdown(answer + "▌")
+                    placeholder.success(answer)
+                    packing = results.get("context_stats")
+                    if packing:
+                        st.caption(f"Context: {packing['tokens']} tokens from {packing['chunks']} "
+                                   f"chunks ({packing['tokens_saved']} tokens saved, "
+                                   f"{packing['duplicates']} near-duplicates dropped)")
                 else:
                     st.info("ℹ️ No generated answer available. Showing retrieved documents only.")
+                
+                caption = f"Retrieved in {search_ms:.0f} ms"
+                if results.get("cache"):
+                    caption += f" · Served from {results['cache']} cache"
+                stats = rag.cache_stats()
+                if stats:
+                    caption += (f" · Query cache hit rate: {stats['hit_rate']:.0%} "
+                                f"({stats['exact_hits']} exact, {stats['semantic_hits']} semantic, "
+                                f"{stats['misses']} misses)")
+                st.caption(caption)
             else:
                 st.warning("⚠️ No relevant documents found for your query.")
                 
@@ -164,8 +301,7 @@ st.sidebar.markdown("---")
 st.sidebar.markdown("### 📊 Status")
 
 # Check if index exists
-index_path = f"{index_name}.faiss" if not index_name.endswith('.faiss') else index_name
-if os.path.exists(index_path):
+if os.path.exists(os.path.join(index_name, "index.faiss")):
     st.sidebar.success(f"✅ Index '{index_name}' is ready")
 else:
     st.sidebar.warning(f"⚠️ Index '{index_name}' not found")
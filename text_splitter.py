@@ -0,0 +1,228 @@
+# text_splitter.py
+"""
+Token-aware text splitting with overlap
+"""
+import math
+import re
+from typing import Callable, Iterable, Iterator, List, NamedTuple
+from langchain_core.documents import Document
+
+_PARAGRAPH_RE = re.compile(r"(?:(?!\n[ \t]*\n).)+", re.S)
+_SENTENCE_RE = re.compile(r"\S.*?(?:[.!?]+(?=\s)|$)", re.S)
+_WORD_RE = re.compile(r"\S+")
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+
+class _Span(NamedTuple):
+    text: str
+    start: int
+    end: int
+    tokens: int
+    paragraph_end: bool
+
+
+def _regex_token_counts(texts: List[str]) -> List[int]:
+    return [len(_TOKEN_RE.findall(text)) for text in texts]
+
+
+class TextSplitter:
+    """
+    Split documents into chunks of at most chunk_size tokens
+
+    Text is cut at sentence boundaries, preferring paragraph breaks when one
+    falls in the second half of a chunk. Consecutive chunks share up to
+    chunk_overlap tokens of whole sentences. Consecutive paragraph documents
+    (those with a "paragraph" metadata key) from the same source are packed
+    together; any other document is split on its own. Only one chunk worth of
+    text is buffered at a time.
+    """
+
+    def __init__(self, chunk_size: int = 200, chunk_overlap: int = 40,
+                 tokenizer=None):
+        """
+        Initialize the splitter
+
+        Args:
+            chunk_size: Maximum number of tokens per chunk
+            chunk_overlap: Number of tokens repeated between consecutive chunks
+            tokenizer: Optional Hugging Face tokenizer used to count tokens;
+                a word/punctuation approximation is used when omitted
+        """
+        if chunk_size <= 0:
+            raise ValueError("chunk_size must be positive")
+        if not 0 <= chunk_overlap < chunk_size:
+            raise ValueError("chunk_overlap must be between 0 and chunk_size")
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self._count: Callable[[List[str]], List[int]] = _regex_token_counts
+        if tokenizer is not None:
+            self._count = lambda texts: [
+                len(ids) for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]
+            ]
+
+    def count_tokens(self, texts: List[str]) -> List[int]:
+        """Return the token count of each text"""
+        return self._count(texts) if texts else []
+
+    def split_text(self, text: str) -> List[str]:
+        """Split a single string into chunk texts"""
+        return [doc.page_content for doc in self.split_documents([Document(page_content=text)])]
+
+    def split_documents(self, documents: Iterable[Document]) -> Iterator[Document]:
+        """
+        Lazily split documents into chunks
+
+        Each chunk keeps the source and page of its input and records
+        start_index/end_index character offsets and a per-source chunk number.
+
+        Args:
+            documents: Documents to split, in reading order
+
+        Returns:
+            Iterator over chunk Documents
+        """
+        buffer: List[_Span] = []
+        overlap_count = 0
+        group_key = None
+        metadata = {}
+        chunk_numbers = {}
+
+        def emit(spans: List[_Span]) -> Document:
+            parts = []
+            for i, span in enumerate(spans):
+                if i:
+                    parts.append("\n\n" if spans[i - 1].paragraph_end else " ")
+                parts.append(span.text)
+            source = metadata.get("source")
+            number = chunk_numbers.get(source, 0)
+            chunk_numbers[source] = number + 1
+            chunk_metadata = dict(metadata, start_index=spans[0].start,
+                                  end_index=spans[-1].end, chunk=number)
+            return Document(page_content="".join(parts), metadata=chunk_metadata)
+
+        for doc in documents:
+            doc_metadata = doc.metadata or {}
+            if "paragraph" in doc_metadata:
+                doc_key = (doc_metadata.get("source"), doc_metadata.get("page"))
+            else:
+                doc_key = object()
+            if doc_key != group_key:
+                if len(buffer) > overlap_count:
+                    yield emit(buffer)
+                buffer, overlap_count = [], 0
+                group_key = doc_key
+                metadata = {key: value for key, value in doc_metadata.items()
+                            if key not in ("paragraph", "start_index", "end_index", "chunk")}
+
+            for span in self._spans(doc):
+                while buffer and self._tokens(buffer) + span.tokens > self.chunk_size:
+                    if overlap_count == len(buffer):
+                        # Only already-emitted overlap is left and it does not fit
+                        buffer, overlap_count = [], 0
+                        break
+                    cut = self._cut_point(buffer, overlap_count)
+                    yield emit(buffer[:cut])
+                    tail = self._overlap_tail(buffer[:cut])
+                    buffer = tail + buffer[cut:]
+                    overlap_count = len(tail)
+                buffer.append(span)
+
+        if len(buffer) > overlap_count:
+            yield emit(buffer)
+
+    def _spans(self, doc: Document) -> List[_Span]:
+        """Break a document into sentence spans no longer than chunk_size tokens"""
+        base = (doc.metadata or {}).get("start_index", 0)
+        raw = []
+        for paragraph in _PARAGRAPH_RE.finditer(doc.page_content):
+            sentences = [m for m in _SENTENCE_RE.finditer(paragraph.group())
+                         if m.group().strip()]
+            for i, match in enumerate(sentences):
+                text = match.group().rstrip()
+                start = base + paragraph.start() + match.start()
+                raw.append((text, start, i == len(sentences) - 1))
+        if raw:
+            # Every input document ends a paragraph
+            text, start, _ = raw[-1]
+            raw[-1] = (text, start, True)
+
+        counts = self.count_tokens([text for text, _, _ in raw])
+        spans = []
+        for (text, start, paragraph_end), tokens in zip(raw, counts):
+            if tokens <= self.chunk_size:
+                spans.append(_Span(text, start, start + len(text), tokens, paragraph_end))
+            else:
+                spans.extend(self._split_long(text, start, tokens, paragraph_end))
+        return spans
+
+    def _split_long(self, text: str, start: int, tokens: int,
+                    paragraph_end: bool) -> List[_Span]:
+        """Split an over-long sentence at word boundaries"""
+        words = list(_WORD_RE.finditer(text))
+        pieces = math.ceil(tokens / self.chunk_size)
+        spans = []
+        while True:
+            per_piece = max(1, math.ceil(len(words) / pieces))
+            groups = [words[i:i + per_piece] for i in range(0, len(words), per_piece)]
+            texts = [text[group[0].start():group[-1].end()] for group in groups]
+            counts = self.count_tokens(texts)
+            if max(counts) <= self.chunk_size or per_piece == 1:
+                break
+            pieces += 1
+        for group, piece, count in zip(groups, texts, counts):
+            piece_start = start + group[0].start()
+            if count <= self.chunk_size:
+                spans.append(_Span(piece, piece_start, piece_start + len(piece), count, False))
+            else:
+                # A single word longer than a chunk, e.g. a URL or unspaced CJK text
+                spans.extend(self._split_word(piece, piece_start))
+        if spans:
+            spans[-1] = spans[-1]._replace(paragraph_end=paragraph_end)
+        return spans
+
+    def _split_word(self, text: str, start: int) -> List[_Span]:
+        """Hard-split a word at the token limit into the longest prefixes that fit"""
+        spans = []
+        offset = 0
+        while offset < len(text):
+            # Bisect on the character length of the next piece
+            low, high = 1, len(text) - offset
+            while low < high:
+                middle = (low + high + 1) // 2
+                if self.count_tokens([text[offset:offset + middle]])[0] <= self.chunk_size:
+                    low = middle
+                else:
+                    high = middle - 1
+            piece = text[offset:offset + low]
+            spans.append(_Span(piece, start + offset, start + offset + low,
+                               self.count_tokens([piece])[0], False))
+            offset += low
+        return spans
+
+    def _cut_point(self, buffer: List[_Span], overlap_count: int) -> int:
+        """Prefer ending a chunk at the last paragraph break past its midpoint"""
+        tokens = 0
+        best = len(buffer)
+        for i, span in enumerate(buffer, start=1):
+            tokens += span.tokens
+            if i > overlap_count and span.paragraph_end and tokens >= self.chunk_size / 2:
+                best = i
+        return best
+
+    def _overlap_tail(self, spans: List[_Span]) -> List[_Span]:
+        """Return the trailing sentences that fit in chunk_overlap tokens"""
+        tail: List[_Span] = []
+        tokens = 0
+        for span in reversed(spans):
+            if tokens + span.tokens > self.chunk_overlap:
+                break
+            tail.insert(0, span)
+            tokens += span.tokens
+        if len(tail) == len(spans):
+            # Never carry a whole chunk over, or the next chunk would repeat it
+            tail = tail[1:]
+        return tail
+
+    @staticmethod
+    def _tokens(spans: List[_Span]) -> int:
+        return sum(span.tokens for span in spans)
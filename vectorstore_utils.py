@@ -2,62 +2,655 @@
 """
 Utilities for managing vector stores
 """
-from typing import List, Optional
-from langchain.schema import Document
-from langchain_community.vectorstores import FAISS
-from embedding_utils import get_embedding_model, encode_query
+from __future__ import annotations
 
-def create_vectorstore(documents: List[Document], 
+import hashlib
+import json
+import os
+import shutil
+import time
+from itertools import islice
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, Iterator, List, Optional, Set
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+from embedding_utils import (get_embedding_model, encode_documents,
+                             encode_query, encode_queries, RegistryEmbeddings)
+from metadata_store import MetadataStore, metadata_matches
+from keyword_index import KeywordIndex
+from chunk_store import ChunkStore, ChunkDocstore, ChunkIdMap, CHUNK_COMPRESSIONS
+from exact_vectors import ExactVectors, VECTORS_DIR
+from metrics import span, traced, record_batch_size, record_index_size
+from index_factory import (INDEX_TYPES, build_index, needs_training, reconstruct,
+                           resolve_index_params, search_parameters, training_size)
+
+if TYPE_CHECKING:
+    # LangChain's vector store module is slow to import; it is loaded by the
+    # functions that build or open a store
+    from langchain_community.vectorstores import FAISS
+
+def _batched(items: Iterable, batch_size: int) -> Iterator[list]:
+    """Yield successive lists of at most batch_size items"""
+    iterator = iter(items)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+MANIFEST_FILE = "manifest.json"
+FAISS_FILE = "index.faiss"
+
+# Pickled docstore written by FAISS.save_local, no longer read or written
+LEGACY_DOCSTORE_FILE = "index.pkl"
+
+# Read flags of memory-mapped loading: IVF lists are mapped by IO_FLAG_MMAP,
+# flat and HNSW vector storage by IO_FLAG_MMAP_IFC (FAISS 1.10+). The two
+# cannot be combined: IVF lists are only mapped through a plain file reader.
+IVF_MMAP_FLAGS = faiss.IO_FLAG_MMAP
+MMAP_FLAGS = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+
+# How existing index contents are treated when new documents are ingested
+INDEX_MODES = ("rebuild", "append", "upsert")
+
+# Filtered searches over at most this many chunks are scored exactly
+EXACT_FILTER_THRESHOLD = 20000
+
+# Vectors scored per block in exact subset search
+_EXACT_BLOCK_SIZE = 65536
+
+# How hybrid search merges the vector and keyword rankings
+FUSION_METHODS = ("rrf", "weighted")
+
+# Rank offset of reciprocal rank fusion; damps the weight of the very top ranks
+RRF_K = 60
+
+# Candidate multipliers tried, in order, when calibrating compact-vector rescoring
+RESCORE_FACTORS = (1, 2, 4, 8, 16, 32, 64)
+
+# Calibration measures recall@CALIBRATION_K over this many stored vectors as queries
+CALIBRATION_K = 10
+CALIBRATION_QUERIES = 200
+
+def document_id(doc: Document) -> int:
+    """
+    Stable 60-bit ID of a chunk, derived from its source and content
+    
+    Re-ingesting an unchanged chunk yields the same ID, which lets append and
+    upsert skip it without re-embedding.
+    """
+    source = str((doc.metadata or {}).get("source", ""))
+    digest = hashlib.sha1(f"{source}\0{doc.page_content}".encode("utf-8")).hexdigest()
+    return int(digest[:15], 16)
+
+def print_progress(count: int, elapsed: float) -> None:
+    """Default progress reporter for create_vectorstore"""
+    rate = count / elapsed if elapsed > 0 else 0.0
+    print(f"Processed {count} chunks ({rate:.1f} docs/sec)")
+
+def read_manifest(index_name: str) -> Dict:
+    """Return the manifest stored in an index folder, or {} if there is none"""
+    try:
+        with open(os.path.join(index_name, MANIFEST_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_vectorstore(vectorstore: FAISS, index_name: str,
+                     model_name: str = "all-MiniLM-L6-v2",
+                     index_config: Optional[Dict] = None,
+                     chunk_compression: Optional[str] = None) -> None:
+    """
+    Save a vectorstore and bump the version recorded in its manifest
+    
+    The index folder holds the FAISS index, the chunk texts (ChunkStore),
+    their metadata (MetadataStore), the keyword index and, for compact
+    indexes, the full-precision vectors (ExactVectors); nothing is pickled.
+    
+    Args:
+        vectorstore: The vectorstore to save
+        index_name: Folder to save into
+        model_name: The embedding model the vectors were produced with
+        index_config: Index type and build parameters to record, if the index
+            was (re)built
+        chunk_compression: One of CHUNK_COMPRESSIONS; defaults to the setting
+            recorded in the manifest (none for a new index)
+    """
+    with span("save_index", index=index_name):
+        _save_vectorstore(vectorstore, index_name, model_name, index_config, chunk_compression)
+    record_index_size(index_name, vectorstore.index.ntotal)
+
+def _save_vectorstore(vectorstore: FAISS, index_name: str, model_name: str,
+                      index_config: Optional[Dict], chunk_compression: Optional[str]) -> None:
+    """Write the files of save_vectorstore"""
+    manifest = read_manifest(index_name)
+    chunk_compression = chunk_compression or manifest.get("chunk_compression", "none")
+    
+    ids = list(vectorstore.index_to_docstore_id)
+    metadatas = _metadata_for(vectorstore, ids)
+    text_of = lambda i: _text_of(vectorstore, i)
+    os.makedirs(index_name, exist_ok=True)
+    MetadataStore.write(index_name, ids, metadatas)
+    KeywordIndex.write(index_name, ids, text_of)
+    ChunkStore.write(index_name, ids, text_of, chunk_compression)
+    exact_vectors = getattr(vectorstore, "exact_vectors", None)
+    if exact_vectors is not None:
+        ExactVectors.write(index_name, ids, lambda batch: _vectors_for(vectorstore, batch))
+        vectorstore.exact_vectors = ExactVectors(index_name)
+    elif os.path.isdir(os.path.join(index_name, VECTORS_DIR)):
+        shutil.rmtree(os.path.join(index_name, VECTORS_DIR))
+    # Write next to the old file and rename, so processes mapping it are unaffected
+    faiss_path = os.path.join(index_name, FAISS_FILE)
+    faiss.write_index(vectorstore.index, faiss_path + ".tmp")
+    os.replace(faiss_path + ".tmp", faiss_path)
+    legacy_path = os.path.join(index_name, LEGACY_DOCSTORE_FILE)
+    if os.path.exists(legacy_path):
+        os.remove(legacy_path)
+    
+    # Serve the saved texts from the new store from now on
+    chunks = ChunkStore(index_name)
+    vectorstore.docstore = ChunkDocstore(chunks)
+    vectorstore.index_to_docstore_id = ChunkIdMap(chunks)
+    vectorstore.metadata_store = MetadataStore(index_name)
+    vectorstore.keyword_index = KeywordIndex(index_name)
+    if index_config is not None:
+        manifest["index"] = index_config
+    manifest.update({
+        "model_name": model_name,
+        "version": manifest.get("version", 0) + 1,
+        "num_vectors": int(vectorstore.index.ntotal),
+        "chunk_compression": chunk_compression,
+    })
+    # Replaced atomically: readers poll it to notice new versions
+    path = os.path.join(index_name, MANIFEST_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+def _add_embeddings(vectorstore: FAISS, docs: List[Document],
+                    embeddings: np.ndarray, ids: List[int]) -> None:
+    """Add vectors under explicit IDs and register their documents"""
+    with span("add_vectors", vectors=len(ids)):
+        vectorstore.index.add_with_ids(np.ascontiguousarray(embeddings, dtype="float32"),
+                                       np.asarray(ids, dtype="int64"))
+    docstore_ids = [f"{i:015x}" for i in ids]
+    vectorstore.docstore.add(dict(zip(docstore_ids, docs)))
+    vectorstore.index_to_docstore_id.update(zip(ids, docstore_ids))
+    if getattr(vectorstore, "exact_vectors", None) is not None:
+        vectorstore.exact_vectors.add(ids, embeddings)
+
+def _remove_ids(vectorstore: FAISS, ids: Iterable[int]) -> int:
+    """Remove vectors and documents by ID; returns the number removed"""
+    ids = [i for i in ids if i in vectorstore.index_to_docstore_id]
+    if not ids:
+        return 0
+    try:
+        vectorstore.index.remove_ids(np.asarray(ids, dtype="int64"))
+    except RuntimeError:
+        # HNSW graphs cannot drop nodes; re-add the remaining vectors instead
+        removed = set(ids)
+        keep = np.asarray([i for i in vectorstore.index_to_docstore_id if i not in removed],
+                          dtype="int64")
+        vectors = _vectors_for(vectorstore, keep) if len(keep) else None
+        vectorstore.index.reset()
+        if vectors is not None:
+            vectorstore.index.add_with_ids(vectors, keep)
+    vectorstore.docstore.delete([vectorstore.index_to_docstore_id.pop(i) for i in ids])
+    if getattr(vectorstore, "exact_vectors", None) is not None:
+        vectorstore.exact_vectors.remove(ids)
+    return len(ids)
+
+def _vectors_for(vectorstore: FAISS, ids: np.ndarray) -> np.ndarray:
+    """Vectors of the given IDs, exact even when the index stores compact codes"""
+    exact_vectors = getattr(vectorstore, "exact_vectors", None)
+    if exact_vectors is not None:
+        return exact_vectors.vectors(ids)
+    return reconstruct(vectorstore.index, ids)
+
+def _text_of(vectorstore: FAISS, i: int) -> str:
+    """Text of a chunk ID, without building a Document when it is stored"""
+    doc_id = vectorstore.index_to_docstore_id[i]
+    if isinstance(vectorstore.docstore, ChunkDocstore):
+        return vectorstore.docstore.text(doc_id)
+    return vectorstore.docstore.search(doc_id).page_content
+
+def _metadata_for(vectorstore: FAISS, ids: List[int]) -> List[Dict]:
+    """
+    Metadata of the given IDs
+    
+    Documents added since the last save carry their metadata inline;
+    everything else is read from the index's MetadataStore.
+    """
+    store = getattr(vectorstore, "metadata_store", None)
+    sidecar = store.lookup(ids) if store is not None else [{} for _ in ids]
+    metadatas = []
+    docstore = vectorstore.docstore
+    for i, stored in zip(ids, sidecar):
+        doc_id = vectorstore.index_to_docstore_id[i]
+        doc = (docstore.pending(doc_id) if isinstance(docstore, ChunkDocstore)
+               else docstore.search(doc_id))
+        inline = None if doc is None or isinstance(doc, str) else doc.metadata
+        metadatas.append(dict(inline) if inline else dict(stored))
+    return metadatas
+
+def _ids_by_source(vectorstore: FAISS) -> Dict[str, Set[int]]:
+    """Group the IDs stored in a vectorstore by their source metadata"""
+    groups: Dict[str, Set[int]] = {}
+    ids = list(vectorstore.index_to_docstore_id)
+    for i, metadata in zip(ids, _metadata_for(vectorstore, ids)):
+        groups.setdefault(str(metadata.get("source", "")), set()).add(i)
+    return groups
+
+def create_vectorstore(documents: Iterable[Document], 
                       index_name: str = "faiss_index",
-                      model_name: str = "all-MiniLM-L6-v2") -> FAISS:
+                      model_name: str = "all-MiniLM-L6-v2",
+                      batch_size: int = 256,
+                      on_progress: Optional[Callable[[int, float], None]] = print_progress,
+                      mode: str = "rebuild",
+                      embedding_cache=None,
+                      index_type: str = "flat",
+                      index_params: Optional[Dict] = None,
+                      chunk_compression: Optional[str] = None) -> FAISS:
     """
-    Create and save a FAISS vector store from documents
+    Create or update a FAISS vector store from documents and save it
+    
+    Documents are consumed lazily in fixed-size batches; each batch is embedded
+    and added to the index before the next one is read, so only one batch of
+    raw text and embeddings is held at a time.
+    
+    Modes:
+        rebuild: Replace any existing index with the given documents
+        append: Add documents whose ID is not already in the index
+        upsert: Like append, then remove chunks of every ingested source
+            that were not seen in this run
+    
+    Index types that need training (IVF) buffer the first train_size new
+    vectors as their training sample before the index is created. Updates of
+    an existing index keep its original type.
     
     Args:
-        documents: List of Document objects to embed
+        documents: Documents to embed (any iterable, including generators)
         index_name: Name/path to save the index
         model_name: The embedding model to use
+        batch_size: Number of chunks embedded per forward pass
+        on_progress: Called with (chunks processed, seconds elapsed) after each batch
+        mode: One of INDEX_MODES
+        embedding_cache: Optional EmbeddingCache checked before running the model
+        index_type: One of INDEX_TYPES, used when a new index is built
+        index_params: Overrides for index_factory.DEFAULT_INDEX_PARAMS,
+            including vector_dtype (float32, float16, int8 or binary) and the
+            rescoring settings of compact vectors
+        chunk_compression: How chunk texts are stored, one of
+            CHUNK_COMPRESSIONS (defaults to the index's current setting)
         
     Returns:
-        The created FAISS vectorstore
+        The created or updated FAISS vectorstore
     """
     try:
-        texts = [doc.page_content for doc in documents]
+        if mode not in INDEX_MODES:
+            raise ValueError(f"Unknown index mode '{mode}', expected one of {INDEX_MODES}")
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type '{index_type}', expected one of {INDEX_TYPES}")
+        if chunk_compression is not None and chunk_compression not in CHUNK_COMPRESSIONS:
+            raise ValueError(f"Unknown chunk compression '{chunk_compression}', "
+                             f"expected one of {CHUNK_COMPRESSIONS}")
+        
+        from langchain_community.docstore.in_memory import InMemoryDocstore
+        from langchain_community.vectorstores import FAISS
+        
         embedding_model = get_embedding_model(model_name)
+        params = resolve_index_params(index_params)
+        vectorstore = None
+        index_config = None
+        if mode != "rebuild" and os.path.isdir(index_name):
+            vectorstore = load_vectorstore(index_name, model_name, mmap=False)
+            if vectorstore is None:
+                raise RuntimeError(f"Could not load existing index '{index_name}'")
+        
+        existing_by_source = _ids_by_source(vectorstore) if mode == "upsert" and vectorstore else {}
+        seen_by_source: Dict[str, Set[int]] = {}
+        run_ids: Set[int] = set()
+        pending_docs, pending_ids, pending_vectors = [], [], []
+        added = removed = count = 0
+        start = time.perf_counter()
+        
+        def flush_pending(final: bool) -> None:
+            nonlocal vectorstore, index_config
+            buffered = sum(len(v) for v in pending_vectors)
+            if not buffered or (not final and buffered < training_size(index_type, params)):
+                return
+            vectors = np.vstack(pending_vectors)
+            index, index_config = build_index(index_type, vectors.shape[1], params,
+                                              vectors if needs_training(index_type, params) else None)
+            vectorstore = FAISS(embedding_model, index, InMemoryDocstore({}), {})
+            vectorstore.exact_vectors = ExactVectors() if "vector_dtype" in index_config else None
+            _add_embeddings(vectorstore, pending_docs, vectors, pending_ids)
+            pending_docs.clear()
+            pending_ids.clear()
+            pending_vectors.clear()
+        
+        # Reading a batch includes parsing and splitting the documents it comes from
+        for batch in traced(_batched(documents, batch_size), "read_chunks"):
+            new_docs, new_ids = [], []
+            for doc in batch:
+                doc_id = document_id(doc)
+                seen_by_source.setdefault(str(doc.metadata.get("source", "")), set()).add(doc_id)
+                if doc_id in run_ids:
+                    continue
+                run_ids.add(doc_id)
+                if vectorstore is not None and doc_id in vectorstore.index_to_docstore_id:
+                    continue
+                new_docs.append(doc)
+                new_ids.append(doc_id)
+            
+            if new_docs:
+                embeddings = encode_documents([doc.page_content for doc in new_docs],
+                                              model_name, batch_size, embedding_cache)
+                if vectorstore is None:
+                    pending_docs.extend(new_docs)
+                    pending_ids.extend(new_ids)
+                    pending_vectors.append(embeddings)
+                    flush_pending(final=False)
+                else:
+                    _add_embeddings(vectorstore, new_docs, embeddings, new_ids)
+                added += len(new_docs)
+            count += len(batch)
+            if on_progress:
+                on_progress(count, time.perf_counter() - start)
         
-        vectorstore = FAISS.from_texts(texts, embedding_model)
-        vectorstore.save_local(index_name)
+        flush_pending(final=True)
+        if vectorstore is None:
+            raise ValueError("No documents to index")
         
+        if mode == "upsert":
+            stale = [i for source, ids in existing_by_source.items()
+                     if source in seen_by_source
+                     for i in ids - seen_by_source[source]]
+            removed = _remove_ids(vectorstore, stale)
+        
+        print(f"Added {added} chunks, removed {removed}, kept {count - added} unchanged")
+        if embedding_cache is not None:
+            stats = embedding_cache.stats()
+            print(f"Embedding cache: {stats['hits']} hits, {stats['misses']} misses "
+                  f"({stats['hit_rate']:.0%} hit rate)")
+        if index_config is not None and "vector_dtype" in index_config:
+            if not index_config["rescore_factor"]:
+                index_config["rescore_factor"] = calibrate_rescore_factor(
+                    vectorstore, index_config["min_recall"])
+            vectorstore.rescore_factor = index_config["rescore_factor"]
+        if added or removed or mode == "rebuild":
+            save_vectorstore(vectorstore, index_name, model_name, index_config,
+                             chunk_compression)
         return vectorstore
     except Exception as e:
         print(f"Error creating vectorstore: {e}")
         raise
 
-def load_vectorstore(index_name: str = "faiss_index") -> Optional[FAISS]:
+def delete_documents(index_name: str, sources: List[str]) -> int:
+    """
+    Remove every chunk of the given sources from a saved index
+    
+    Args:
+        index_name: Path to the saved index
+        sources: Source values (as stored in chunk metadata) to remove
+        
+    Returns:
+        Number of chunks removed
+    """
+    vectorstore = load_vectorstore(index_name, mmap=False)
+    if vectorstore is None:
+        return 0
+    by_source = _ids_by_source(vectorstore)
+    removed = _remove_ids(vectorstore, [i for source in sources
+                                        for i in by_source.get(source, ())])
+    if removed:
+        save_vectorstore(vectorstore, index_name, read_manifest(index_name).get(
+            "model_name", "all-MiniLM-L6-v2"))
+    return removed
+
+def _mmap_flags(manifest: Dict) -> int:
+    """FAISS read flags that map an index of the type recorded in a manifest"""
+    index_type = manifest.get("index", {}).get("index_type", "flat")
+    return IVF_MMAP_FLAGS if index_type.startswith("ivf") else MMAP_FLAGS
+
+def load_vectorstore(index_name: str = "faiss_index",
+                     model_name: Optional[str] = None,
+                     mmap: bool = True,
+                     load_model: bool = True) -> Optional[FAISS]:
     """
     Load a FAISS vectorstore from disk
     
+    Chunk texts are always memory-mapped. With mmap, so is the FAISS index
+    (read-only): opening is near-instant, pages are read on first access,
+    and processes serving the same index share them through the OS page
+    cache. Indexes that will be modified must be loaded with mmap=False.
+    
     Args:
         index_name: Path to the saved index
+        model_name: Embedding model to attach; defaults to the one recorded
+            in the index manifest
+        mmap: Map the FAISS index instead of reading it into memory
+        load_model: Load the embedding model now; stores only searched with
+            precomputed query embeddings (e.g. shards in worker processes)
+            never load it
         
     Returns:
         The loaded FAISS vectorstore or None if loading fails
     """
     try:
-        embedding_model = get_embedding_model()
-        return FAISS.load_local(
-            index_name, 
-            embedding_model, 
-            allow_dangerous_deserialization=True
-        )
+        manifest = read_manifest(index_name)
+        model_name = model_name or manifest.get("model_name", "all-MiniLM-L6-v2")
+        embedding_model = (get_embedding_model(model_name) if load_model
+                           else RegistryEmbeddings(model_name))
+        with span("load_index", index=index_name, mmap=mmap):
+            vectorstore = _open_vectorstore(index_name, manifest, embedding_model, mmap)
+        record_index_size(index_name, vectorstore.index.ntotal)
+        return vectorstore
     except Exception as e:
         print(f"Error loading vectorstore from {index_name}: {e}")
         return None
 
+def _open_vectorstore(index_name: str, manifest: Dict, embedding_model, mmap: bool) -> FAISS:
+    """Open the files of a saved index as a vectorstore (raises on failure)"""
+    from langchain_community.vectorstores import FAISS
+    
+    if not ChunkStore.exists(index_name):
+        if os.path.exists(os.path.join(index_name, LEGACY_DOCSTORE_FILE)):
+            raise ValueError("index uses the old pickled docstore, which is not "
+                             "loaded for security reasons; rebuild it with ingest.py")
+        raise FileNotFoundError(f"no index found in '{index_name}'")
+    index = faiss.read_index(os.path.join(index_name, FAISS_FILE),
+                             _mmap_flags(manifest) if mmap else 0)
+    chunks = ChunkStore(index_name)
+    vectorstore = FAISS(embedding_model, index, ChunkDocstore(chunks), ChunkIdMap(chunks))
+    # Opening the sidecar reads nothing; columns are mapped on first lookup
+    vectorstore.metadata_store = (MetadataStore(index_name)
+                                  if MetadataStore.exists(index_name) else None)
+    vectorstore.keyword_index = (KeywordIndex(index_name)
+                                 if KeywordIndex.exists(index_name) else None)
+    vectorstore.exact_vectors = (ExactVectors(index_name)
+                                 if ExactVectors.exists(index_name) else None)
+    vectorstore.rescore_factor = manifest.get("index", {}).get("rescore_factor") or 1
+    return vectorstore
+
+def _filter_ids(vectorstore: FAISS, filter: Dict) -> np.ndarray:
+    """IDs of the chunks whose metadata satisfies filter"""
+    store = getattr(vectorstore, "metadata_store", None)
+    if store is not None:
+        return store.ids_for(filter)
+    # Vectorstores that were never saved keep metadata inline
+    ids = list(vectorstore.index_to_docstore_id)
+    return np.asarray(sorted(i for i, metadata in zip(ids, _metadata_for(vectorstore, ids))
+                             if metadata_matches(metadata, filter)), dtype="int64")
+
+def _search_subset(vectorstore: FAISS, embeddings: np.ndarray, ids: np.ndarray, k: int):
+    """Exact top-k over the given IDs, scored block by block"""
+    k = min(k, len(ids))
+    best_distances = np.full((len(embeddings), 0), np.inf, dtype="float32")
+    best_labels = np.empty((len(embeddings), 0), dtype="int64")
+    query_norms = (embeddings ** 2).sum(axis=1, keepdims=True)
+    for start in range(0, len(ids), _EXACT_BLOCK_SIZE):
+        block_ids = ids[start:start + _EXACT_BLOCK_SIZE]
+        vectors = _vectors_for(vectorstore, block_ids)
+        distances = query_norms - 2.0 * embeddings @ vectors.T + (vectors ** 2).sum(axis=1)
+        distances = np.concatenate([best_distances, distances], axis=1)
+        block_labels = np.broadcast_to(block_ids, (len(embeddings), len(block_ids)))
+        labels = np.concatenate([best_labels, block_labels], axis=1)
+        top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        best_distances = np.take_along_axis(distances, top, axis=1)
+        best_labels = np.take_along_axis(labels, top, axis=1)
+    order = np.argsort(best_distances, axis=1)
+    return np.take_along_axis(best_distances, order, axis=1), np.take_along_axis(best_labels, order, axis=1)
+
+def search_vectors(vectorstore: FAISS, embeddings: np.ndarray, k: int,
+                   nprobe: Optional[int] = None,
+                   ef_search: Optional[int] = None,
+                   filter: Optional[Dict] = None):
+    """
+    Search query vectors, optionally restricted to chunks matching a metadata filter
+    
+    Filtered queries look the matching IDs up in the metadata inverted index.
+    Small subsets (up to EXACT_FILTER_THRESHOLD) are scored exactly, so their
+    cost depends only on the subset size; larger ones are searched through
+    the index with an ID selector, falling back to exact scoring if the
+    approximate search returns fewer than k hits.
+    
+    Compact indexes (float16, int8 or binary vectors) are first searched for
+    rescore_factor * k candidates, which are then rescored exactly against
+    the memory-mapped full-precision vectors.
+    
+    Args:
+        vectorstore: The FAISS vectorstore to search in
+        embeddings: float32 query matrix
+        k: Number of results per query
+        nprobe: IVF lists to visit
+        ef_search: HNSW search depth
+        filter: Metadata conditions, e.g. {"source": "a.pdf", "page": {"$gte": 3}}
+        
+    Returns:
+        (distances, labels) arrays of shape (len(embeddings), k); missing
+        results are labelled -1
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+    record_batch_size("vector_search", len(embeddings))
+    if getattr(vectorstore, "exact_vectors", None) is None:
+        with span("vector_search", queries=len(embeddings), k=k, filtered=bool(filter)):
+            return _search_index(vectorstore, embeddings, k, nprobe, ef_search, filter)
+    depth = k * max(1, getattr(vectorstore, "rescore_factor", 1))
+    with span("vector_search", queries=len(embeddings), k=depth, filtered=bool(filter)):
+        _, labels = _search_index(vectorstore, embeddings, depth, nprobe, ef_search, filter)
+    with span("rescore", queries=len(embeddings), candidates=depth):
+        return _rescore(vectorstore, embeddings, labels, k)
+
+def vector_hits(vectorstore: FAISS, embeddings: np.ndarray, k: int,
+                nprobe: Optional[int] = None,
+                ef_search: Optional[int] = None,
+                filter: Optional[Dict] = None) -> List[List[tuple]]:
+    """(id, similarity) pairs of the nearest chunks of each query, best first"""
+    distances, labels = search_vectors(vectorstore, embeddings, k, nprobe, ef_search, filter)
+    return [[(int(label), 1.0 - float(d) / 2.0) for label, d in zip(row, dist) if label != -1]
+            for row, dist in zip(labels, distances)]
+
+def _search_index(vectorstore: FAISS, embeddings: np.ndarray, k: int,
+                  nprobe: Optional[int] = None,
+                  ef_search: Optional[int] = None,
+                  filter: Optional[Dict] = None):
+    """First-pass search of search_vectors, on the codes stored in the index"""
+    if not filter:
+        params = search_parameters(vectorstore.index, nprobe, ef_search)
+        return vectorstore.index.search(embeddings, k, params=params)
+    
+    ids = _filter_ids(vectorstore, filter)
+    distances = np.full((len(embeddings), k), np.inf, dtype="float32")
+    labels = np.full((len(embeddings), k), -1, dtype="int64")
+    if not len(ids):
+        return distances, labels
+    
+    if len(ids) <= EXACT_FILTER_THRESHOLD:
+        found_distances, found_labels = _search_subset(vectorstore, embeddings, ids, k)
+    else:
+        selector = faiss.IDSelectorBatch(ids)
+        params = search_parameters(vectorstore.index, nprobe, ef_search, selector)
+        try:
+            found_distances, found_labels = vectorstore.index.search(embeddings, k, params=params)
+        except RuntimeError:
+            # Binary (LSH) codes cannot be searched with an ID selector
+            found_distances, found_labels = _search_subset(vectorstore, embeddings, ids, k)
+        short = np.flatnonzero((found_labels == -1).any(axis=1))
+        if len(short):
+            exact_distances, exact_labels = _search_subset(vectorstore, embeddings[short],
+                                                           ids, k)
+            found_distances[short], found_labels[short] = exact_distances, exact_labels
+    width = found_labels.shape[1]
+    distances[:, :width], labels[:, :width] = found_distances, found_labels
+    return distances, labels
+
+def _rescore(vectorstore: FAISS, embeddings: np.ndarray, labels: np.ndarray, k: int):
+    """Exact top-k among candidate labels, by squared L2 to the full-precision vectors"""
+    distances = np.full((len(embeddings), k), np.inf, dtype="float32")
+    result = np.full((len(embeddings), k), -1, dtype="int64")
+    candidates = np.unique(labels[labels != -1])
+    if not len(candidates):
+        return distances, result
+    vectors = _vectors_for(vectorstore, candidates)
+    for row, (query, row_labels) in enumerate(zip(embeddings, labels)):
+        row_labels = row_labels[row_labels != -1]
+        row_vectors = vectors[np.searchsorted(candidates, row_labels)]
+        row_distances = ((row_vectors - query) ** 2).sum(axis=1)
+        best = np.argsort(row_distances, kind="stable")[:k]
+        distances[row, :len(best)] = row_distances[best]
+        result[row, :len(best)] = row_labels[best]
+    return distances, result
+
+def calibrate_rescore_factor(vectorstore: FAISS, min_recall: float,
+                             k: int = CALIBRATION_K,
+                             queries: int = CALIBRATION_QUERIES) -> int:
+    """
+    Smallest rescoring depth of a compact index that reaches a recall target
+    
+    Queries are midpoints of random pairs of stored vectors, which lie
+    between chunks as real queries do (a stored vector itself would find its
+    own near-duplicates too easily). Their exact nearest neighbours,
+    computed from the full-precision vectors, are compared with the
+    rescored results for each factor in RESCORE_FACTORS.
+    
+    Args:
+        vectorstore: Vectorstore with a compact index and exact_vectors
+        min_recall: Required mean recall@k, e.g. 0.95
+        k: Neighbours compared per query
+        queries: Number of sample queries
+        
+    Returns:
+        The first factor whose recall@k reaches min_recall, else the largest
+    """
+    ids = np.sort(np.fromiter(vectorstore.index_to_docstore_id, dtype="int64"))
+    k = min(k, len(ids))
+    if k < 1:
+        return RESCORE_FACTORS[0]
+    pairs = np.random.default_rng(0).choice(ids, (queries, 2))
+    embeddings = np.ascontiguousarray(
+        (_vectors_for(vectorstore, pairs[:, 0]) + _vectors_for(vectorstore, pairs[:, 1])) / 2)
+    _, truth = _search_subset(vectorstore, embeddings, ids, k)
+    for factor in RESCORE_FACTORS:
+        _, labels = _search_index(vectorstore, embeddings, k * factor)
+        _, found = _rescore(vectorstore, embeddings, labels, k)
+        recall = float(np.mean([len(set(row) & set(expected)) / k
+                                for row, expected in zip(found.tolist(), truth.tolist())]))
+        if recall >= min_recall:
+            break
+    print(f"Rescoring {factor}x candidates: recall@{k} {recall:.3f} (target {min_recall})")
+    if recall < min_recall:
+        print("Warning: recall target not reached; use a less compact vector dtype")
+    return factor
+
 def similarity_search(query: str, 
                      vectorstore: FAISS, 
                      k: int = 5, 
-                     model_name: str = "all-MiniLM-L6-v2") -> List[Document]:
+                     model_name: str = "all-MiniLM-L6-v2",
+                     nprobe: Optional[int] = None,
+                     ef_search: Optional[int] = None,
+                     filter: Optional[Dict] = None,
+                     query_embedding=None) -> List[Document]:
     """
     Perform similarity search using embeddings
     
@@ -66,17 +659,252 @@ def similarity_search(query: str,
         vectorstore: The FAISS vectorstore to search in
         k: Number of results to return
         model_name: The embedding model to use
+        nprobe: IVF lists to visit, overriding the value saved with the index
+        ef_search: HNSW search depth, overriding the value saved with the index
+        filter: Only return chunks whose metadata matches these conditions
+        query_embedding: Precomputed embedding of query (skips encoding)
         
     Returns:
-        List of Document objects sorted by relevance
+        List of Document objects sorted by relevance, each with its chunk "id"
+        and similarity "score" added to the metadata
     """
     try:
         # Get query embedding 
-        query_embedding = encode_query(query, model_name)
+        if query_embedding is None:
+            query_embedding = encode_query(query, model_name)
+        query_embedding = np.asarray([query_embedding], dtype="float32")
         
         # Search by vector
-        results = vectorstore.similarity_search_by_vector(query_embedding, k=k)
-        return results
+        distances, labels = search_vectors(vectorstore, query_embedding, k,
+                                           nprobe, ef_search, filter)
+        return _docs_for_labels(vectorstore, labels[0], distances[0])
     except Exception as e:
         print(f"Error during similarity search: {e}")
-        return []
\ No newline at end of file
+        return []
+
+def _docs_for_labels(vectorstore: FAISS, labels, distances) -> List[Document]:
+    """
+    Map a row of FAISS results to documents, skipping empty (-1) slots
+    
+    Returned documents are copies whose metadata also holds the chunk "id" and
+    a similarity "score" (1 - squared L2 / 2, i.e. cosine similarity for
+    normalized embeddings).
+    """
+    return _docs_for_ids(vectorstore, [(int(label), {"score": 1.0 - float(distance) / 2.0})
+                                       for label, distance in zip(labels, distances)
+                                       if label != -1])
+
+def _docs_for_ids(vectorstore: FAISS, hits: List[tuple]) -> List[Document]:
+    """Documents for (id, extra metadata) pairs, skipping IDs not in the store"""
+    with span("fetch_documents", hits=len(hits)):
+        hits = [(i, extra) for i, extra in hits if i in vectorstore.index_to_docstore_id]
+        metadatas = _metadata_for(vectorstore, [i for i, _ in hits])
+        docs = []
+        for (i, extra), metadata in zip(hits, metadatas):
+            doc = vectorstore.docstore.search(vectorstore.index_to_docstore_id[i])
+            if isinstance(doc, str):
+                continue
+            metadata.update(id=i, **extra)
+            docs.append(type(doc)(page_content=doc.page_content, metadata=metadata))
+        return docs
+
+def similarity_search_many(queries: List[str],
+                           vectorstore: FAISS,
+                           k: int = 5,
+                           model_name: str = "all-MiniLM-L6-v2",
+                           batch_size: int = 256,
+                           nprobe: Optional[int] = None,
+                           ef_search: Optional[int] = None,
+                           filter: Optional[Dict] = None,
+                           embeddings=None) -> List[List[Document]]:
+    """
+    Perform similarity search for many queries with batched encoding and search
+    
+    Queries are processed in slices of batch_size: each slice is encoded as one
+    matrix and searched with a single FAISS call.
+    
+    Args:
+        queries: The query strings
+        vectorstore: The FAISS vectorstore to search in
+        k: Number of results to return per query
+        model_name: The embedding model to use
+        batch_size: Number of queries encoded and searched together
+        nprobe: IVF lists to visit, overriding the value saved with the index
+        ef_search: HNSW search depth, overriding the value saved with the index
+        filter: Only return chunks whose metadata matches these conditions
+        embeddings: Precomputed query embeddings, one row per query (skips encoding)
+        
+    Returns:
+        One list of Document objects per query, in input order
+    """
+    results: List[List[Document]] = []
+    try:
+        for start in range(0, len(queries), batch_size):
+            batch = queries[start:start + batch_size]
+            batch_embeddings = (encode_queries(batch, model_name, batch_size=batch_size)
+                                if embeddings is None else embeddings[start:start + batch_size])
+            distances, labels = search_vectors(vectorstore, batch_embeddings, k,
+                                               nprobe, ef_search, filter)
+            results.extend(_docs_for_labels(vectorstore, row, dist)
+                           for row, dist in zip(labels, distances))
+        return results
+    except Exception as e:
+        print(f"Error during batched similarity search: {e}")
+        return results + [[] for _ in range(len(queries) - len(results))]
+
+
+def _keyword_hits(query: str, vectorstore: FAISS, k: int,
+                  filter: Optional[Dict] = None,
+                  collection: Optional[tuple] = None) -> List[tuple]:
+    """(id, BM25 score) pairs of the best keyword matches of a query"""
+    keyword_index = getattr(vectorstore, "keyword_index", None)
+    if keyword_index is None:
+        return []
+    with span("keyword_search", k=k, filtered=bool(filter)):
+        allowed = keyword_index.rows(_filter_ids(vectorstore, filter)) if filter else None
+        ids, scores = keyword_index.search(query, k, allowed, collection)
+    return [(int(i), float(score)) for i, score in zip(ids, scores)]
+
+def keyword_search(query: str,
+                   vectorstore: FAISS,
+                   k: int = 5,
+                   filter: Optional[Dict] = None) -> List[Document]:
+    """
+    Perform BM25 keyword search
+    
+    Args:
+        query: The query string
+        vectorstore: The FAISS vectorstore whose keyword index is searched
+        k: Number of results to return
+        filter: Only return chunks whose metadata matches these conditions
+        
+    Returns:
+        List of Document objects sorted by BM25 "score" (stored in metadata)
+    """
+    try:
+        if getattr(vectorstore, "keyword_index", None) is None:
+            print("Keyword index not found; re-ingest the documents to build it")
+            return []
+        return _docs_for_ids(vectorstore, [(i, {"score": score}) for i, score
+                                           in _keyword_hits(query, vectorstore, k, filter)])
+    except Exception as e:
+        print(f"Error during keyword search: {e}")
+        return []
+
+def fuse_rankings(vector_hits: List[tuple], keyword_hits: List[tuple], k: int,
+                  fusion: str = "rrf", vector_weight: float = 0.5) -> List[tuple]:
+    """
+    Merge vector and keyword rankings into one
+    
+    rrf sums 1 / (RRF_K + rank) over both lists. weighted min-max normalizes
+    each list's scores and mixes them as vector_weight * vector +
+    (1 - vector_weight) * keyword; chunks missing from a list get 0 there.
+    
+    Args:
+        vector_hits: (id, similarity) pairs, best first
+        keyword_hits: (id, BM25 score) pairs, best first
+        k: Number of fused results
+        fusion: One of FUSION_METHODS
+        vector_weight: Weight of the vector ranking in weighted fusion
+        
+    Returns:
+        (id, extra metadata) pairs with the fused "score" and the component
+        "vector_score"/"keyword_score", best first
+    """
+    if fusion not in FUSION_METHODS:
+        raise ValueError(f"Unknown fusion method '{fusion}', expected one of {FUSION_METHODS}")
+    fused: Dict[int, float] = {}
+    components: Dict[int, Dict[str, float]] = {}
+    for name, hits, weight in (("vector_score", vector_hits, vector_weight),
+                               ("keyword_score", keyword_hits, 1.0 - vector_weight)):
+        if not hits:
+            continue
+        scores = [score for _, score in hits]
+        low, spread = min(scores), max(scores) - min(scores)
+        for rank, (i, score) in enumerate(hits):
+            if fusion == "rrf":
+                contribution = 1.0 / (RRF_K + rank + 1)
+            else:
+                contribution = weight * ((score - low) / spread if spread else 1.0)
+            fused[i] = fused.get(i, 0.0) + contribution
+            components.setdefault(i, {})[name] = score
+    best = sorted(fused, key=fused.get, reverse=True)[:k]
+    return [(i, dict(components[i], score=fused[i])) for i in best]
+
+def hybrid_search(query: str,
+                  vectorstore: FAISS,
+                  k: int = 5,
+                  model_name: str = "all-MiniLM-L6-v2",
+                  nprobe: Optional[int] = None,
+                  ef_search: Optional[int] = None,
+                  filter: Optional[Dict] = None,
+                  fusion: str = "rrf",
+                  vector_weight: float = 0.5,
+                  candidates: Optional[int] = None,
+                  query_embedding=None) -> List[Document]:
+    """
+    Perform hybrid search, fusing vector and BM25 keyword candidates
+    
+    Exact identifiers, error codes and part numbers that embeddings blur
+    together are still found by the keyword side. Without a keyword index
+    this is a plain similarity search.
+    
+    Args:
+        query: The query string
+        vectorstore: The FAISS vectorstore to search in
+        k: Number of results to return
+        model_name: The embedding model to use
+        nprobe: IVF lists to visit, overriding the value saved with the index
+        ef_search: HNSW search depth, overriding the value saved with the index
+        filter: Only return chunks whose metadata matches these conditions
+        fusion: One of FUSION_METHODS
+        vector_weight: Weight of the vector ranking in weighted fusion
+        candidates: Results taken from each side before fusion (default 4 * k, at least 20)
+        query_embedding: Precomputed embedding of query (skips encoding)
+        
+    Returns:
+        List of Document objects sorted by fused "score"
+    """
+    embeddings = None if query_embedding is None else np.asarray([query_embedding], dtype="float32")
+    return hybrid_search_many([query], vectorstore, k, model_name, 1, nprobe, ef_search,
+                              filter, fusion, vector_weight, candidates, embeddings)[0]
+
+def hybrid_search_many(queries: List[str],
+                       vectorstore: FAISS,
+                       k: int = 5,
+                       model_name: str = "all-MiniLM-L6-v2",
+                       batch_size: int = 256,
+                       nprobe: Optional[int] = None,
+                       ef_search: Optional[int] = None,
+                       filter: Optional[Dict] = None,
+                       fusion: str = "rrf",
+                       vector_weight: float = 0.5,
+                       candidates: Optional[int] = None,
+                       embeddings=None) -> List[List[Document]]:
+    """
+    Perform hybrid search for many queries
+    
+    The vector side is encoded and searched in batches of batch_size as in
+    similarity_search_many (or taken from embeddings, one row per query); see
+    hybrid_search for the other arguments.
+    
+    Returns:
+        One list of Document objects per query, in input order
+    """
+    results: List[List[Document]] = []
+    depth = candidates or max(4 * k, 20)
+    try:
+        for start in range(0, len(queries), batch_size):
+            batch = queries[start:start + batch_size]
+            batch_embeddings = (encode_queries(batch, model_name, batch_size=batch_size)
+                                if embeddings is None else embeddings[start:start + batch_size])
+            batch_hits = vector_hits(vectorstore, batch_embeddings, depth,
+                                     nprobe, ef_search, filter)
+            for query, hits in zip(batch, batch_hits):
+                keyword_hits = _keyword_hits(query, vectorstore, depth, filter)
+                results.append(_docs_for_ids(vectorstore, fuse_rankings(
+                    hits, keyword_hits, k, fusion, vector_weight)))
+        return results
+    except Exception as e:
+        print(f"Error during hybrid search: {e}")
+        return results + [[] for _ in range(len(queries) - len(results))]